@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+
+"""Benchmarks for meteo_check_status.py checks on large synthetic Weewx DBs.
+
+Generates Weewx archives with the full archive table schema at 1-minute
+resolution and measures DB check and full check cycle performance. Each
+scenario runs in a separate process, so that peak RSS values are independent.
+Results are written as JSON (one object per DB size and scenario).
+
+Example:
+  ./bench_meteo_check_status.py --years 1 5 10 --db-dir /var/tmp/meteo-bench --output results.json
+"""
+
+import sys
+import os
+import argparse
+import time
+import math
+import json
+import random
+import sqlite3
+import contextlib
+import tempfile
+import multiprocessing
+import resource
+import statistics
+
+# archive table schema of Weewx 3.x (see notes.txt)
+archive_columns = ['dateTime', 'usUnits', 'interval', 'barometer', 'pressure', 'altimeter',
+  'inTemp', 'outTemp', 'inHumidity', 'outHumidity', 'windSpeed', 'windDir', 'windGust',
+  'windGustDir', 'rainRate', 'rain', 'dewpoint', 'windchill', 'heatindex', 'ET', 'radiation',
+  'UV', 'extraTemp1', 'extraTemp2', 'extraTemp3', 'soilTemp1', 'soilTemp2', 'soilTemp3',
+  'soilTemp4', 'leafTemp1', 'leafTemp2', 'extraHumid1', 'extraHumid2', 'soilMoist1',
+  'soilMoist2', 'soilMoist3', 'soilMoist4', 'leafWet1', 'leafWet2', 'rxCheckPercent',
+  'txBatteryStatus', 'consBatteryVoltage', 'hail', 'hailRate', 'heatingTemp', 'heatingVoltage',
+  'supplyVoltage', 'referenceVoltage', 'windBatteryStatus', 'rainBatteryStatus',
+  'outTempBatteryStatus', 'inTempBatteryStatus']
+archive_schema = 'CREATE TABLE archive (`dateTime` INTEGER NOT NULL UNIQUE PRIMARY KEY, ' \
+  '`usUnits` INTEGER NOT NULL, `interval` INTEGER NOT NULL, ' + \
+  ', '.join('`{0}` REAL'.format(column) for column in archive_columns[3:]) + ')'
+# Columns, that FineOffsetUSB driver fills in. The rest are NULL
+station_columns = ['dateTime', 'usUnits', 'interval', 'barometer', 'pressure', 'altimeter',
+  'inTemp', 'outTemp', 'inHumidity', 'outHumidity', 'windSpeed', 'windDir', 'windGust',
+  'windGustDir', 'rain', 'dewpoint', 'windchill', 'heatindex', 'rxCheckPercent']
+record_interval = 60
+insert_batch_size = 10000
+
+def generate_records(start_time, end_time):
+  """Yields synthetic station records with 1-minute interval"""
+  rnd = random.Random(start_time)
+  for record_time in range(start_time, end_time + 1, record_interval):
+    day_phase = math.sin(2 * math.pi * (record_time % 86400) / 86400)
+    out_temp = 10 + 8 * day_phase + rnd.uniform(-0.5, 0.5)
+    wind_speed = max(0, 4 + 3 * day_phase + rnd.gauss(0, 1.5))
+    # Occasional lost connection: no wind data
+    if rnd.random() < 0.002:
+      wind_speed = wind_gust = wind_dir = None
+    else:
+      wind_gust = wind_speed + abs(rnd.gauss(0, 2))
+      wind_dir = rnd.uniform(0, 360)
+    yield (record_time, 16, 1, 1013 + rnd.uniform(-2, 2), 1012 + rnd.uniform(-2, 2),
+      1013 + rnd.uniform(-2, 2), 22 + rnd.uniform(-1, 1), out_temp, 45 + rnd.uniform(-5, 5),
+      70 + 20 * day_phase, wind_speed, wind_dir, wind_gust, wind_dir,
+      0.0 if rnd.random() > 0.01 else 0.2, out_temp - 3, out_temp, out_temp, 100.0)
+
+def generate_db(db_file, years):
+  """Creates (or tops up to the current time) a synthetic Weewx DB file"""
+  end_time = int(time.time()) // record_interval * record_interval
+  with contextlib.closing(sqlite3.connect(db_file)) as conn:
+    conn.execute('PRAGMA journal_mode=OFF')
+    conn.execute('PRAGMA synchronous=OFF')
+    conn.execute(archive_schema.replace('CREATE TABLE', 'CREATE TABLE IF NOT EXISTS'))
+    last_record_time = conn.execute('SELECT max(dateTime) FROM archive').fetchone()[0]
+    if last_record_time is None:
+      start_time = end_time - int(years * 365 * 86400) // record_interval * record_interval
+    else:
+      start_time = last_record_time + record_interval
+    insert_sql = 'INSERT INTO archive ({0}) VALUES ({1})'.format(
+      ', '.join('`{0}`'.format(column) for column in station_columns),
+      ', '.join('?' * len(station_columns)))
+    records = generate_records(start_time, end_time)
+    while True:
+      batch = [record for _, record in zip(range(insert_batch_size), records)]
+      if not(batch):
+        break
+      conn.executemany(insert_sql, batch)
+      conn.commit()
+    return(conn.execute('SELECT count(*) FROM archive').fetchone()[0])
+
+def read_proc_io():
+  """Returns number of bytes read by read() syscalls (includes page cache hits)"""
+  with open('/proc/self/io') as f:
+    for line in f:
+      if line.startswith('rchar:'):
+        return(int(line.split()[1]))
+  return(0)
+
+# Original check query, that computes a local time string for every row. Kept to
+# compare with the index-friendly one
+legacy_query = 'SELECT windSpeed, datetime(dateTime, "unixepoch", "localtime") AS dt, ' \
+  'dateTime FROM archive WHERE dt >= datetime("now", "-15 Minute", "localtime") ' \
+  'ORDER BY dt DESC'
+
+def run_scenario(scenario, db_file, repeat, result_queue):
+  """Runs a scenario in a child process and puts measurement results to the queue"""
+  import logging
+  import meteo_check_status
+  meteo_check_status.logger.setLevel(logging.CRITICAL)
+  work_dir = tempfile.mkdtemp()
+  meteo_check_status.data_file = os.path.join(work_dir, 'data_file')
+  meteo_check_status.weewx_db_file = db_file
+  meteo_check_status.min_uptime_before_check = 0
+  # A check cycle on the benchmark host may fail (no USB station, no Weewx
+  # process), which must not reboot the host, run remediation commands or send
+  # mail. Re-check bursts would add their sleeps to the measured latency
+  class BenchEnvironment(meteo_check_status.SystemEnvironment):
+    def system(self, command):
+      return(0)
+    def call(self, command, timeout):
+      return(0)
+  meteo_check_status.environment = BenchEnvironment()
+  meteo_check_status.do_reboot = lambda state_file=None: False
+  meteo_check_status.send_mail_to_root = lambda message=None: None
+  meteo_check_status.recheck_budget = 0
+
+  # SQLite VM instructions are counted in a separate run: the progress handler
+  # is a python call per instruction, that would dominate the timed runs
+  vm_steps = [0]
+  counting = [False]
+  def count_vm_steps():
+    vm_steps[0] += 1
+    return(0)
+
+  def prepare_connection(conn):
+    conn.set_progress_handler(count_vm_steps if counting[0] else None, 1)
+    return(conn)
+
+  if scenario == 'legacy_query':
+    conn = sqlite3.connect(db_file)
+    run = lambda: prepare_connection(conn).execute(legacy_query).fetchall()
+    cold_run = None
+  elif scenario in ('check_db_cold', 'check_db_incremental', 'check_cycle'):
+    def run_check():
+      weewx_db = meteo_check_status.get_weewx_db()
+      prepare_connection(weewx_db.get_connection())
+      if scenario == 'check_cycle':
+        meteo_check_status.do_check(True)
+      else:
+        meteo_check_status.do_check_db()
+    def cold_run():
+      # No saved high-water marks: the check has to look through recent records
+      if os.path.isfile(meteo_check_status.data_file):
+        os.remove(meteo_check_status.data_file)
+      meteo_check_status.state_stores.clear()
+      meteo_check_status.weewx_db = None
+      run_check()
+    run = cold_run if scenario == 'check_db_cold' else run_check
+  else:
+    raise ValueError('Unknown scenario: {0}'.format(scenario))
+
+  # Warm up: open the connection and set high-water marks
+  (cold_run or run)()
+  durations = []
+  bytes_read = []
+  for _ in range(repeat):
+    rchar_before = read_proc_io()
+    start_time = time.perf_counter()
+    run()
+    durations.append(time.perf_counter() - start_time)
+    bytes_read.append(read_proc_io() - rchar_before)
+  counting[0] = True
+  run()
+  counting[0] = False
+
+  with contextlib.closing(sqlite3.connect(db_file)) as conn:
+    page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+  result_queue.put({
+    'latency_min_ms': min(durations) * 1000,
+    'latency_median_ms': statistics.median(durations) * 1000,
+    # SQLite VM instructions per run, proportional to the number of rows visited
+    'vm_steps': vm_steps[0],
+    # Bytes, returned by read() syscalls of the process (DB and other files),
+    # including page cache hits. SQLite doesn't report its own page reads to python
+    'bytes_read': statistics.median(bytes_read),
+    'bytes_read_in_pages': statistics.median(bytes_read) / page_size,
+    # Linux reports ru_maxrss in kilobytes
+    'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  })
+
+def measure(scenario, db_file, repeat):
+  # Spawned process doesn't inherit parent's memory, so peak RSS is not skewed
+  context = multiprocessing.get_context('spawn')
+  result_queue = context.Queue()
+  process = context.Process(target=run_scenario, args=(scenario, db_file, repeat, result_queue))
+  process.start()
+  result = result_queue.get()
+  process.join()
+  return(result)
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmarks meteo_check_status.py checks ' \
+    'on synthetic Weewx DBs')
+  parser.add_argument('-y', '--years', dest='years', type=float, nargs='+', default=[1, 5, 10],
+    help='Synthetic DB sizes in years of 1-minute records (default: %(default)s)')
+  parser.add_argument('--db-dir', dest='db_dir', default=tempfile.gettempdir(),
+    help='Directory for the generated DB files. Existing files are reused (default: %(default)s)')
+  parser.add_argument('-n', '--repeat', dest='repeat', type=int, default=20,
+    help='Number of measured runs per scenario (default: %(default)d)')
+  parser.add_argument('-s', '--scenario', dest='scenarios', action='append',
+    choices=['check_db_cold', 'check_db_incremental', 'check_cycle', 'legacy_query'],
+    help='Scenario to run, can be specified multiple times (default: all)')
+  parser.add_argument('-o', '--output', dest='output', help='Output file (default: stdout)')
+  options = parser.parse_args()
+
+  results = []
+  for years in options.years:
+    db_file = os.path.join(options.db_dir, 'meteo_bench_{0:g}y.sdb'.format(years))
+    generate_start = time.perf_counter()
+    records_count = generate_db(db_file, years)
+    sys.stderr.write('{0}: {1} records ({2:.1f}s)\n'.format(db_file, records_count,
+      time.perf_counter() - generate_start))
+    for scenario in options.scenarios or ['check_db_cold', 'check_db_incremental',
+        'check_cycle', 'legacy_query']:
+      result = {'scenario': scenario, 'years': years, 'records': records_count,
+        'db_size_bytes': os.path.getsize(db_file), 'repeat': options.repeat}
+      result.update(measure(scenario, db_file, options.repeat))
+      sys.stderr.write('  {0}: {1:.3f}ms\n'.format(scenario, result['latency_median_ms']))
+      results.append(result)
+
+  output = json.dumps({'python': sys.version.split()[0], 'sqlite': sqlite3.sqlite_version,
+    'timestamp': int(time.time()), 'results': results}, indent=2)
+  if options.output:
+    with open(options.output, 'w') as f:
+      f.write(output + '\n')
+  else:
+    print(output)
+  return(0)
+
+if __name__ == '__main__':
+  sys.exit(main())
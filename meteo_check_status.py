@@ -1,21 +1,25 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
+# Modules, that only optional or rarely used features need (argument parsing,
+# asyncio, native probes, notifications, the report, etc.), are imported where
+# they are needed to keep startup time and memory footprint low (see
+# ImportTime_FunctionalTest)
 import sys
 import signal
 import os
 import logging
-import argparse
 import time
 import subprocess
+import threading
+import queue
 import sqlite3
 import contextlib
 import datetime
-try:
-  from configparser import ConfigParser
-except ImportError:
-  from ConfigParser import ConfigParser  # ver. < 3.0
-import email.mime.text
-import socket
+import functools
+import collections
+# Imported by the modules above anyway
+import re
+import math
 
 # Filter class to log only messages with level lower than specified
 # http://stackoverflow.com/questions/2302315/how-can-info-and-debug-logging-message-be-sent-to-stdout-and-higher-level-messag/31459386#31459386
@@ -29,23 +33,27 @@ class LevelLessThanFilter(logging.Filter):
     return 1 if record.levelno < self.max_level else 0
 
 # Root logger. Accepts all levels of messages, but doesn't output anything.
-# Additional handlers will take care of that.
+# Additional handlers will take care of that (see setup_logging()).
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
+stdout_handler = None
+stderr_handler = None
 
-# Stdout handler. By default echoes only info messages. Optionally outputs
-# debug messages if --debug option is set
-stdout_handler = logging.StreamHandler(sys.stdout)
-stdout_handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
-stdout_handler.addFilter(LevelLessThanFilter(logging.WARNING))
-stdout_handler.setLevel(logging.INFO)
-logger.addHandler(stdout_handler)
+def setup_logging(debug=False):
+  global stdout_handler, stderr_handler
+  # Stdout handler. By default echoes only info messages. Optionally outputs
+  # debug messages if --debug option is set
+  stdout_handler = logging.StreamHandler(sys.stdout)
+  stdout_handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+  stdout_handler.addFilter(LevelLessThanFilter(logging.WARNING))
+  stdout_handler.setLevel(logging.DEBUG if debug else logging.INFO)
+  logger.addHandler(stdout_handler)
 
-# Stderr handler. Outputs warnings, errors and critical messages to stderr
-stderr_handler = logging.StreamHandler(sys.stderr)
-stderr_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s: %(message)s'))
-stderr_handler.setLevel(logging.WARNING)
-logger.addHandler(stderr_handler)
+  # Stderr handler. Outputs warnings, errors and critical messages to stderr
+  stderr_handler = logging.StreamHandler(sys.stderr)
+  stderr_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s: %(message)s'))
+  stderr_handler.setLevel(logging.WARNING)
+  logger.addHandler(stderr_handler)
 
 # File name to save timeout data between reboots
 data_file = os.path.expanduser('~/.meteo_check_status')
@@ -61,118 +69,2108 @@ reboot_timeouts_map = {
   720:  720  # 12h
 }
 ping_count = 3
+# We use DNS names instead of IPs for Google and OpenDNS NS to ensure that DNS resolution works
+ping_targets = ['google-public-dns-a.google.com', 'resolver1.opendns.com', 'ya.ru']
+# Overall time limit for the ping check (seconds)
+ping_deadline = 30
+# 'native' uses built-in probe engine (see run_native_probes()), 'subprocess'
+# runs external ping command for each target
+ping_backend = 'native'
+# Host name that is resolved by "dns:SERVER" ping targets
+dns_probe_name = 'ya.ru'
+# Time limit for a single check run (seconds)
+check_timeout = 120
+# Delay before running a triggered check (seconds)
+trigger_delay = 1
+# Remediation ladder: steps, that are tried in order when the check fails.
+# 'reboot' step (the last one) reboots the system (see do_reboot()), other steps
+# run commands from remediation_commands
+remediation_ladder = ['reboot']
+# Remediation step commands and delays before verification re-check (seconds)
+remediation_commands = {
+  'restart_weewx': ('sudo /usr/sbin/service weewx restart', 90),
+  # FineOffset USB device (see weewx fousb driver)
+  'reset_usb': ('sudo /usr/sbin/usb_modeswitch -v 0x1941 -p 0x8021 --reset-usb', 90),
+  'restart_network': ('sudo /usr/sbin/service networking restart', 30)
+}
+# Time limit for a remediation command (seconds)
+remediation_command_timeout = 120
+# After a failure, failing checks are re-run with this interval (seconds) until
+# they pass or recheck_budget (seconds, 0 to disable) is spent, so that transient
+# failures are dismissed before remediation (see confirm_failure())
+recheck_interval = 5
+recheck_budget = 30
+# Notification sinks: "sendmail", "smtp:HOST[:PORT]" or "webhook:URL"
+# (see create_notification_sink())
+notification_sinks = ['sendmail']
+# Notification recipient (for sendmail and SMTP sinks)
+mail_to = 'root'
+# Notices, arriving within this period of time (seconds), are sent as one digest
+notification_batch_delay = 10
+# Retry interval for undelivered notifications (seconds)
+notification_retry_interval = 60
+# Time limit for a single notification delivery (seconds)
+notification_timeout = 30
+# Undelivered notifications are kept in this file, no more than
+# notification_spool_limit notices per sink
+notification_spool_file = os.path.expanduser('~/.meteo_check_status.spool')
+notification_spool_limit = 1000
+# Notifier object (see get_notifier())
+notifier = None
+# CheckScheduler object, that is running in main() (see signal_handler())
+active_scheduler = None
+# Checks, that are run by the scheduler (see get_check_definitions()). Extra
+# checks are enabled with --check option
+enabled_checks = ['ping', 'DB']
+# Checks, added with register_check()
+custom_check_definitions = collections.OrderedDict()
+# Disk space check: paths and minimum free space (MB and percent of the size)
+disk_check_paths = ['/', '/var/lib/weewx']
+disk_min_free_mb = 100
+disk_min_free_percent = 5
+# USB device check: vendor and product IDs of the weather station (FineOffset
+# WH1080 and clones, see weewx fousb driver) and sysfs directory with USB devices
+usb_device_id = '1941:8021'
+usb_devices_dir = '/sys/bus/usb/devices'
+# Weewx process check: daemon process name
+weewx_process_name = 'weewxd'
+# REST upload check: URLs of the services, Weewx uploads data to. The check
+# passes if each service responds (any HTTP status below 500)
+upload_check_urls = ['http://www.windguru.cz/upload/api.php']
+upload_check_timeout = 30
+# Weewx log check: 'file' tails weewx_log_file, 'journal' reads systemd journal
+# entries of weewx_log_identifier with journalctl (see WeewxLogMonitor)
+weewx_log_source = 'file'
+weewx_log_file = '/var/log/syslog'
+weewx_log_identifier = 'weewx'
+# The check fails if the station has lost connection for this period of time
+# (minutes) or if there have been log_max_upload_failures failed uploads within
+# log_upload_failure_window minutes
+log_lost_connection_minutes = 5
+log_max_upload_failures = 5
+log_upload_failure_window = 15
+# Maximum amount of log data read per check (bytes), the rest is skipped
+log_max_read_bytes = 16 * 1024 * 1024
+# WeewxLogMonitor object (see get_weewx_log_monitor())
+weewx_log_monitor = None
+# Weewx log events (see notes.txt):
+#   fousb: station status {'unknown': 0, 'lost_connection': 64, 'rain_overflow': 0} (64)
+#   restx: WindGuru: Failed to publish record 2016-08-19 23:11:00 EET (1471641060): ...
+weewx_log_pattern = re.compile(r"fousb: station status \{.*'lost_connection': (?P<lost_connection>\d+)|"
+  r"restx: (?P<service>[^:]+): Failed to publish record")
+# Syslog line timestamp: "Aug 19 23:11:02" or RFC 3339 "2016-08-19T23:11:02"
+syslog_time_pattern = re.compile(r'^(?:(?P<iso>\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)|' \
+  r'(?P<bsd>[A-Z][a-z]{2} [ \d]\d \d\d:\d\d:\d\d))')
 # Skip check if uptime is less than this period of time (minutes)
 min_uptime_before_check = 5
 # If there is no meteo data for this period of time (in minutes), DB check will fail
 no_db_records_threshold = 15
+# Data freshness and validity rules in "[NAME=]COLUMN[:MINUTES[:MIN:MAX]]"
+# format (see DataRule.parse())
+data_rules = ['wind=windSpeed']
+# How far back to look for records (in minutes) when there are no saved high-water marks
+db_initial_lookback = 24 * 60
+# Number of compiled SQL statements kept by the DB connection between checks
+db_cached_statements = 16
+# Query Weewx DB only when its files have changed (see DBChangeWatcher)
+db_watch = False
+# 'direct' queries the Weewx DB file, 'snapshot' queries its copy (checks use
+# RecentDBSnapshot, the report uses DBSnapshot), 'auto' queries the DB file if it
+# is in WAL mode and the copy otherwise
+db_read_mode = 'direct'
+# Directory for DB snapshots. Should be on tmpfs
+db_snapshot_dir = '/dev/shm'
+# Records, that are kept in the snapshot for checks (minutes before the newest
+# record). Should cover db_initial_lookback, data rule ages and the wind window
+db_snapshot_window = 24 * 60
+# Number of DB pages, copied per backup step of the report snapshot, and pause
+# between steps (seconds)
+db_snapshot_pages = 256
+db_snapshot_step_pause = 0.005
+# DB check interval in watch mode if inotify is not available (seconds)
+db_watch_poll_interval = 10
+# Wind data anomaly detection over the last wind_window_size archive records
+# (see WindWindow): 'off', 'warn' (log a warning) or 'fail' (fail DB check)
+wind_anomaly_action = 'warn'
+wind_window_size = 180
+wind_speed_column = 'windSpeed'
+wind_gust_column = 'windGust'
+# Wind speed, that hasn't changed for this period of time (minutes), is
+# considered stuck. Calm (zero speed) can last longer
+wind_stuck_minutes = 60
+wind_calm_stuck_minutes = 360
+# Wind speed variance collapse: variance over at least half of the window is
+# less than wind_min_variance, while mean speed is above wind_min_mean (DB units)
+wind_min_variance = 0.01
+wind_min_mean = 0.5
+# Number of records in the window with gust less than speed, that is considered
+# an anomaly
+wind_max_gust_violations = 10
+# Report subcommand: values, that are more than this amount of time (minutes)
+# apart, are reported as a gap (see ArchiveReport)
+report_gap_minutes = 15
+# Number of rows, fetched from the DB at once
+report_fetch_size = 4096
+# Default number of simultaneous station checks in fleet mode
+fleet_workers = 4
+# WeewxDB object, that is reused between checks (see get_weewx_db())
+weewx_db = None
+# Frequently changing state values (DB high-water marks, last success time) are
+# written to the data file at most once per this interval (seconds), unless
+# other state changes (see StateStore)
+state_lazy_write_interval = 60 * 60
+# StateStore objects by data file path (see get_state_store())
+state_stores = {}
+
+# Prometheus metrics: histogram buckets for check phase durations (seconds)
+metrics_duration_buckets = [0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60]
+# File for node_exporter textfile collector, None to disable
+metrics_textfile = None
+
+class SystemEnvironment(object):
+  """Clock, sleep, system uptime, command runner, threads and ping of the real system.
+
+     Check scheduler, checks, notifier, reboot and remediation logic use them through the
+     module-level environment object, so that it can be replaced, e.g. by a simulated one
+     (see simulate_meteo_check_status.py).
+  """
+
+  def time(self):
+    return(time.time())
+
+  def monotonic(self):
+    return(time.monotonic())
+
+  def sleep(self, seconds):
+    time.sleep(seconds)
+
+  def wait(self, queue_obj, timeout):
+    """Gets an item from the queue, waiting no longer than timeout seconds (None: no
+       limit). Raises queue.Empty on timeout
+    """
+    return(queue_obj.get(timeout=timeout))
+
+  def get_uptime(self):
+    """Returns system uptime in seconds"""
+    # proc/uptime contains two numbers: the uptime of the system (seconds), and the
+    # amount of time spent in idle process (seconds). We read the first number
+    with open('/proc/uptime', 'r') as f:
+      return(float(f.readline().split()[0]))
+
+  def system(self, command):
+    """Runs a shell command without time limit (see os.system())"""
+    return(os.system(command))
+
+  def call(self, command, timeout):
+    """Runs a shell command and returns its exit code (see subprocess.call())"""
+    return(subprocess.call(command, shell=True, timeout=timeout))
+
+  def run(self, args, input=None, timeout=None, stderr=None):
+    """Runs a program, returns subprocess.CompletedProcess with its output (see
+       subprocess.run()). The program is killed on timeout
+    """
+    return(subprocess.run(args, input=input, stdout=subprocess.PIPE, stderr=stderr,
+      timeout=timeout))
+
+  def start_thread(self, func, args=()):
+    """Runs func in a new daemon thread"""
+    thread = threading.Thread(target=func, args=args)
+    thread.daemon = True
+    thread.start()
+
+  def ping(self, targets, deadline_seconds):
+    """Probes the targets with ping_backend, returns True if any of them responds"""
+    if ping_backend == 'native':
+      return(run_native_probes(targets, deadline_seconds))
+    return(run_ping_subprocesses(targets, deadline_seconds))
+
+environment = SystemEnvironment()
 
 def get_system_uptime():
-  # proc/uptime contains two numbers: the uptime of the system (seconds), and the
-  # amount of time spent in idle process (seconds). We read the first number and
-  # convert it to timedelta, rounding to seconds
-  with open('/proc/uptime', 'r') as f:
-    return(datetime.timedelta(seconds=round(float(f.readline().split()[0]))))
-
-def read_reboot_timeout():
-  reboot_timeout = None
+  # Uptime is rounded to seconds
+  return(datetime.timedelta(seconds=round(environment.get_uptime())))
+
+class Metrics(object):
+  """Thread-safe collection of monitoring metrics, rendered in Prometheus text format.
+
+     Check phase durations are kept as cumulative histograms, so that recording a
+     value costs a few additions under a lock.
+  """
+
+  def __init__(self, duration_buckets):
+    self.lock = threading.Lock()
+    self.duration_buckets = duration_buckets
+    # phase: [bucket counters..., sum, count]
+    self.durations = {}
+    # (phase, result): count
+    self.results = {}
+    # name: [help, type, value]
+    self.values = {}
+
+  def observe(self, phase, duration, success):
+    with self.lock:
+      histogram = self.durations.get(phase)
+      if histogram is None:
+        histogram = self.durations[phase] = [0] * (len(self.duration_buckets) + 2)
+      for bucket_index, bucket in enumerate(self.duration_buckets):
+        if duration <= bucket:
+          histogram[bucket_index] += 1
+      histogram[-2] += duration
+      histogram[-1] += 1
+      result_key = (phase, 'success' if success else 'failure')
+      self.results[result_key] = self.results.get(result_key, 0) + 1
+
+  def set_gauge(self, name, help_text, value):
+    with self.lock:
+      self.values[name] = [help_text, 'gauge', value]
+
+  def increment(self, name, help_text):
+    with self.lock:
+      counter = self.values.setdefault(name, [help_text, 'counter', 0])
+      counter[2] += 1
+
+  def render(self):
+    """Returns metrics in Prometheus text exposition format"""
+    lines = []
+    with self.lock:
+      lines.append('# HELP meteo_check_duration_seconds Duration of check phases')
+      lines.append('# TYPE meteo_check_duration_seconds histogram')
+      for phase in sorted(self.durations):
+        histogram = self.durations[phase]
+        for bucket, count in zip(self.duration_buckets, histogram):
+          lines.append('meteo_check_duration_seconds_bucket{{phase="{0}",le="{1}"}} {2}'.format(
+            phase, bucket, count))
+        lines.append('meteo_check_duration_seconds_bucket{{phase="{0}",le="+Inf"}} {1}'.format(
+          phase, histogram[-1]))
+        lines.append('meteo_check_duration_seconds_sum{{phase="{0}"}} {1}'.format(phase, histogram[-2]))
+        lines.append('meteo_check_duration_seconds_count{{phase="{0}"}} {1}'.format(phase, histogram[-1]))
+      lines.append('# HELP meteo_check_results_total Check phase results')
+      lines.append('# TYPE meteo_check_results_total counter')
+      for (phase, result), count in sorted(self.results.items()):
+        lines.append('meteo_check_results_total{{phase="{0}",result="{1}"}} {2}'.format(
+          phase, result, count))
+      for name, (help_text, metric_type, value) in sorted(self.values.items()):
+        if value is None:
+          continue
+        lines.append('# HELP {0} {1}'.format(name, help_text))
+        lines.append('# TYPE {0} {1}'.format(name, metric_type))
+        lines.append('{0} {1}'.format(name, value))
+    return('\n'.join(lines) + '\n')
+
+metrics = Metrics(metrics_duration_buckets)
+
+def timed_phase(phase):
+  """Decorator, that records function duration and result in metrics.
+
+     The result is a failure if the function returns False or raises an exception.
+  """
+  def decorator(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+      start_time = environment.monotonic()
+      success = False
+      try:
+        result = func(*args, **kwargs)
+        success = result is not False
+        return(result)
+      finally:
+        metrics.observe(phase, environment.monotonic() - start_time, success)
+    return(wrapper)
+  return(decorator)
+
+def update_state_metrics():
+  """Updates gauges, that are computed on demand"""
+  metrics.set_gauge('meteo_system_uptime_seconds', 'System uptime',
+    get_system_uptime().total_seconds())
+  if weewx_db is not None and weewx_db.last_record_time is not None:
+    metrics.set_gauge('meteo_archive_newest_record_age_seconds',
+      'Age of the newest Weewx archive record', int(environment.time()) - weewx_db.last_record_time)
+
+def write_metrics_textfile():
+  """Writes metrics for node_exporter textfile collector (atomically)"""
+  update_state_metrics()
+  temp_file = metrics_textfile + '.tmp'
+  with open(temp_file, 'w') as f:
+    f.write(metrics.render())
+  os.rename(temp_file, metrics_textfile)
+
+async def serve_metrics(reader, writer):
+  """Minimal HTTP handler, that returns metrics for any GET request"""
+  import asyncio
+  try:
+    request_line = await reader.readline()
+    # Skip request headers
+    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+      pass
+    if request_line.startswith(b'GET '):
+      update_state_metrics()
+      body = metrics.render().encode('utf-8')
+      writer.write(b'HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n' +
+        'Content-Length: {0}\r\n\r\n'.format(len(body)).encode('ascii') + body)
+    else:
+      writer.write(b'HTTP/1.0 405 Method Not Allowed\r\nContent-Length: 0\r\n\r\n')
+    await writer.drain()
+  except (OSError, asyncio.IncompleteReadError) as e:
+    logger.debug('Metrics request has failed: {0}'.format(str(e)))
+  finally:
+    writer.close()
+
+def parse_state(text):
+  """Parses data file contents: JSON or legacy ConfigParser format.
+
+     Raises:
+       ValueError: The contents are malformed.
+  """
+  import json
+  if text.lstrip().startswith('{'):
+    state = json.loads(text)
+    if not(isinstance(state, dict)):
+      raise ValueError('State is not a JSON object')
+    return(state)
+  from configparser import ConfigParser
+  config_data = ConfigParser()
+  try:
+    config_data.read_string(text)
+  except Exception as e:
+    raise ValueError(str(e))
+  state = {}
+  if config_data.has_option('meteo_check_status', 'reboot_timeout'):
+    # Stored as integer, as write_reboot_timeout() does
+    reboot_timeout = config_data.get('meteo_check_status', 'reboot_timeout')
+    try:
+      state['reboot_timeout'] = int(reboot_timeout)
+    except ValueError:
+      logger.warning('Invalid reboot timeout "{0}" in legacy data file is ignored'.format(
+        reboot_timeout))
+  if config_data.has_section('weewx_db'):
+    try:
+      state['weewx_db'] = {'db_file': config_data.get('weewx_db', 'db_file'),
+        'file_id': [int(part) for part in config_data.get('weewx_db', 'file_id').split(':')],
+        'last_record_time': int(config_data.get('weewx_db', 'last_record_time')),
+        'last_valid_times': json.loads(config_data.get('weewx_db', 'last_valid_times'))}
+    except Exception:
+      # Incomplete marks are useless, DB check will start over
+      pass
+  return(state)
+
+class StateStore(object):
+  """Persistent script state, kept in a JSON data file.
+
+     The file is rewritten only when the state changes, through a temporary file,
+     fsync() and rename(), so that power loss leaves either old or new version of
+     it. Values, that change on almost every check (last success time, DB
+     high-water marks), are updated lazily: they are written together with the
+     next regular change, by flush() or once per state_lazy_write_interval.
+     Data files in legacy ConfigParser format are converted on the first write.
+  """
+
+  def __init__(self, state_file):
+    self.state_file = state_file
+    self.state = {}
+    # stat() signature of the file version the state has been read from
+    self.signature = None
+    # There are lazy updates, that haven't been written yet
+    self.dirty = False
+    # environment.monotonic() of the last write
+    self.write_time = None
+    self.lock = threading.Lock()
+
+  def get_signature(self):
+    try:
+      file_stat = os.stat(self.state_file)
+    except FileNotFoundError:
+      return(None)
+    return((file_stat.st_ino, file_stat.st_size, file_stat.st_mtime_ns))
+
+  def load(self):
+    """Returns current state, re-reading the file if it has been changed by someone else"""
+    signature = self.get_signature()
+    if signature != self.signature:
+      self.signature = signature
+      self.state = {}
+      self.dirty = False
+      if signature is not None:
+        try:
+          with open(self.state_file, 'r') as f:
+            self.state = parse_state(f.read())
+        except (OSError, ValueError) as e:
+          logger.warning('Error reading data from {0}: {1}'.format(self.state_file, str(e)))
+    return(self.state)
+
+  def get(self, key, default=None):
+    with self.lock:
+      return(self.load().get(key, default))
+
+  def update(self, values, lazy=False):
+    """Sets state values, writing the file only if any of them has changed.
+
+       Values should not be modified by the caller afterwards (pass copies).
+    """
+    with self.lock:
+      state = self.load()
+      if all(key in state and state[key] == value for key, value in values.items()):
+        return
+      state.update(values)
+      if (not(lazy) or self.write_time is None or
+          environment.monotonic() - self.write_time >= state_lazy_write_interval):
+        self.write()
+      else:
+        self.dirty = True
+
+  def flush(self):
+    """Writes lazy updates to the file"""
+    with self.lock:
+      if self.dirty:
+        self.write()
+
+  def write(self):
+    import json
+    temp_file = self.state_file + '.tmp'
+    with open(temp_file, 'w') as f:
+      json.dump(self.state, f, sort_keys=True)
+      f.flush()
+      os.fsync(f.fileno())
+    os.rename(temp_file, self.state_file)
+    # Make the rename itself durable
+    dir_fd = os.open(os.path.dirname(os.path.abspath(self.state_file)), os.O_RDONLY)
+    try:
+      os.fsync(dir_fd)
+    finally:
+      os.close(dir_fd)
+    self.signature = self.get_signature()
+    self.dirty = False
+    self.write_time = environment.monotonic()
+
+def get_state_store(state_file=None):
+  """Returns StateStore object for the data file (module-level data_file by default)"""
+  state_file = state_file or data_file
+  if state_file not in state_stores:
+    state_stores.setdefault(state_file, StateStore(state_file))
+  return(state_stores[state_file])
+
+def flush_state_stores():
+  for state_store in list(state_stores.values()):
+    try:
+      state_store.flush()
+    except OSError as e:
+      logger.warning('Error writing data to {0}: {1}'.format(state_store.state_file, str(e)))
+
+# State functions below use module-level data_file, unless another file
+# (e.g. fleet station's one) is specified
+def read_reboot_timeout(state_file=None):
+  state_store = get_state_store(state_file)
+  reboot_timeout = state_store.get('reboot_timeout')
   try:
-    if os.path.isfile(data_file):
-      config_data = ConfigParser()
-      config_data.read(data_file)
-      if config_data.has_section('meteo_check_status'):
-        if config_data.has_option('meteo_check_status', 'reboot_timeout'):
-          reboot_timeout = int(config_data.get('meteo_check_status', 'reboot_timeout'))
+    if reboot_timeout is not None:
+      reboot_timeout = int(reboot_timeout)
   except Exception as e:
-    logger.warning('Error reading data from {0}: {1}'.format(data_file, str(e)))
+    logger.warning('Error reading data from {0}: {1}'.format(state_store.state_file, str(e)))
+    reboot_timeout = None
   return(reboot_timeout)
 
-def write_reboot_timeout(reboot_timeout):
-  config_data = ConfigParser()
-  config_data.add_section('meteo_check_status')
-  config_data.set('meteo_check_status', 'reboot_timeout', str(reboot_timeout))
-  with open(data_file, "w") as f:
-    config_data.write(f)
+def write_reboot_timeout(reboot_timeout, state_file=None):
+  get_state_store(state_file).update({'reboot_timeout': reboot_timeout})
+  if state_file is None:
+    metrics.set_gauge('meteo_reboot_timeout_minutes', 'Current reboot timeout (backoff level)',
+      reboot_timeout)
+
+def record_check_result(name, result, state_file=None):
+  """Updates consecutive failures count of the check"""
+  state_store = get_state_store(state_file)
+  check_failures = dict(state_store.get('check_failures') or {})
+  check_failures[name] = 0 if result else check_failures.get(name, 0) + 1
+  state_store.update({'check_failures': check_failures})
+
+def read_db_marks(db_file, file_id, state_file=None):
+  """Reads Weewx DB high-water marks, saved by write_db_marks().
+
+     Returns:
+       tuple: (last_record_time, last_valid_times) or (None, {}) if there are
+         no saved marks for this DB file (with the same device and inode).
+  """
+  state_store = get_state_store(state_file)
+  saved_marks = state_store.get('weewx_db')
+  try:
+    if (saved_marks is not None and saved_marks.get('db_file') == db_file and
+        saved_marks.get('file_id') == list(file_id) and
+        saved_marks.get('last_record_time') is not None):
+      return((int(saved_marks['last_record_time']),
+        dict(saved_marks.get('last_valid_times', {}))))
+  except Exception as e:
+    logger.warning('Error reading data from {0}: {1}'.format(state_store.state_file, str(e)))
+  return((None, {}))
+
+def write_db_marks(db_file, file_id, last_record_time, last_valid_times, state_file=None):
+  # Marks change with every new record, so they are written lazily
+  get_state_store(state_file).update({'weewx_db': {'db_file': db_file, 'file_id': list(file_id),
+    'last_record_time': last_record_time, 'last_valid_times': dict(last_valid_times)}},
+    lazy=True)
 
+@timed_phase('ping')
 def do_ping():
   """Pings several targets to check network connectivity.
 
      Fails only if all the targets have failed. Successful ping of even one of the targets
      is considered a success. Lost packets for one target considered as target fail.
+     All the targets are probed simultaneously. The check returns as soon as one of
+     them succeeds (remaining probes are cancelled) or when ping_deadline expires.
+
+     Depending on ping_backend setting probes are done either by built-in probe
+     engine (see run_native_probes()) or by ping subprocesses.
 
      Returns:
        bool: The return value. True for success, False otherwise.
   """
+  ping_result = environment.ping(ping_targets, ping_deadline)
+  if not(ping_result):
+    logger.error('All ping attempts have failed')
+  return(ping_result)
+
+def run_ping_subprocesses(targets, deadline_seconds):
+  """Pings the targets using simultaneously running ping subprocesses.
+
+     Returns:
+       bool: True if at least one of the targets has responded, False otherwise.
+  """
+  # Each waiting thread puts (target, return code, output) tuple here when its
+  # ping process exits
+  ping_results = queue.Queue()
+
+  def wait_for_ping(ping_target, ping_subproc):
+    ping_output = ping_subproc.communicate()[0]
+    ping_results.put((ping_target, ping_subproc.returncode, ping_output))
+
   ping_result = False
-  # We use DNS names instead of IPs for Google and OpenDNS NS to ensure that DNS resolution works
-  for ping_target in ['google-public-dns-a.google.com', 'resolver1.opendns.com', 'ya.ru']:
-    # Create ping subprocess
-    ping_subproc = subprocess.Popen(["ping", "-c {0}".format(ping_count), ping_target],
+  ping_subprocs = []
+  deadline = time.monotonic() + deadline_seconds
+  try:
+    for ping_target in targets:
+      # Create ping subprocess
+      ping_subproc = subprocess.Popen(["ping", "-c {0}".format(ping_count), ping_target],
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+      ping_subprocs.append(ping_subproc)
+      wait_thread = threading.Thread(target=wait_for_ping, args=(ping_target, ping_subproc))
+      wait_thread.daemon = True
+      wait_thread.start()
+
+    for _ in ping_subprocs:
+      try:
+        ping_target, return_code, ping_output = ping_results.get(
+          timeout=max(deadline - time.monotonic(), 0))
+      except queue.Empty:
+        logger.warning('Ping deadline ({0}s) has expired'.format(deadline_seconds))
+        break
+      for ping_output_line in ping_output.splitlines():
+        logger.debug(ping_output_line)
+      logger.debug('{0}: ping return code: {1}'.format(ping_target, return_code))
+      # Check exit code
+      if return_code == 0:
+        ping_result = True
+        break
+      else:
+        logger.warning('{0}: ping attempt has failed'.format(ping_target))
+  finally:
+    # We don't need results of the remaining targets
+    for ping_subproc in ping_subprocs:
+      if ping_subproc.poll() is None:
+        ping_subproc.kill()
+
+  return(ping_result)
+
+def icmp_checksum(data):
+  import struct
+  if len(data) % 2:
+    data += b'\0'
+  checksum = sum(struct.unpack('!{0}H'.format(len(data) // 2), data))
+  checksum = (checksum >> 16) + (checksum & 0xffff)
+  checksum += checksum >> 16
+  return(~checksum & 0xffff)
+
+def build_dns_query(query_id, name):
+  import struct
+  # Header: ID, flags (recursion desired), QDCOUNT=1, ANCOUNT, NSCOUNT, ARCOUNT
+  query = struct.pack('!HHHHHH', query_id, 0x0100, 1, 0, 0, 0)
+  for label in name.rstrip('.').split('.'):
+    query += struct.pack('B', len(label)) + label.encode('ascii')
+  # Root label, QTYPE=A, QCLASS=IN
+  return(query + struct.pack('!BHH', 0, 1, 1))
+
+class Probe(object):
+  """Base class for the built-in connectivity probes.
+
+     resolve() resolves the host name (see ProbeResolver). start() creates
+     a non-blocking file object and returns selector events to wait for.
+     process() is called when any of the events occurs and returns True (target
+     has responded), False (target has failed) or None (keep waiting).
+  """
+
+  def __init__(self, target, host, port=None):
+    self.target = target
+    self.host = host
+    self.port = port
+    self.fileobj = None
+    # getaddrinfo() result: (family, type, proto, canonname, address)
+    self.address_info = None
+
+  def get_socket_type(self):
+    """Returns socket type to resolve the host name for"""
+    import socket
+    return(socket.SOCK_DGRAM)
+
+  def resolve(self):
+    import socket
+    # Name resolution is blocking, but it is also a part of the check: we use
+    # DNS names as targets to ensure that DNS resolution works
+    self.address_info = socket.getaddrinfo(self.host, self.port, 0, self.get_socket_type())[0]
+
+  def close(self):
+    if self.fileobj is not None:
+      self.fileobj.close()
+      self.fileobj = None
+
+class TCPProbe(Probe):
+  """Succeeds if TCP connection to host:port is established"""
+
+  def get_socket_type(self):
+    import socket
+    return(socket.SOCK_STREAM)
+
+  def start(self):
+    import socket
+    import errno
+    import selectors
+    family, socket_type, proto, _, address = self.address_info
+    self.fileobj = socket.socket(family, socket_type, proto)
+    self.fileobj.setblocking(False)
+    error_code = self.fileobj.connect_ex(address)
+    if error_code not in (0, errno.EINPROGRESS):
+      raise socket.error(error_code, os.strerror(error_code))
+    return(selectors.EVENT_WRITE)
+
+  def process(self, events):
+    import socket
+    error_code = self.fileobj.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+    if error_code != 0:
+      logger.debug('{0}: {1}'.format(self.target, os.strerror(error_code)))
+    return(error_code == 0)
+
+class DNSProbe(Probe):
+  """Succeeds if DNS server replies to a query over UDP"""
+
+  def start(self):
+    import socket
+    import random
+    import selectors
+    family, socket_type, proto, _, address = self.address_info
+    self.query_id = random.randint(0, 0xffff)
+    self.fileobj = socket.socket(family, socket_type, proto)
+    self.fileobj.setblocking(False)
+    # Connected UDP socket receives replies from the server only
+    self.fileobj.connect(address)
+    self.fileobj.send(build_dns_query(self.query_id, dns_probe_name))
+    return(selectors.EVENT_READ)
+
+  def process(self, events):
+    import struct
+    reply = self.fileobj.recv(512)
+    if len(reply) < 12:
+      return(None)
+    reply_id, flags = struct.unpack('!HH', reply[:4])
+    # Any reply (even an error one) to our query means that the server is reachable
+    if reply_id != self.query_id or not(flags & 0x8000):
+      return(None)
+    logger.debug('{0}: DNS reply code {1}'.format(self.target, flags & 0x000f))
+    return(True)
+
+class ICMPProbe(Probe):
+  """Succeeds if host replies to ICMP echo request.
+
+     Uses unprivileged ICMP datagram socket, that is allowed only for the groups
+     listed in net.ipv4.ping_group_range sysctl. If the socket can't be created
+     start() raises PermissionError.
+  """
+
+  def start(self):
+    import socket
+    import struct
+    import selectors
+    family, _, _, _, address = self.address_info
+    if family == socket.AF_INET6:
+      proto, echo_request, self.echo_reply = socket.IPPROTO_ICMPV6, 128, 129
+    else:
+      proto, echo_request, self.echo_reply = socket.IPPROTO_ICMP, 8, 0
+    self.fileobj = socket.socket(family, socket.SOCK_DGRAM, proto)
+    self.fileobj.setblocking(False)
+    # Kernel replaces identifier with the socket's port number and filters
+    # replies by it, so we don't need to check it
+    for sequence in range(1, ping_count + 1):
+      packet = struct.pack('!BBHHH', echo_request, 0, 0, 0, sequence) + b'meteo_check_status'
+      packet = packet[:2] + struct.pack('!H', icmp_checksum(packet)) + packet[4:]
+      self.fileobj.sendto(packet, address)
+    return(selectors.EVENT_READ)
+
+  def process(self, events):
+    import struct
+    reply = self.fileobj.recv(1024)
+    if len(reply) >= 8 and struct.unpack('!B', reply[:1])[0] == self.echo_reply:
+      return(True)
+    return(None)
+
+class PingSubprocessProbe(Probe):
+  """Fallback for ICMPProbe: runs ping subprocess and waits for its output to end"""
+
+  def start(self):
+    import selectors
+    self.ping_subproc = subprocess.Popen(["ping", "-c {0}".format(ping_count), self.host],
       stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    # Wait for exit and get output
-    for ping_output_line in ping_subproc.communicate()[0].splitlines():
+    self.fileobj = self.ping_subproc.stdout
+    self.ping_output = b''
+    return(selectors.EVENT_READ)
+
+  def process(self, events):
+    output = os.read(self.fileobj.fileno(), 4096)
+    if output:
+      self.ping_output += output
+      return(None)
+    for ping_output_line in self.ping_output.splitlines():
       logger.debug(ping_output_line)
-    logger.debug('ping return code: {0}'.format(ping_subproc.returncode))
-    # Check exit code
-    if ping_subproc.returncode == 0:
-      ping_result = True
-    else:
-      logger.warning('{0}: ping attempt has failed'.format(ping_target))
+    return(self.ping_subproc.wait() == 0)
 
-  if not(ping_result):
-    logger.error('All ping attempts have failed')
-  return(ping_result)
+  def close(self):
+    if self.fileobj is not None and self.ping_subproc.poll() is None:
+      self.ping_subproc.kill()
+      self.ping_subproc.wait()
+    super(PingSubprocessProbe, self).close()
 
-def do_check_db():
-  """Checks wind records presence in the Weewx DB.
+def create_probe(target):
+  """Creates a probe object for the target.
+
+     Target formats: "tcp:HOST:PORT", "dns:SERVER[:PORT]", "icmp:HOST" or just "HOST"
+     (same as "icmp:HOST").
+  """
+  probe_type, _, address = target.partition(':')
+  if probe_type == 'tcp':
+    host, _, port = address.rpartition(':')
+    return(TCPProbe(target, host, int(port)))
+  if probe_type == 'dns':
+    host, _, port = address.partition(':')
+    return(DNSProbe(target, host, int(port) if port else 53))
+  if probe_type == 'icmp':
+    return(ICMPProbe(target, address))
+  return(ICMPProbe(target, target))
+
+class ProbeResolver(object):
+  """Resolves host names of the probes in background threads.
+
+     getaddrinfo() is blocking and its DNS timeouts may be long, so each probe
+     is resolved in its own daemon thread, and the probes don't wait for each
+     other. Resolved probes are queued and the selector loop is woken up through
+     a pipe. Threads, that finish after close(), are ignored.
+  """
+
+  def __init__(self):
+    self.resolved = queue.Queue()
+    self.lock = threading.Lock()
+    self.wakeup_fd, self.notify_fd = os.pipe()
+    os.set_blocking(self.wakeup_fd, False)
+
+  def resolve(self, probe):
+    thread = threading.Thread(target=self.run, args=(probe,), name='resolver')
+    thread.daemon = True
+    thread.start()
+
+  def run(self, probe):
+    try:
+      probe.resolve()
+      error = None
+    except (OSError, UnicodeError) as e:
+      error = e
+    with self.lock:
+      if self.notify_fd is None:
+        return
+      self.resolved.put((probe, error))
+      os.write(self.notify_fd, b'\0')
 
-     Returns True if there is at least one valid (non-NULL) wind record with
-     timestamp within specified amount of time (no_db_records_threshold).
+  def get_resolved(self):
+    """Returns a list of (probe, resolution error or None) tuples"""
+    try:
+      os.read(self.wakeup_fd, 4096)
+    except BlockingIOError:
+      pass
+    resolved = []
+    while not(self.resolved.empty()):
+      resolved.append(self.resolved.get_nowait())
+    return(resolved)
+
+  def close(self):
+    with self.lock:
+      os.close(self.notify_fd)
+      self.notify_fd = None
+    os.close(self.wakeup_fd)
+
+def start_probe(probe):
+  """Starts the resolved probe.
 
      Returns:
-       bool: The return value. True for success, False otherwise.
+       tuple: (probe, selector events), probe is None if it has failed to start.
+  """
+  try:
+    try:
+      return(probe, probe.start())
+    except PermissionError:
+      logger.debug('{0}: ICMP socket is not permitted, using ping subprocess'.format(probe.target))
+      probe.close()
+      probe = PingSubprocessProbe(probe.target, probe.host)
+      return(probe, probe.start())
+  except (OSError, UnicodeError) as e:
+    logger.warning('{0}: probe has failed: {1}'.format(probe.target, str(e)))
+    probe.close()
+    return(None, None)
+
+def run_native_probes(targets, deadline_seconds):
+  """Probes the targets in-process using non-blocking sockets.
+
+     Host names are resolved concurrently (see ProbeResolver) and each probe
+     starts as soon as its own name is resolved, so slow DNS replies count
+     against the deadline instead of adding up. If unprivileged ICMP sockets are
+     not allowed, ICMP targets are pinged using ping subprocess instead.
+
+     Returns:
+       bool: True if at least one of the targets has responded, False otherwise.
+  """
+  import selectors
+  probe_result = False
+  probes = []
+  deadline = time.monotonic() + deadline_seconds
+  selector = selectors.DefaultSelector()
+  resolver = ProbeResolver()
+  try:
+    selector.register(resolver.wakeup_fd, selectors.EVENT_READ, None)
+    for target in targets:
+      resolver.resolve(create_probe(target))
+
+    pending_probes = len(targets)
+    while pending_probes and not(probe_result):
+      timeout = deadline - time.monotonic()
+      if timeout <= 0:
+        logger.warning('Ping deadline ({0}s) has expired'.format(deadline_seconds))
+        break
+      for key, events in selector.select(timeout):
+        if key.data is None:
+          for probe, error in resolver.get_resolved():
+            if error is None:
+              probe, events = start_probe(probe)
+            else:
+              logger.warning('{0}: probe has failed: {1}'.format(probe.target, str(error)))
+              probe = None
+            if probe is None:
+              pending_probes -= 1
+            else:
+              probes.append(probe)
+              selector.register(probe.fileobj, events, probe)
+          continue
+        probe = key.data
+        try:
+          result = probe.process(events)
+        except OSError as e:
+          logger.debug('{0}: {1}'.format(probe.target, str(e)))
+          result = False
+        if result is None:
+          continue
+        selector.unregister(probe.fileobj)
+        probe.close()
+        pending_probes -= 1
+        if result:
+          logger.debug('{0}: probe has succeeded'.format(probe.target))
+          probe_result = True
+          break
+        else:
+          logger.warning('{0}: ping attempt has failed'.format(probe.target))
+  finally:
+    for probe in probes:
+      probe.close()
+    selector.close()
+    resolver.close()
+  return(probe_result)
+
+class DBChangeWatcher(object):
+  """Detects changes of the Weewx DB file and its -wal and -journal files.
+
+     changed() compares inode numbers, sizes and modification times of the files
+     with the ones seen on the previous call, which costs three stat() calls.
+     Optionally an inotify watch on the DB directory can be created with
+     start_inotify(), so that the event loop is woken up as soon as Weewx writes
+     to the DB.
+  """
+
+  # inotify event masks (see inotify(7))
+  IN_MODIFY = 0x00000002
+  IN_CLOSE_WRITE = 0x00000008
+  IN_MOVED_TO = 0x00000080
+  IN_CREATE = 0x00000100
+  IN_DELETE = 0x00000200
+
+  def __init__(self, db_file):
+    self.paths = [db_file, db_file + '-wal', db_file + '-journal']
+    self.file_names = set(os.path.basename(path) for path in self.paths)
+    self.signature = None
+    self.inotify_fd = None
+    # struct inotify_event header: wd, mask, cookie, len
+    self.inotify_event_header = None
+
+  def get_signature(self):
+    signature = []
+    for path in self.paths:
+      try:
+        file_stat = os.stat(path)
+        signature.append((file_stat.st_ino, file_stat.st_size, file_stat.st_mtime_ns))
+      except OSError:
+        signature.append(None)
+    return(tuple(signature))
+
+  def changed(self):
+    """Returns True if the DB files have changed since the previous call"""
+    signature = self.get_signature()
+    changed = signature != self.signature
+    self.signature = signature
+    return(changed)
+
+  def start_inotify(self):
+    """Creates non-blocking inotify descriptor, watching the DB directory.
+
+       Returns:
+         int: inotify file descriptor or None if inotify is not available.
+    """
+    import ctypes
+    import struct
+    try:
+      # Symbols of the running python binary include libc ones. This is much
+      # faster than ctypes.util.find_library(), that runs ldconfig
+      libc = ctypes.CDLL(None, use_errno=True)
+      inotify_fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+      if inotify_fd < 0:
+        raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+      # -wal and -journal files are created and deleted by SQLite, so we watch
+      # the whole directory
+      watch_descriptor = libc.inotify_add_watch(inotify_fd,
+        os.fsencode(os.path.dirname(os.path.abspath(self.paths[0]))),
+        self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE | self.IN_DELETE)
+      if watch_descriptor < 0:
+        error_code = ctypes.get_errno()
+        os.close(inotify_fd)
+        raise OSError(error_code, os.strerror(error_code))
+    except (OSError, AttributeError) as e:
+      logger.info('inotify is not available ({0}), falling back to polling'.format(str(e)))
+      return(None)
+    self.inotify_fd = inotify_fd
+    self.inotify_event_header = struct.Struct('iIII')
+    return(inotify_fd)
+
+  def read_inotify_events(self):
+    """Reads pending inotify events.
+
+       Returns:
+         bool: True if any of the events is related to the DB files.
+    """
+    db_files_changed = False
+    while True:
+      try:
+        events_data = os.read(self.inotify_fd, 4096)
+      except BlockingIOError:
+        break
+      offset = 0
+      while offset < len(events_data):
+        _, _, _, name_length = self.inotify_event_header.unpack_from(events_data, offset)
+        offset += self.inotify_event_header.size
+        file_name = os.fsdecode(events_data[offset:offset + name_length].rstrip(b'\0'))
+        offset += name_length
+        if file_name in self.file_names:
+          db_files_changed = True
+    return(db_files_changed)
+
+  def close(self):
+    if self.inotify_fd is not None:
+      os.close(self.inotify_fd)
+      self.inotify_fd = None
+
+def is_wal_db(db_file):
+  """Returns True if the DB file is in WAL mode (see "Database File Format" in
+     SQLite documentation: file format version numbers at offset 18 are 2 for WAL)
+  """
+  with open(db_file, 'rb') as f:
+    header = f.read(20)
+  return(len(header) == 20 and header[18] == 2 and header[19] == 2)
+
+def use_db_snapshot(db_file, read_mode):
+  """Returns True if the DB file should be read from a snapshot in read_mode (see
+     db_read_mode)
+  """
+  return(read_mode == 'snapshot' or (read_mode == 'auto' and not(is_wal_db(db_file))))
+
+class DBSnapshot(object):
+  """Copy of the Weewx DB, made with SQLite online backup API (python 3.7+).
+
+     With the default rollback journal a reading transaction and a Weewx write
+     block each other. The backup copies db_snapshot_pages pages per step and
+     holds a shared lock on the DB only during a step, pausing between steps,
+     so that Weewx is never kept waiting for long. If Weewx writes to the DB in
+     the middle of the backup, SQLite restarts it. The copy is updated in a
+     single transaction, so readers of the snapshot file always see a consistent
+     state, and only if the DB files have changed since the previous refresh.
+
+     The whole DB is copied (a year of 1-minute records takes about 100 MB and
+     more than a second), so it is used for the report only. Checks use
+     RecentDBSnapshot.
+  """
+
+  def __init__(self, db_file, snapshot_dir):
+    self.db_file = db_file
+    self.snapshot_file = os.path.join(snapshot_dir, 'meteo_check_status-{0}-{1}'.format(
+      re.sub(r'[^A-Za-z0-9.]+', '_', os.path.abspath(db_file).strip('/')), self.get_name_suffix()))
+    self.watcher = DBChangeWatcher(db_file)
+
+  def get_name_suffix(self):
+    # Each report process has its own copy, so that neither other reports nor
+    # the daemon overwrite or remove it
+    return('report{0}'.format(os.getpid()))
+
+  def refresh(self):
+    """Copies the DB to the snapshot file if the DB has changed.
+
+       Returns:
+         bool: True if the snapshot has been updated.
+    """
+    if not(self.watcher.changed()) and os.path.isfile(self.snapshot_file):
+      return(False)
+    import urllib.parse
+    start_time = environment.monotonic()
+    steps = [0]
+    def on_progress(status, remaining, total):
+      steps[0] += 1
+      if remaining:
+        environment.sleep(db_snapshot_step_pause)
+    db_uri = 'file:{0}?mode=ro'.format(urllib.parse.quote(os.path.abspath(self.db_file)))
+    with contextlib.closing(sqlite3.connect(db_uri, uri=True)) as source_conn, \
+        contextlib.closing(sqlite3.connect(self.snapshot_file)) as snapshot_conn:
+      source_conn.backup(snapshot_conn, pages=db_snapshot_pages, progress=on_progress)
+    logger.debug('Weewx DB snapshot {0} has been updated in {1} steps ({2:.3f}s)'.format(
+      self.snapshot_file, steps[0], environment.monotonic() - start_time))
+    return(True)
+
+  def remove(self):
+    for path in (self.snapshot_file, self.snapshot_file + '-journal'):
+      with contextlib.suppress(FileNotFoundError):
+        os.remove(path)
+    self.watcher.signature = None
+
+class RecentDBSnapshot(DBSnapshot):
+  """Copy of the recent records of the Weewx DB archive table.
+
+     Checks read only the records, added since the previous check (see WeewxDB),
+     so instead of copying the whole DB on each change the snapshot copies the
+     records, that are newer than its newest one, and drops the ones older than
+     db_snapshot_window. The cost of a refresh and the size of the snapshot don't
+     depend on the DB size. The DB is attached read-only, and a refresh is a single
+     short transaction: a primary key range read of the DB and a write of the
+     snapshot, so readers of the snapshot always see a consistent state. Records,
+     changed in place after they have been copied, are not updated.
+  """
+
+  def get_name_suffix(self):
+    return('recent')
+
+  def refresh(self):
+    """Copies new records to the snapshot file if the DB has changed.
+
+       Returns:
+         bool: True if the snapshot has been updated.
+    """
+    if not(self.watcher.changed()) and os.path.isfile(self.snapshot_file):
+      return(False)
+    import urllib.parse
+    start_time = environment.monotonic()
+    snapshot_uri = 'file:{0}'.format(urllib.parse.quote(os.path.abspath(self.snapshot_file)))
+    db_uri = 'file:{0}?mode=ro'.format(urllib.parse.quote(os.path.abspath(self.db_file)))
+    # Transactions are managed explicitly, so that schema changes are a part of them
+    with contextlib.closing(sqlite3.connect(snapshot_uri, uri=True,
+        isolation_level=None)) as conn:
+      conn.execute('ATTACH DATABASE ? AS weewx', (db_uri,))
+      conn.execute('BEGIN')
+      try:
+        schema_query = 'SELECT sql FROM {0}.sqlite_master WHERE type = "table" AND name = "archive"'
+        db_schema = conn.execute(schema_query.format('weewx')).fetchone()
+        if db_schema is None:
+          raise sqlite3.OperationalError('no such table: archive')
+        # Weewx DB may have been rebuilt with different columns
+        if conn.execute(schema_query.format('main')).fetchone() != db_schema:
+          conn.execute('DROP TABLE IF EXISTS main.archive')
+          conn.execute(db_schema[0])
+        last_record_time = conn.execute('SELECT max(dateTime) FROM main.archive').fetchone()[0]
+        if last_record_time is None:
+          last_record_time = conn.execute('SELECT max(dateTime) FROM weewx.archive').fetchone()[0]
+          last_record_time = -1 if last_record_time is None else \
+            last_record_time - db_snapshot_window * 60 - 1
+        added = conn.execute('INSERT INTO main.archive SELECT * FROM weewx.archive ' \
+          'WHERE dateTime > ?', (last_record_time,)).rowcount
+        conn.execute('DELETE FROM main.archive WHERE dateTime < ' \
+          '(SELECT max(dateTime) FROM main.archive) - ?', (db_snapshot_window * 60,))
+        conn.execute('COMMIT')
+      except:
+        conn.execute('ROLLBACK')
+        raise
+    logger.debug('Weewx DB snapshot {0} has been updated with {1} records ({2:.3f}s)'.format(
+      self.snapshot_file, added, environment.monotonic() - start_time))
+    return(True)
+
+class WindWindow(object):
+  """Rolling window of the recent wind records with streaming statistics.
+
+     Records are kept in array-backed ring buffers (NaN stands for NULL) and sums,
+     counts and the current run of identical speed values are updated as records
+     are added and evicted. The window is topped up with records, added since the
+     previous update, so anomaly detection doesn't re-read history from the DB.
   """
-  logger.debug('Querying Weewx DB file {0}'.format(weewx_db_file))
-  if not(os.path.isfile(weewx_db_file)):
-    logger.error('Weewx DB file {0} does not exist'.format(weewx_db_file))
-    return(False)
 
-  with sqlite3.connect(weewx_db_file) as conn:
+  def __init__(self, size):
+    import array
+    self.size = size
+    self.times = array.array('d', [0.0]) * size
+    self.speeds = array.array('d', [math.nan]) * size
+    self.gusts = array.array('d', [math.nan]) * size
+    # Index of the oldest record and number of records
+    self.start = 0
+    self.count = 0
+    self.last_time = None
+    # Statistics over non-NULL speed values in the window
+    self.speed_count = 0
+    self.speed_sum = 0.0
+    self.speed_sum_squares = 0.0
+    self.gust_violations = 0
+    # Current run of identical speed values (NULL values don't break it)
+    self.run_value = None
+    self.run_start_time = None
+    self.run_end_time = None
+
+  def update_stats(self, speed, gust, sign):
+    if not(math.isnan(speed)):
+      self.speed_count += sign
+      self.speed_sum += sign * speed
+      self.speed_sum_squares += sign * speed * speed
+      if not(math.isnan(gust)) and gust < speed:
+        self.gust_violations += sign
+
+  def add_record(self, record_time, speed, gust):
+    speed = math.nan if speed is None else float(speed)
+    gust = math.nan if gust is None else float(gust)
+    if self.count == self.size:
+      # Evict the oldest record
+      self.update_stats(self.speeds[self.start], self.gusts[self.start], -1)
+      self.start = (self.start + 1) % self.size
+      self.count -= 1
+    index = (self.start + self.count) % self.size
+    self.times[index] = record_time
+    self.speeds[index] = speed
+    self.gusts[index] = gust
+    self.count += 1
+    self.last_time = record_time
+    self.update_stats(speed, gust, 1)
+    if not(math.isnan(speed)):
+      if speed != self.run_value:
+        self.run_value = speed
+        self.run_start_time = record_time
+      self.run_end_time = record_time
+
+  def update(self, conn, since_time, has_gust=True):
+    """Adds records, that are newer than the last one in the window (or since_time)"""
+    query = 'SELECT dateTime, `{0}`, {1} FROM archive WHERE dateTime > ? ' \
+      'ORDER BY dateTime DESC LIMIT ?'.format(wind_speed_column,
+        '`{0}`'.format(wind_gust_column) if has_gust else 'NULL')
     with contextlib.closing(conn.cursor()) as cursor:
-      wind_records = cursor.execute(
-        'SELECT windSpeed, datetime(dateTime, "unixepoch", "localtime") AS dt, ' \
-        'dateTime FROM archive WHERE dt >= datetime("now", "-{0} Minute", "localtime") ' \
-        'ORDER BY dt DESC'.format(no_db_records_threshold)).fetchall()
+      records = cursor.execute(query, (self.last_time if self.last_time is not None else since_time,
+        self.size)).fetchall()
+    for record in reversed(records):
+      self.add_record(*record)
 
-      if len(wind_records) == 0:
-        logger.error('No records in the Weewx DB file for the last {0}min'.format(no_db_records_threshold))
+  def get_variance(self):
+    if self.speed_count < 2:
+      return(None)
+    mean = self.speed_sum / self.speed_count
+    # Rounding errors can make it slightly negative
+    return(max(0.0, self.speed_sum_squares / self.speed_count - mean * mean))
+
+  def get_anomalies(self):
+    """Returns list of detected anomaly descriptions"""
+    anomalies = []
+    if self.run_value is not None:
+      run_minutes = int((self.run_end_time - self.run_start_time) // 60)
+      if run_minutes >= (wind_calm_stuck_minutes if self.run_value == 0 else wind_stuck_minutes):
+        anomalies.append('wind speed has been stuck at {0:g} for {1}min'.format(self.run_value,
+          run_minutes))
+    variance = self.get_variance()
+    if (not(anomalies) and variance is not None and self.speed_count >= self.size // 2 and
+        self.speed_sum / self.speed_count > wind_min_mean and variance < wind_min_variance):
+      anomalies.append('wind speed variance has collapsed to {0:.4f} over the last {1} ' \
+        'records'.format(variance, self.speed_count))
+    if self.gust_violations >= wind_max_gust_violations:
+      anomalies.append('wind gust is less than speed in {0} of the last {1} records'.format(
+        self.gust_violations, self.count))
+    return(anomalies)
+
+class DataRule(object):
+  """Freshness and validity rule for an archive table column.
+
+     The rule passes if the column had a valid value (non-NULL and within
+     [min_value, max_value] range, if the limits are set) within the last
+     max_age minutes (no_db_records_threshold if not set).
+  """
+
+  def __init__(self, name, column, max_age=None, min_value=None, max_value=None):
+    self.name = name
+    self.column = column
+    self.max_age = max_age
+    self.min_value = min_value
+    self.max_value = max_value
+
+  @classmethod
+  def parse(cls, rule_spec):
+    """Creates a rule from "[NAME=]COLUMN[:MINUTES[:MIN:MAX]]" string.
+
+       Empty values mean no limit, e.g. "outTemp:30:-50:60", "rain:60", "barometer::900:".
+       Column name is used as the rule name if the latter is omitted.
+    """
+    name, _, rule_params = rule_spec.rpartition('=')
+    column, max_age, min_value, max_value = (rule_params.split(':') + [''] * 3)[:4]
+    if not(re.match(r'^[A-Za-z_][A-Za-z0-9_]*$', column)):
+      raise ValueError('Invalid column name in data rule "{0}"'.format(rule_spec))
+    return(cls(name or column, column, int(max_age) if max_age else None,
+      float(min_value) if min_value else None, float(max_value) if max_value else None))
+
+  @property
+  def key(self):
+    """Identifies saved high-water mark of the rule (doesn't depend on max_age)"""
+    return('{0}:{1}:{2}'.format(self.column, self.min_value, self.max_value))
+
+  def get_max_age(self):
+    return(no_db_records_threshold if self.max_age is None else self.max_age)
+
+  def sql_condition(self):
+    """Returns SQL condition for a valid value and its parameters"""
+    condition = '"{0}" IS NOT NULL'.format(self.column)
+    params = []
+    if self.min_value is not None:
+      condition += ' AND "{0}" >= ?'.format(self.column)
+      params.append(self.min_value)
+    if self.max_value is not None:
+      condition += ' AND "{0}" <= ?'.format(self.column)
+      params.append(self.max_value)
+    return((condition, params))
+
+def build_new_records_query(rules):
+  """Builds a query for the records, added after the given time.
+
+     The query returns the newest record time followed by the newest valid value
+     time for each rule, so all the rules are evaluated in one pass. It filters on
+     raw dateTime value so that SQLite can use the primary key index instead of
+     scanning the whole archive table.
+
+     Returns:
+       tuple: Query text and parameters (except for the last one, which is the time).
+  """
+  columns = ['max(dateTime)']
+  params = []
+  for rule in rules:
+    condition, condition_params = rule.sql_condition()
+    columns.append('max(CASE WHEN {0} THEN dateTime END)'.format(condition))
+    params.extend(condition_params)
+  return(('SELECT {0} FROM archive WHERE dateTime > ?'.format(', '.join(columns)), params))
+
+class WeewxDB(object):
+  """Long-lived read-only connection to the Weewx DB.
+
+     The DB is opened once in read-only mode, so the monitor never takes a write
+     lock on the Weewx database, and compiled statements are reused between
+     checks. The connection is transparently reopened if the DB file is replaced
+     (its device or inode number changes), e.g. after restoring it from a backup.
+
+     Instead of re-reading recent records on each check the object keeps track
+     of the newest record time and the newest valid value time for each data rule
+     (high-water marks) and reads only the records added since the previous check.
+     The marks are saved to the data file, so that they survive restarts.
+
+     If watch parameter is True, the archive table is queried only if the DB
+     files have changed since the previous check (see DBChangeWatcher).
+     read_mode selects between querying the DB file and its snapshot (see
+     db_read_mode). state_file overrides module-level data_file for the marks.
+  """
+
+  def __init__(self, db_file, rules, watch=False, state_file=None, read_mode='direct'):
+    self.db_file = db_file
+    self.rules = rules
+    self.state_file = state_file
+    self.watcher = DBChangeWatcher(db_file) if watch else None
+    self.read_mode = read_mode
+    self.snapshot = None
+    self.conn = None
+    self.file_id = None
+    # Identity of the snapshot file, the connection reads
+    self.snapshot_file_id = None
+    # DB file identity the marks belong to
+    self.marks_file_id = None
+    self.last_record_time = None
+    # Rule key: the newest valid value time
+    self.last_valid_times = {}
+    self.query = None
+    self.query_params = None
+    # Rule specifications the rules have been parsed from (see get_weewx_db())
+    self.rule_specs = None
+    self.archive_columns = None
+    self.wind_window = None
+    # Serializes checks (see check()), reentrant as a failed check closes the DB
+    self.lock = threading.RLock()
+
+  def close(self):
+    with self.lock:
+      if self.conn is not None:
+        self.conn.close()
+      self.conn = None
+      self.file_id = None
+      self.snapshot_file_id = None
+      if self.snapshot is not None:
+        self.snapshot.remove()
+        self.snapshot = None
+      # Make sure the DB is queried after reopening
+      if self.watcher is not None:
+        self.watcher.signature = None
+
+  def get_connection(self):
+    """Returns an open connection to the DB file.
+
+       The connection is reopened if the DB file or its snapshot file has been
+       replaced or removed.
+
+       Raises:
+         OSError: DB file does not exist or is not accessible.
+    """
+    file_stat = os.stat(self.db_file)
+    file_id = (file_stat.st_dev, file_stat.st_ino)
+    snapshot_replaced = self.snapshot is not None and \
+      self.get_snapshot_file_id() != self.snapshot_file_id
+    if self.conn is None or file_id != self.file_id or snapshot_replaced:
+      if self.conn is not None:
+        if file_id != self.file_id:
+          logger.info('Weewx DB file {0} has been replaced, reopening it'.format(self.db_file))
+        else:
+          logger.warning('Weewx DB snapshot {0} has been replaced or removed, ' \
+            're-creating it'.format(self.snapshot.snapshot_file))
+      self.close()
+      read_file = self.db_file
+      if use_db_snapshot(self.db_file, self.read_mode):
+        self.snapshot = RecentDBSnapshot(self.db_file, db_snapshot_dir)
+        self.snapshot.refresh()
+        read_file = self.snapshot.snapshot_file
+      logger.debug('Reading Weewx DB file {0} {1}'.format(self.db_file,
+        'directly' if self.snapshot is None else 'from snapshot {0}'.format(read_file)))
+      import urllib.parse
+      db_uri = 'file:{0}?mode=ro'.format(urllib.parse.quote(os.path.abspath(read_file)))
+      # The scheduler runs each check in a new thread. Checks are serialized
+      # with self.lock (see check()), so sharing the connection is safe
+      self.conn = sqlite3.connect(db_uri, uri=True, cached_statements=db_cached_statements,
+        check_same_thread=False)
+      self.file_id = file_id
+      if self.snapshot is not None:
+        self.snapshot_file_id = self.get_snapshot_file_id()
+      if file_id != self.marks_file_id:
+        self.marks_file_id = file_id
+        self.last_record_time, self.last_valid_times = read_db_marks(self.db_file, file_id,
+          self.state_file)
+        if wind_anomaly_action != 'off':
+          self.wind_window = WindWindow(wind_window_size)
+        # Saved marks can't be used for the rules, that have been added since,
+        # so we start over
+        if any(rule.key not in self.last_valid_times for rule in self.rules):
+          self.last_record_time, self.last_valid_times = None, {}
+    return(self.conn)
+
+  def get_snapshot_file_id(self):
+    try:
+      file_stat = os.stat(self.snapshot.snapshot_file)
+    except FileNotFoundError:
+      return(None)
+    return((file_stat.st_dev, file_stat.st_ino))
+
+  def get_query(self, conn):
+    if self.query is None:
+      archive_columns = set(column_info[1] for column_info in
+        conn.execute('PRAGMA table_info(archive)'))
+      self.archive_columns = archive_columns
+      for rule in self.rules:
+        if rule.column not in archive_columns:
+          raise ValueError('Data rule "{0}": there is no column "{1}" in the archive table'.format(
+            rule.name, rule.column))
+      self.query, self.query_params = build_new_records_query(self.rules)
+    return(self.query)
+
+  def update_marks(self):
+    """Reads records, added since the previous call, and updates high-water marks"""
+    conn = self.get_connection()
+    if self.watcher is not None and not(self.watcher.changed()):
+      logger.debug('Weewx DB files have not changed since the previous check')
+      return
+    if self.last_record_time is None:
+      # No marks yet, look through recent records only
+      since_time = int(environment.time()) - db_initial_lookback * 60
+    else:
+      since_time = self.last_record_time
+    try:
+      if self.snapshot is not None:
+        self.snapshot.refresh()
+      with contextlib.closing(conn.cursor()) as cursor:
+        new_marks = cursor.execute(self.get_query(conn),
+          self.query_params + [since_time]).fetchone()
+      if self.wind_window is not None:
+        if wind_speed_column not in self.archive_columns:
+          logger.warning('There is no column "{0}" in the archive table, wind anomaly ' \
+            'detection is disabled'.format(wind_speed_column))
+          self.wind_window = None
+        else:
+          self.wind_window.update(conn, since_time, wind_gust_column in self.archive_columns)
+    except sqlite3.Error:
+      # Start over with a fresh connection next time
+      self.close()
+      raise
+    logger.debug('New records since {0}: {1}'.format(since_time, new_marks))
+
+    if new_marks[0] is not None:
+      self.last_record_time = new_marks[0]
+      for rule, last_valid_time in zip(self.rules, new_marks[1:]):
+        if last_valid_time is not None:
+          self.last_valid_times[rule.key] = last_valid_time
+      write_db_marks(self.db_file, self.marks_file_id, self.last_record_time,
+        self.last_valid_times, self.state_file)
+
+  def get_expiry_time(self):
+    """Returns the time, when current data becomes stale unless new records arrive.
+
+       Returns None if the data is already missing.
+    """
+    if self.last_record_time is None or any(rule.key not in self.last_valid_times
+        for rule in self.rules):
+      return(None)
+    # Data is considered stale one second after reaching maximum age
+    return(min([self.last_record_time + no_db_records_threshold * 60] +
+      [self.last_valid_times[rule.key] + rule.get_max_age() * 60 for rule in self.rules]) + 1)
+
+  def evaluate_rules(self, now):
+    """Returns a report: list of (rule, last valid value time, passed) tuples"""
+    report = []
+    for rule in self.rules:
+      last_valid_time = self.last_valid_times.get(rule.key)
+      passed = last_valid_time is not None and last_valid_time >= now - rule.get_max_age() * 60
+      report.append((rule, last_valid_time, passed))
+    return(report)
+
+  def check(self):
+    """Checks records presence in the Weewx DB and evaluates data rules.
+
+       Returns True if there are records and all data rules pass, e.g. for the
+       default rule there is at least one valid (non-NULL) wind record with
+       timestamp within specified amount of time (no_db_records_threshold).
+
+       Returns:
+         bool: The return value. True for success, False otherwise.
+    """
+    # Scheduled DB checks and re-checks, made while processing results
+    # (see confirm_failure() and verify_recovery()), run in different threads
+    # and may overlap, but they share the connection and the marks
+    with self.lock:
+      logger.debug('Querying Weewx DB file {0}'.format(self.db_file))
+      try:
+        self.update_marks()
+      except OSError:
+        logger.error('Weewx DB file {0} does not exist'.format(self.db_file))
+        self.close()
         return(False)
 
-      has_wind_speed = False
-      for wind_record in wind_records:
-        logger.debug(wind_record)
-        if wind_record[0] != None:
-          has_wind_speed = True
-          break
-      if not(has_wind_speed):
-        logger.error('No wind data for the last {0}min in the Weewx DB file'.format(no_db_records_threshold))
+      # dateTime is stored as a unix timestamp, so comparing it with the epoch
+      # threshold gives the same result as comparing local time strings (except for
+      # DST transitions, where the epoch comparison is actually the correct one)
+      now = int(environment.time())
+      if self.last_record_time is None or self.last_record_time < now - no_db_records_threshold * 60:
+        log_data_age('Last record', self.last_record_time, now)
+        logger.error('No records in the Weewx DB file for the last {0}min'.format(no_db_records_threshold))
         return(False)
 
-  return(True)
+      check_result = True
+      for rule, last_valid_time, passed in self.evaluate_rules(now):
+        if passed:
+          logger.debug('Data rule "{0}": Ok, last valid value time: {1}'.format(rule.name, last_valid_time))
+        else:
+          log_data_age('Last {0} data record'.format(rule.name), last_valid_time, now)
+          logger.error('No {0} data for the last {1}min in the Weewx DB file'.format(
+            rule.name, rule.get_max_age()))
+          check_result = False
+
+      if self.wind_window is not None:
+        for anomaly in self.wind_window.get_anomalies():
+          if wind_anomaly_action == 'fail':
+            logger.error('Wind data anomaly: {0}'.format(anomaly))
+            check_result = False
+          else:
+            logger.warning('Wind data anomaly: {0}'.format(anomaly))
+
+      return(check_result)
+
+def log_data_age(description, record_time, now):
+  if record_time is None:
+    logger.warning('{0}: more than {1}min ago'.format(description, db_initial_lookback))
+  else:
+    logger.warning('{0}: {1} ({2} ago)'.format(description,
+      datetime.datetime.fromtimestamp(record_time),
+      datetime.timedelta(seconds=now - record_time)))
+
+def get_weewx_db():
+  """Returns WeewxDB object for the current weewx_db_file, reusing existing one"""
+  global weewx_db
+  if (weewx_db is None or weewx_db.db_file != weewx_db_file or
+      weewx_db.rule_specs is not data_rules or (weewx_db.watcher is not None) != db_watch or
+      weewx_db.read_mode != db_read_mode):
+    if weewx_db is not None:
+      weewx_db.close()
+    weewx_db = WeewxDB(weewx_db_file, [DataRule.parse(rule_spec) for rule_spec in data_rules],
+      watch=db_watch, read_mode=db_read_mode)
+    weewx_db.rule_specs = data_rules
+  return(weewx_db)
+
+@timed_phase('check_db')
+def do_check_db():
+  """Checks wind records presence in the Weewx DB (see WeewxDB.check()).
+
+     Returns:
+       bool: The return value. True for success, False otherwise.
+  """
+  return(get_weewx_db().check())
 
-def send_mail_to_root():
-  logger.debug('Sending mail to root')
-  msg = email.mime.text.MIMEText('Script path: {0}\n'.format(os.path.realpath(__file__)) +
-    'Rebooting {0} in 1 minute'.format(socket.gethostname()))
-  msg['From'] = socket.gethostname()
-  msg['To'] = 'root'
-  msg['Subject'] = 'Notification from meteo_check_status.py script'
-  sendmail_supbroc = subprocess.Popen(["/usr/sbin/sendmail", "-t", "-oi"],
-    stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-  for output_line in sendmail_supbroc.communicate(msg.as_string())[0].splitlines():
-    logger.debug(output_line)
-
-def do_reboot():
-  previous_reboot_timeout = read_reboot_timeout()
+def do_check_disk():
+  """Checks free space on the filesystems of disk_check_paths.
+
+     Returns:
+       bool: True if there is enough free space on all of them.
+  """
+  check_result = True
+  for path in disk_check_paths:
+    try:
+      fs_stat = os.statvfs(path)
+    except OSError as e:
+      logger.debug('Skipping disk space check for {0}: {1}'.format(path, str(e)))
+      continue
+    free_mb = fs_stat.f_bavail * fs_stat.f_frsize / (1024 * 1024)
+    free_percent = 100 * fs_stat.f_bavail / fs_stat.f_blocks if fs_stat.f_blocks else 100
+    logger.debug('Free space on {0}: {1:.0f}MB ({2:.1f}%)'.format(path, free_mb, free_percent))
+    if free_mb < disk_min_free_mb or free_percent < disk_min_free_percent:
+      logger.error('Low free space on {0}: {1:.0f}MB ({2:.1f}%)'.format(path, free_mb, free_percent))
+      check_result = False
+  return(check_result)
+
+def do_check_usb():
+  """Checks that the weather station (usb_device_id) is present on USB bus.
+
+     Returns:
+       bool: True if the device is found.
+  """
+  vendor_id, product_id = usb_device_id.split(':')
+  try:
+    device_names = os.listdir(usb_devices_dir)
+  except OSError as e:
+    logger.error('Can\'t list USB devices in {0}: {1}'.format(usb_devices_dir, str(e)))
+    return(False)
+  for device_name in device_names:
+    try:
+      with open(os.path.join(usb_devices_dir, device_name, 'idVendor')) as f:
+        if f.read().strip() != vendor_id:
+          continue
+      with open(os.path.join(usb_devices_dir, device_name, 'idProduct')) as f:
+        if f.read().strip() == product_id:
+          logger.debug('USB device {0} has been found ({1})'.format(usb_device_id, device_name))
+          return(True)
+    except OSError:
+      # Interfaces and hubs without IDs, or the device has just been disconnected
+      continue
+  logger.error('USB device {0} is not connected'.format(usb_device_id))
+  return(False)
+
+def do_check_weewx_process():
+  """Checks that Weewx daemon (weewx_process_name) is running.
+
+     Returns:
+       bool: True if the process is found.
+  """
+  for pid in os.listdir('/proc'):
+    if not(pid.isdigit()):
+      continue
+    try:
+      with open(os.path.join('/proc', pid, 'cmdline'), 'rb') as f:
+        cmdline = f.read().split(b'\0')
+    except OSError:
+      # The process has exited
+      continue
+    # weewxd is usually run by python interpreter
+    if any(os.path.basename(arg) == os.fsencode(weewx_process_name) for arg in cmdline[:2]):
+      logger.debug('Weewx process is running (PID {0})'.format(pid))
+      return(True)
+  logger.error('Weewx process ({0}) is not running'.format(weewx_process_name))
+  return(False)
+
+def do_check_upload():
+  """Checks that the services, Weewx uploads data to (upload_check_urls), respond.
+
+     Returns:
+       bool: True if all of them respond.
+  """
+  import urllib.request
+  import urllib.error
+  check_result = True
+  for url in upload_check_urls:
+    try:
+      with urllib.request.urlopen(url, timeout=upload_check_timeout) as response:
+        status = response.status
+    except urllib.error.HTTPError as e:
+      status = e.code
+    except (OSError, ValueError) as e:
+      logger.error('Upload service {0} is not available: {1}'.format(url, str(e)))
+      check_result = False
+      continue
+    if status >= 500:
+      logger.error('Upload service {0} has responded with HTTP status {1}'.format(url, status))
+      check_result = False
+    else:
+      logger.debug('Upload service {0} has responded with HTTP status {1}'.format(url, status))
+  return(check_result)
+
+def parse_syslog_time(line, now):
+  """Returns unix time of a syslog line or now if the line has no timestamp.
+
+     Traditional syslog timestamps have no year, the current one is assumed
+     unless the time turns out to be in the future.
+  """
+  match = syslog_time_pattern.match(line)
+  try:
+    if match is None:
+      return(now)
+    if match.group('iso') is not None:
+      return(time.mktime(time.strptime(match.group('iso'), '%Y-%m-%dT%H:%M:%S')))
+    line_time = time.strptime(match.group('bsd'), '%b %d %H:%M:%S')
+  except ValueError:
+    return(now)
+  year = time.localtime(now).tm_year
+  line_timestamp = time.mktime((year,) + tuple(line_time)[1:6] + (0, 0, -1))
+  if line_timestamp > now + 24 * 60 * 60:
+    line_timestamp = time.mktime((year - 1,) + tuple(line_time)[1:6] + (0, 0, -1))
+  return(line_timestamp)
+
+class WeewxLogMonitor(object):
+  """Incremental reader of the Weewx log, that tracks station connection and
+     upload failures (see weewx_log_pattern).
+
+     A log file is kept open and only the data, appended since the previous
+     call, is read. Rotation is detected by inode number change: the rest of
+     the old file is read, then the new one from its beginning. A truncated file
+     is read from the beginning. For systemd journal the cursor of the last
+     entry is used instead of the file position. The position is saved to the
+     data file (lazily), so that the log is not re-read after restart. Without
+     a saved position the reading starts at the end of the log.
+  """
+
+  def __init__(self, source, log_file, state_file=None):
+    self.source = source
+    self.log_file = log_file
+    self.state_file = state_file
+    self.file = None
+    self.inode = None
+    self.buffer = b''
+    self.position = get_state_store(state_file).get('weewx_log')
+    # Unix time of the first lost_connection status in a row
+    self.lost_connection_since = None
+    # Unix times and service names of failed uploads
+    self.upload_failures = collections.deque()
+
+  def read_file_data(self):
+    """Returns data, appended to the open log file, up to log_max_read_bytes"""
+    data = self.file.read(log_max_read_bytes)
+    if len(data) == log_max_read_bytes:
+      skipped_bytes = os.fstat(self.file.fileno()).st_size - self.file.tell()
+      if skipped_bytes > 0:
+        logger.warning('Skipping {0} bytes of Weewx log {1}'.format(skipped_bytes, self.log_file))
+        self.file.seek(0, os.SEEK_END)
+        self.buffer = b''
+        data = data[:data.rfind(b'\n') + 1]
+    return(data)
+
+  def split_lines(self, data):
+    data = self.buffer + data
+    lines = data.split(b'\n')
+    # Incomplete line is kept until the rest of it is written
+    self.buffer = lines.pop()
+    return([line.decode(errors='replace') for line in lines])
+
+  def read_file_lines(self):
+    """Returns lines, appended to the log file since the previous call"""
+    lines = []
+    file_stat = os.stat(self.log_file)
+    if self.file is not None and os.fstat(self.file.fileno()).st_ino != file_stat.st_ino:
+      logger.debug('Weewx log {0} has been rotated'.format(self.log_file))
+      lines.extend(self.split_lines(self.read_file_data()))
+      self.file.close()
+      self.file = None
+      self.buffer = b''
+      self.position = {'inode': file_stat.st_ino, 'offset': 0}
+    if self.file is None:
+      self.file = open(self.log_file, 'rb')
+      file_stat = os.fstat(self.file.fileno())
+      if self.position is None or self.position.get('inode') is None:
+        offset = file_stat.st_size
+      elif self.position['inode'] != file_stat.st_ino:
+        # Rotated while we were not watching
+        offset = 0
+      else:
+        offset = self.position['offset']
+      self.file.seek(offset if offset <= file_stat.st_size else 0)
+    elif file_stat.st_size < self.file.tell():
+      logger.debug('Weewx log {0} has been truncated'.format(self.log_file))
+      self.file.seek(0)
+      self.buffer = b''
+    lines.extend(self.split_lines(self.read_file_data()))
+    self.position = {'inode': file_stat.st_ino, 'offset': self.file.tell() - len(self.buffer)}
+    return(lines)
+
+  def read_journal_lines(self):
+    """Returns journal entries, added since the previous call"""
+    args = ['journalctl', '--quiet', '--no-pager', '--output=short-iso', '--show-cursor',
+      '--identifier={0}'.format(weewx_log_identifier)]
+    cursor = None if self.position is None else self.position.get('cursor')
+    if cursor is None:
+      # Only the cursor of the last entry is needed
+      args.append('--lines=1')
+    else:
+      args.append('--after-cursor={0}'.format(cursor))
+    journalctl_result = environment.run(args, timeout=check_timeout, stderr=subprocess.DEVNULL)
+    journalctl_result.check_returncode()
+    output = journalctl_result.stdout[:log_max_read_bytes]
+    lines = output.decode(errors='replace').splitlines()
+    if lines and lines[-1].startswith('-- cursor: '):
+      self.position = {'cursor': lines.pop()[len('-- cursor: '):]}
+    return(lines if cursor is not None else [])
+
+  def process_line(self, line, now):
+    match = weewx_log_pattern.search(line)
+    if match is None:
+      return
+    line_time = parse_syslog_time(line, now)
+    if match.group('lost_connection') is not None:
+      if int(match.group('lost_connection')) != 0:
+        if self.lost_connection_since is None:
+          logger.warning('Weather station has lost connection: {0}'.format(line.strip()))
+          self.lost_connection_since = line_time
+      elif self.lost_connection_since is not None:
+        logger.info('Weather station connection has been restored')
+        self.lost_connection_since = None
+    else:
+      self.upload_failures.append((line_time, match.group('service')))
+
+  def update(self):
+    """Reads new log lines and updates the station and upload state"""
+    now = environment.time()
+    if self.source == 'journal':
+      lines = self.read_journal_lines()
+    else:
+      lines = self.read_file_lines()
+    for line in lines:
+      # Cheap test before the regular expression
+      if 'fousb' in line or 'restx' in line:
+        self.process_line(line, now)
+    get_state_store(self.state_file).update({'weewx_log': self.position}, lazy=True)
+    while self.upload_failures and self.upload_failures[0][0] < now - log_upload_failure_window * 60:
+      self.upload_failures.popleft()
+
+  def check(self):
+    """Checks station connection and upload failures in the new log lines.
+
+       Returns:
+         bool: The return value. True for success, False otherwise.
+    """
+    try:
+      self.update()
+    except (OSError, subprocess.SubprocessError) as e:
+      logger.error('Error reading Weewx log: {0}'.format(str(e)))
+      return(False)
+    check_result = True
+    now = environment.time()
+    if self.lost_connection_since is not None and \
+        now - self.lost_connection_since >= log_lost_connection_minutes * 60:
+      logger.error('Weather station has lost connection {0} ago'.format(
+        datetime.timedelta(seconds=round(now - self.lost_connection_since))))
+      check_result = False
+    if len(self.upload_failures) >= log_max_upload_failures:
+      logger.error('{0} failed uploads ({1}) in the last {2}min'.format(len(self.upload_failures),
+        ', '.join(sorted(set(service for _, service in self.upload_failures))),
+        log_upload_failure_window))
+      check_result = False
+    return(check_result)
+
+  def close(self):
+    if self.file is not None:
+      self.file.close()
+      self.file = None
+
+def get_weewx_log_monitor():
+  """Returns WeewxLogMonitor object for the current log settings, reusing existing one"""
+  global weewx_log_monitor
+  if (weewx_log_monitor is None or weewx_log_monitor.source != weewx_log_source or
+      weewx_log_monitor.log_file != weewx_log_file):
+    if weewx_log_monitor is not None:
+      weewx_log_monitor.close()
+    weewx_log_monitor = WeewxLogMonitor(weewx_log_source, weewx_log_file)
+  return(weewx_log_monitor)
+
+def do_check_log():
+  """Checks Weewx log for station connection and upload failures (see
+     WeewxLogMonitor.check()).
+
+     Returns:
+       bool: The return value. True for success, False otherwise.
+  """
+  return(get_weewx_log_monitor().check())
+
+class SendmailSink(object):
+  """Delivers notifications with local sendmail"""
+
+  def __init__(self):
+    self.name = 'sendmail'
+
+  def send(self, subject, text):
+    import email.mime.text
+    import socket
+    msg = email.mime.text.MIMEText(text)
+    msg['From'] = socket.gethostname()
+    msg['To'] = mail_to
+    msg['Subject'] = subject
+    sendmail_result = environment.run(['/usr/sbin/sendmail', '-t', '-oi'],
+      input=msg.as_bytes(), timeout=notification_timeout, stderr=subprocess.STDOUT)
+    for output_line in sendmail_result.stdout.splitlines():
+      logger.debug(output_line.decode(errors='replace'))
+    if sendmail_result.returncode != 0:
+      raise OSError('sendmail has exited with code {0}'.format(sendmail_result.returncode))
+
+class SMTPSink(object):
+  """Delivers notifications directly to an SMTP server"""
+
+  def __init__(self, host, port=25):
+    self.name = 'smtp:{0}:{1}'.format(host, port)
+    self.host = host
+    self.port = port
+
+  def send(self, subject, text):
+    import email.mime.text
+    import smtplib
+    import getpass
+    import socket
+    msg = email.mime.text.MIMEText(text)
+    msg['From'] = '{0}@{1}'.format(getpass.getuser(), socket.getfqdn())
+    msg['To'] = mail_to
+    msg['Subject'] = subject
+    with smtplib.SMTP(self.host, self.port, timeout=notification_timeout) as smtp:
+      smtp.send_message(msg)
+
+class WebhookSink(object):
+  """Delivers notifications as JSON POST requests: {"subject": ..., "text": ...}"""
+
+  def __init__(self, url):
+    self.name = 'webhook:{0}'.format(url)
+    self.url = url
+
+  def send(self, subject, text):
+    import urllib.request
+    import json
+    request = urllib.request.Request(self.url, method='POST',
+      data=json.dumps({'subject': subject, 'text': text}).encode(),
+      headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request, timeout=notification_timeout) as response:
+      response.read()
+
+def create_notification_sink(sink_spec):
+  """Creates notification sink object from "sendmail", "smtp:HOST[:PORT]" or
+     "webhook:URL" specification.
+
+     Raises:
+       ValueError: The specification is invalid.
+  """
+  kind, _, params = sink_spec.partition(':')
+  if kind == 'sendmail' and not(params):
+    return(SendmailSink())
+  if kind == 'smtp' and params:
+    host, _, port = params.partition(':')
+    return(SMTPSink(host, int(port or 25)))
+  if kind == 'webhook' and params:
+    return(WebhookSink(params))
+  raise ValueError('Invalid notification sink "{0}"'.format(sink_spec))
+
+def format_digest(notices):
+  """Returns notification text, where repeated notices are coalesced into one line"""
+  groups = []
+  groups_by_text = {}
+  for notice in notices:
+    group = groups_by_text.get(notice['text'])
+    if group is None:
+      group = groups_by_text[notice['text']] = [notice['time'], notice['time'], 0, notice['text']]
+      groups.append(group)
+    group[1] = notice['time']
+    group[2] += 1
+  lines = ['Script path: {0}'.format(os.path.realpath(__file__))]
+  for first_time, last_time, count, text in groups:
+    line = '{0}: {1}'.format(datetime.datetime.fromtimestamp(first_time), text)
+    if count > 1:
+      line += ' (repeated {0} times, last at {1})'.format(count,
+        datetime.datetime.fromtimestamp(last_time))
+    lines.append(line)
+  return('\n'.join(lines) + '\n')
+
+class Notifier(object):
+  """Delivers notifications in a background thread, so that checks are not blocked.
+
+     Notices, arriving within notification_batch_delay, are sent as one digest.
+     Undelivered notices are kept for each sink in a spool file and are retried
+     every notification_retry_interval seconds (or on wake(), e.g. when a check
+     passes again), so they go out once connectivity returns.
+  """
+
+  def __init__(self, sinks, spool_file):
+    self.sinks = sinks
+    self.spool = StateStore(spool_file)
+    self.queue = queue.Queue()
+    self.thread = None
+    self.lock = threading.Lock()
+
+  def start(self):
+    with self.lock:
+      if self.thread is None:
+        self.thread = threading.Thread(target=self.run, name='notifier')
+        self.thread.daemon = True
+        self.thread.start()
+
+  def notify(self, text):
+    self.start()
+    self.queue.put({'time': int(environment.time()), 'text': text})
+
+  def wake(self):
+    """Retries delivery of spooled notices right away"""
+    if self.thread is not None:
+      self.queue.put(None)
+
+  def stop(self, timeout=None):
+    if self.thread is not None:
+      self.queue.put(False)
+      self.thread.join(timeout)
+
+  def get_batch(self, timeout):
+    """Waits for notices and returns them (None on wake, False on stop)"""
+    try:
+      item = environment.wait(self.queue, timeout)
+    except queue.Empty:
+      return([])
+    if not(item):
+      return(item)
+    batch = [item]
+    batch_end_time = environment.monotonic() + notification_batch_delay
+    while True:
+      remaining_time = batch_end_time - environment.monotonic()
+      if remaining_time <= 0:
+        break
+      try:
+        item = environment.wait(self.queue, remaining_time)
+      except queue.Empty:
+        break
+      if item is False:
+        self.queue.put(item)
+        break
+      if item is not None:
+        batch.append(item)
+    return(batch)
+
+  def deliver(self, pending):
+    for sink in self.sinks:
+      notices = pending.get(sink.name)
+      if not(notices):
+        continue
+      subject = 'Notification from meteo_check_status.py script'
+      if len(notices) > 1:
+        subject += ' ({0} notices)'.format(len(notices))
+      start_time = environment.monotonic()
+      try:
+        sink.send(subject, format_digest(notices))
+        pending[sink.name] = []
+        logger.debug('{0} notices have been sent to {1}'.format(len(notices), sink.name))
+      except Exception as e:
+        logger.warning('Error sending notification to {0}: {1}. {2} notices are ' \
+          'spooled'.format(sink.name, str(e), len(notices)))
+      metrics.observe('notify', environment.monotonic() - start_time, not(pending[sink.name]))
+
+  def run(self):
+    pending = {}
+    for sink in self.sinks:
+      pending[sink.name] = list((self.spool.get('pending') or {}).get(sink.name, []))
+    retry_time = environment.monotonic()
+    while True:
+      if any(pending.values()) and environment.monotonic() >= retry_time:
+        self.deliver(pending)
+        self.save_spool(pending)
+        retry_time = environment.monotonic() + notification_retry_interval
+      if any(pending.values()):
+        batch = self.get_batch(max(0, retry_time - environment.monotonic()))
+      else:
+        batch = self.get_batch(None)
+      if batch is False:
+        break
+      if batch is None or batch:
+        # Deliver new notices (or retry on wake) right away
+        retry_time = environment.monotonic()
+      if batch:
+        for notices in pending.values():
+          notices.extend(batch)
+          del notices[:-notification_spool_limit]
+        self.save_spool(pending)
+
+  def save_spool(self, pending):
+    try:
+      self.spool.update({'pending': dict((name, list(notices)) for name, notices in
+        pending.items() if notices)})
+    except OSError as e:
+      logger.warning('Error writing data to {0}: {1}'.format(self.spool.state_file, str(e)))
+
+def get_notifier():
+  """Returns Notifier object for the current notification_sinks setting"""
+  global notifier
+  if notifier is None or notifier.sink_specs is not notification_sinks:
+    if notifier is not None:
+      notifier.stop(0)
+    notifier = Notifier([create_notification_sink(sink_spec) for sink_spec in notification_sinks],
+      notification_spool_file)
+    notifier.sink_specs = notification_sinks
+  return(notifier)
+
+def send_mail_to_root(message=None):
+  """Queues notification for delivery (see Notifier)"""
+  logger.debug('Queueing notification')
+  if message is None:
+    import socket
+    message = 'Rebooting {0} in 1 minute'.format(socket.gethostname())
+  get_notifier().notify(message)
+
+def do_reboot(state_file=None):
+  """Reboots the system unless uptime is less than current reboot timeout.
+
+     Returns:
+       bool: True if reboot has been initiated, False otherwise.
+  """
+  previous_reboot_timeout = read_reboot_timeout(state_file)
   try:
     reboot_timeout_minutes = reboot_timeouts_map[previous_reboot_timeout]
   except:
@@ -183,49 +2181,944 @@ def do_reboot():
   uptime = get_system_uptime()
   reboot_timeout = datetime.timedelta(minutes=reboot_timeout_minutes)
   if uptime > reboot_timeout:
-    write_reboot_timeout(reboot_timeout_minutes)
+    write_reboot_timeout(reboot_timeout_minutes, state_file)
     send_mail_to_root()
     logger.warning('*** Rebooting the system in 1 minute ***')
     # Delay reboot for 1 minute to give postifx an opportunity to deliver
     # message to and external server if root mail forwarding is enabled
-    os.system('sudo /sbin/shutdown -r +1')
+    environment.system('sudo /sbin/shutdown -r +1')
+    metrics.increment('meteo_reboots_initiated_total', 'Number of initiated reboots')
+    return(True)
   else:
     logger.info('System uptime ({0}) is less then the minimum, allowed before ' \
       'reboot ({1}). Skipping reboot'.format(uptime, reboot_timeout))
+    return(False)
 
-def do_check(no_ping):
-  logger.debug('-- Starting check --')
+def run_remediation_command(step):
+  """Runs remediation step command.
+
+     Returns:
+       bool: True if the command has succeeded, False otherwise.
+  """
+  command = remediation_commands[step][0]
+  logger.warning('Remediation step "{0}": running "{1}"'.format(step, command))
+  try:
+    return_code = environment.call(command, remediation_command_timeout)
+  except (OSError, subprocess.TimeoutExpired) as e:
+    logger.error('Remediation step "{0}" has failed: {1}'.format(step, str(e)))
+    return(False)
+  if return_code != 0:
+    logger.error('Remediation step "{0}" has failed with exit code {1}'.format(step, return_code))
+  return(return_code == 0)
+
+class CheckDefinition(object):
+  """Declared check.
+
+     Attributes:
+       name (str): Check name for logging and state.
+       check_func: Function without parameters, returning True on success.
+       timeout (float): Check run time limit (seconds), None means check_timeout.
+       depends_on (list): Names of the checks, that should pass for this check
+         to be run, e.g. upload check makes no sense without network connection.
+         If one of them fails, the check is skipped and its result doesn't count.
+       description (str): Help text.
+  """
+
+  def __init__(self, name, check_func, timeout=None, depends_on=(), description=''):
+    self.name = name
+    self.check_func = check_func
+    self.timeout = timeout
+    self.depends_on = list(depends_on)
+    self.description = description
+
+def register_check(definition):
+  """Adds a custom check (CheckDefinition), that can be enabled by name"""
+  custom_check_definitions[definition.name] = definition
+
+def get_check_definitions():
+  """Returns declared checks by name.
+
+     Definitions are created on each call, so that check functions are looked up
+     in the module at call time (e.g. they can be patched).
+  """
+  definitions = collections.OrderedDict((definition.name, definition) for definition in [
+    CheckDefinition('ping', do_ping, description='Internet connection'),
+    CheckDefinition('DB', do_check_db, description='Weewx DB data freshness'),
+    CheckDefinition('disk', do_check_disk, 10, description='Free disk space'),
+    CheckDefinition('usb', do_check_usb, 10, description='Weather station USB device presence'),
+    CheckDefinition('weewx', do_check_weewx_process, 10, description='Weewx process is running'),
+    CheckDefinition('upload', do_check_upload, upload_check_timeout * len(upload_check_urls) + 10,
+      ['ping'], description='Upload services are available'),
+    CheckDefinition('log', do_check_log, description='No station connection or upload ' \
+      'failures in Weewx log')])
+  definitions.update(custom_check_definitions)
+  return(definitions)
+
+def get_enabled_check_definitions():
+  definitions = get_check_definitions()
+  return([definitions[name] for name in enabled_checks if name in definitions])
+
+def merge_check_results(results):
+  """Returns combined verdict for check results: True, False or None for skipped
+     checks (see run_checks())
+  """
+  return(all(result for result in results.values() if result is not None))
+
+def run_checks(definitions):
+  """Runs checks in parallel threads, each one as soon as its dependencies have
+     passed, so the time it takes is the time of the slowest dependency chain.
+
+     A check is skipped (its result is None) if one of its dependencies has failed
+     or has been skipped. Dependencies, that are not among the definitions, are
+     considered passed. A check, that exceeds its time limit, fails, its daemon
+     thread is left behind (see run_in_thread()).
+
+     Returns:
+       collections.OrderedDict: Check results by name in definitions order.
+  """
+  names = [definition.name for definition in definitions]
+  results = collections.OrderedDict((name, None) for name in names)
+  finished = set()
+  pending = list(definitions)
+  # Check name: (deadline (monotonic time), timeout)
+  running = {}
+  done_queue = queue.Queue()
+
+  def run_check(definition):
+    try:
+      done_queue.put((definition.name, definition.check_func(), None))
+    except Exception as e:
+      done_queue.put((definition.name, None, e))
+
+  while pending or running:
+    ready = [definition for definition in pending if all(name in finished
+      for name in definition.depends_on if name in names)]
+    if not(ready) and not(running):
+      raise ValueError('Circular check dependencies: {0}'.format(', '.join(
+        definition.name for definition in pending)))
+    for definition in ready:
+      pending.remove(definition)
+      failed_dependencies = [name for name in definition.depends_on if name in names and
+        not(results[name])]
+      if failed_dependencies:
+        logger.info('{0} check is skipped: {1} check has not passed'.format(definition.name,
+          ', '.join(failed_dependencies)))
+        finished.add(definition.name)
+        continue
+      logger.debug('-- Starting {0} check --'.format(definition.name))
+      environment.start_thread(run_check, (definition,))
+      timeout = definition.timeout or check_timeout
+      running[definition.name] = (environment.monotonic() + timeout, timeout)
+    if not(running):
+      continue
+    try:
+      name, result, exception = environment.wait(done_queue, max(0,
+        min(deadline for deadline, _ in running.values()) - environment.monotonic()))
+    except queue.Empty:
+      now = environment.monotonic()
+      for name, (deadline, timeout) in list(running.items()):
+        if deadline <= now:
+          logger.error('{0} check has timed out ({1}s)'.format(name, timeout))
+          del running[name]
+          results[name] = False
+          finished.add(name)
+      continue
+    if name not in running:
+      # Late result of a timed out check
+      continue
+    if exception is not None:
+      raise exception
+    del running[name]
+    results[name] = result
+    finished.add(name)
+  return(results)
+
+def run_and_record_checks(definitions):
+  """Runs checks (see run_checks()) and records their results in the state.
+
+     Returns:
+       bool: Combined result (see merge_check_results()).
+  """
+  results = run_checks(definitions)
+  for name, result in results.items():
+    if result is not None:
+      record_check_result(name, result)
+  return(merge_check_results(results))
+
+def get_failing_checks():
+  """Returns names of the checks, that have failed last time (see record_check_result())"""
+  check_failures = get_state_store().get('check_failures') or {}
+  return([name for name in sorted(check_failures) if check_failures[name] and
+    name in enabled_checks])
+
+def verify_recovery():
+  """Re-runs the checks, that are failing.
+
+     Returns:
+       bool: True if all of them pass now (or none of them is failing), False otherwise.
+  """
+  failing_checks = get_failing_checks()
+  if not(failing_checks):
+    return(True)
+  definitions = get_check_definitions()
+  return(run_and_record_checks([definitions[name] for name in failing_checks]))
+
+def confirm_failure():
+  """Re-runs failing checks every recheck_interval seconds within recheck_budget.
+
+     The budget is checked before each re-run, so a slow check can exceed it by
+     its own duration.
+
+     Returns:
+       bool: True if the failure is confirmed, False if the checks pass now
+         (or none of them is failing, e.g. a stale result has been combined).
+  """
+  if not(get_failing_checks()):
+    logger.info('There are no failing checks to confirm')
+    return(False)
+  deadline = environment.monotonic() + recheck_budget
+  attempt = 0
+  while environment.monotonic() + recheck_interval <= deadline:
+    environment.sleep(recheck_interval)
+    attempt += 1
+    if verify_recovery():
+      logger.info('Failure has not been confirmed by re-check #{0}'.format(attempt))
+      return(False)
+  logger.info('Failure has been confirmed by {0} re-checks'.format(attempt))
+  return(True)
+
+def do_remediation():
+  """Goes through remediation ladder steps until the failure is fixed.
+
+     After a step has been run, the failing checks are re-run to verify recovery.
+     Each step (except for reboot, see do_reboot()) has its own backoff: after
+     being run it's skipped for reboot_timeouts_map[previous timeout] minutes.
+     Successful check resets the timeouts.
+
+     Returns:
+       bool: True if reboot has been initiated, False otherwise.
+  """
+  # The failing checks may have passed since the combined result was made
+  # (e.g. a re-check by another scheduled check)
+  if not(get_failing_checks()):
+    logger.info('There are no failing checks to remediate')
+    return(False)
+  state_store = get_state_store()
+  for step in remediation_ladder:
+    if step == 'reboot':
+      return(do_reboot())
+    remediation_state = dict(state_store.get('remediation') or {})
+    step_state = remediation_state.get(step)
+    now = int(environment.time())
+    if step_state is not None and now - step_state['time'] < step_state['timeout'] * 60:
+      logger.info('Remediation step "{0}" is skipped for {1}'.format(step,
+        datetime.timedelta(seconds=step_state['time'] + step_state['timeout'] * 60 - now)))
+      continue
+    previous_timeout = None if step_state is None else step_state['timeout']
+    remediation_state[step] = {'time': now,
+      'timeout': reboot_timeouts_map.get(previous_timeout, reboot_timeouts_map[None])}
+    state_store.update({'remediation': remediation_state})
+
+    start_time = environment.monotonic()
+    recovered = False
+    if run_remediation_command(step):
+      logger.info('Waiting {0}s before verification'.format(remediation_commands[step][1]))
+      environment.sleep(remediation_commands[step][1])
+      recovered = verify_recovery()
+    metrics.observe('remediation_' + step, environment.monotonic() - start_time, recovered)
+    if recovered:
+      logger.info('Remediation step "{0}" has fixed the failure'.format(step))
+      return(False)
+  return(False)
+
+def do_notify(station):
+  """Sends a notification about station failure.
+
+     Notifications are repeated with increasing intervals like reboots: the first
+     one is sent after the station has been failing for reboot_timeouts_map[None]
+     minutes, the next one after reboot_timeouts_map[previous interval] minutes.
+  """
+  now = environment.monotonic()
+  if station.failing_since is None:
+    station.failing_since = now
+  previous_timeout = read_reboot_timeout(station.state_file)
+  timeout_minutes = reboot_timeouts_map.get(previous_timeout, reboot_timeouts_map[None])
+  failure_duration = now - (station.last_notification_time or station.failing_since)
+  if failure_duration > timeout_minutes * 60:
+    write_reboot_timeout(timeout_minutes, station.state_file)
+    station.last_notification_time = now
+    logger.warning('Station {0} has been failing for {1}, sending notification'.format(
+      station.name, datetime.timedelta(seconds=round(now - station.failing_since))))
+    send_mail_to_root('Weewx station {0} ({1}) check has failed'.format(station.name, station.db_file))
+  else:
+    logger.info('Station {0}: next notification in {1}'.format(station.name,
+      datetime.timedelta(seconds=round(timeout_minutes * 60 - failure_duration))))
+
+def check_is_allowed():
+  """Returns False if system uptime is too small to do checks"""
   uptime = get_system_uptime()
   if uptime < datetime.timedelta(minutes=min_uptime_before_check):
     logger.info("System uptime is less than {0} minutes ({1}). " \
       "Skipping check".format(min_uptime_before_check, uptime))
-    return()
+    return(False)
+  return(True)
 
-  if no_ping:
-    logger.debug('--no-ping option is specified. Skipping ping')
-    check_result = True
-  else:
-    check_result = do_ping()
-  # Can't use `and` here because of boolean short-circuit evaluation
-  if not do_check_db():
-    check_result = False
+def process_check_result(check_result, station=None):
+  """Resets reboot timeout on success, reboots the system on failure.
+
+     For fleet stations with 'notify' action a notification is sent instead of reboot.
 
+     Returns:
+       bool: True if reboot has been initiated, False otherwise.
+  """
+  state_file = None if station is None else station.state_file
+  if not(check_result) and station is None and recheck_budget > 0:
+    check_result = not(confirm_failure())
+  if station is None:
+    metrics.set_gauge('meteo_check_success', 'Result of the latest check', int(bool(check_result)))
+  log_prefix = '' if station is None else 'Station {0}: '.format(station.name)
   if check_result:
-    logger.info('Check result: Ok')
+    logger.info(log_prefix + 'Check result: Ok')
     # Reset reboot timeout to default
-    write_reboot_timeout(0)
+    write_reboot_timeout(0, state_file)
+    state_store = get_state_store(state_file)
+    state_store.update({'last_success_time': int(environment.time())}, lazy=True)
+    if state_store.get('remediation'):
+      state_store.update({'remediation': {}})
+    if notifier is not None:
+      # Connectivity may have just been restored
+      notifier.wake()
+    if station is not None:
+      station.failing_since = station.last_notification_time = None
+    reboot_initiated = False
   else:
-    logger.info('Check result: Failure')
-    do_reboot()
+    logger.info(log_prefix + 'Check result: Failure')
+    if station is not None and station.action == 'notify':
+      do_notify(station)
+      reboot_initiated = False
+    elif station is not None:
+      reboot_initiated = do_reboot(state_file)
+    else:
+      reboot_initiated = do_remediation()
+  if metrics_textfile is not None:
+    try:
+      write_metrics_textfile()
+    except OSError as e:
+      logger.warning('Error writing metrics to {0}: {1}'.format(metrics_textfile, str(e)))
+  return(reboot_initiated)
+
+def do_check(no_ping):
+  """Runs enabled checks once in parallel and processes the combined result"""
+  logger.debug('-- Starting check --')
+  if not(check_is_allowed()):
+    return()
+
+  definitions = get_enabled_check_definitions()
+  if no_ping:
+    logger.debug('--no-ping option is specified. Skipping ping')
+    definitions = [definition for definition in definitions if definition.name != 'ping']
+  process_check_result(run_and_record_checks(definitions))
+
+class Station(object):
+  """Weewx station, monitored in fleet mode.
+
+     Each station has its own DB file (local path, NFS mount or synced copy),
+     data rules and data file with reboot timeout (backoff level) and DB
+     high-water marks. On failure 'reboot' action reboots this host, while
+     'notify' action only sends notifications with backoff.
+  """
+
+  def __init__(self, name, db_file, state_file, rule_specs=None, action='notify', db_watch=False):
+    self.name = name
+    self.db_file = db_file
+    self.state_file = state_file
+    self.action = action
+    self.weewx_db = WeewxDB(db_file, [DataRule.parse(rule_spec) for rule_spec in
+      (rule_specs or data_rules)], watch=db_watch, state_file=state_file,
+      read_mode=db_read_mode)
+    # Failure tracking for 'notify' action (monotonic time)
+    self.failing_since = None
+    self.last_notification_time = None
+
+  def check(self):
+    """Checks station's DB and processes the result.
+
+       Returns:
+         bool: The return value. True for success, False otherwise.
+    """
+    logger.debug('-- Checking station {0} --'.format(self.name))
+    if self.action == 'reboot' and not(check_is_allowed()):
+      return(True)
+    check_result = timed_phase('check_db')(self.weewx_db.check)()
+    record_check_result('DB', check_result, self.state_file)
+    process_check_result(check_result, self)
+    return(check_result)
+
+def read_fleet_config(config_file):
+  """Reads fleet mode configuration file.
+
+     Example:
+       [fleet]
+       workers = 4
+
+       [station:baltiysk]
+       db_file = /mnt/baltiysk/weewx.sdb
+       # Optional settings
+       data_file = ~/.meteo_check_status.baltiysk
+       data_rules = wind=windSpeed, outTemp:30:-50:60
+       action = notify
+       db_watch = no
+
+     Returns:
+       tuple: (number of workers, list of Station objects)
+  """
+  from configparser import ConfigParser
+  config_data = ConfigParser()
+  if not(config_data.read(config_file)):
+    raise ValueError('Can\'t read fleet configuration file {0}'.format(config_file))
+  workers = config_data.getint('fleet', 'workers', fallback=fleet_workers)
+  stations = []
+  for section in config_data.sections():
+    if not(section.startswith('station:')):
+      continue
+    name = section[len('station:'):]
+    action = config_data.get(section, 'action', fallback='notify')
+    if action not in ('notify', 'reboot'):
+      raise ValueError('Station {0}: invalid action "{1}"'.format(name, action))
+    rule_specs = [rule_spec.strip() for rule_spec in
+      config_data.get(section, 'data_rules', fallback='').split(',') if rule_spec.strip()]
+    stations.append(Station(name, config_data.get(section, 'db_file'),
+      os.path.expanduser(config_data.get(section, 'data_file',
+        fallback='~/.meteo_check_status.{0}'.format(name))),
+      rule_specs, action, config_data.getboolean(section, 'db_watch', fallback=False)))
+  if not(stations):
+    raise ValueError('No stations are defined in {0}'.format(config_file))
+  return((workers, stations))
+
+class ScheduledCheck(object):
+  """Check function with its own schedule.
+
+     Attributes:
+       name (str): Check name for logging.
+       check_func: Function without parameters, returning True on success.
+       interval (float): Interval between check runs (seconds).
+       jitter (float): Maximum random delay added to each run (seconds).
+       timeout (float): Check run time limit (seconds), None means no limit.
+       triggered (bool): Check can be run before its scheduled time by
+         CheckScheduler.trigger_check().
+       deadline_func: Optional function, returning unix time of the next
+         unscheduled run (e.g. when data becomes stale) or None.
+       independent (bool): Check processes its result itself (e.g. fleet
+         station check), the result is not combined with other checks.
+       depends_on (list): Names of the checks, that should pass for this check
+         to be run. The check is skipped while the latest result of one of them
+         is a failure.
+  """
+
+  def __init__(self, name, check_func, interval, jitter=0, timeout=None,
+      triggered=False, deadline_func=None, independent=False, depends_on=()):
+    self.name = name
+    self.check_func = check_func
+    self.interval = interval
+    self.jitter = jitter
+    self.timeout = timeout
+    self.triggered = triggered
+    self.deadline_func = deadline_func
+    self.independent = independent
+    self.depends_on = list(depends_on)
+    # Future of the current run, that may outlive its timeout
+    self.running = None
+    # asyncio.Event, created by CheckScheduler for triggered checks
+    self.trigger = None
+
+def run_in_thread(loop, func):
+  """Runs blocking function in a separate thread and returns asyncio future for its result.
+
+     Daemon thread is used instead of an executor, so that a hung call (e.g. sqlite3
+     waiting for a lock) can neither stall other checks nor prevent the process from exiting.
+  """
+  future = loop.create_future()
+
+  def set_future_result(result, exception):
+    # The future is cancelled if the run has timed out
+    if not(future.done()):
+      if exception is None:
+        future.set_result(result)
+      else:
+        future.set_exception(exception)
+
+  def thread_func():
+    try:
+      result, exception = func(), None
+    except Exception as e:
+      result, exception = None, e
+    try:
+      loop.call_soon_threadsafe(set_future_result, result, exception)
+    except RuntimeError:
+      # Event loop has been closed while the function was running
+      pass
+
+  environment.start_thread(thread_func)
+  return(future)
+
+class CheckScheduler(object):
+  """Runs checks concurrently in asyncio event loop, each one on its own interval.
+
+     Run times are calculated from the scheduler start time, so time spent
+     on checks doesn't accumulate. After each check run the latest results of all
+     the checks are combined and passed to process_check_result(). A check is
+     skipped while one of its dependencies is failing. Scheduling
+     stops when reboot has been initiated. If max_workers is set, no more than
+     this number of checks run simultaneously.
+  """
+
+  def __init__(self, loop, checks, max_workers=None):
+    self.loop = loop
+    self.checks = checks
+    self.checks_by_name = dict((check.name, check) for check in checks)
+    self.max_workers = max_workers
+    self.workers_semaphore = None
+    self.results = {}
+    self.tasks = []
+    self.stopped = None
+    self.result_lock = None
+    self.reboot_initiated = False
+
+  async def run(self):
+    """Runs the checks until stop() is called"""
+    import asyncio
+    self.stopped = self.loop.create_future()
+    self.result_lock = asyncio.Lock()
+    if self.max_workers is not None:
+      self.workers_semaphore = asyncio.Semaphore(self.max_workers)
+    for check in self.checks:
+      if check.triggered:
+        check.trigger = asyncio.Event()
+    self.tasks = [self.loop.create_task(self.run_periodically(check)) for check in self.checks]
+    try:
+      await self.stopped
+    finally:
+      self.cancel_tasks()
+
+  def stop(self):
+    if self.stopped is not None and not(self.stopped.done()):
+      self.stopped.set_result(None)
+
+  def cancel_tasks(self):
+    for task in self.tasks:
+      task.cancel()
+
+  def trigger_check(self, check):
+    """Runs triggered check as soon as possible (must be called from the event loop)"""
+    if check.trigger is not None:
+      check.trigger.set()
+
+  async def wait_for_next_run(self, check, next_run_time):
+    import asyncio
+    delay = next_run_time - self.loop.time()
+    if check.deadline_func is not None:
+      deadline = check.deadline_func()
+      # Deadlines in the past mean that the check is failing already
+      now = environment.time()
+      if deadline is not None and deadline > now:
+        delay = min(delay, deadline - now)
+    if check.trigger is None:
+      await asyncio.sleep(max(delay, 0))
+      return
+    try:
+      await asyncio.wait_for(check.trigger.wait(), max(delay, 0))
+      # Let the triggering activity (e.g. DB transaction) finish
+      await asyncio.sleep(trigger_delay)
+    except asyncio.TimeoutError:
+      pass
+    check.trigger.clear()
+
+  async def run_periodically(self, check):
+    import asyncio
+    import random
+    try:
+      start_time = self.loop.time()
+      run_number = 0
+      while True:
+        next_run_time = start_time + run_number * check.interval + random.uniform(0, check.jitter)
+        await self.wait_for_next_run(check, next_run_time)
+        result = await self.run_check(check)
+        if await self.process_result(check, result):
+          logger.info('Reboot has been initiated, stopping checks')
+          self.loop.call_soon(self.cancel_tasks)
+          return
+        # Skip runs, that have been missed while the check was running. Unscheduled
+        # runs don't shift the schedule
+        run_number = max(run_number + (self.loop.time() >= next_run_time),
+          int((self.loop.time() - start_time) // check.interval) + 1)
+    except asyncio.CancelledError:
+      raise
+    except Exception as e:
+      # Unexpected errors stop the script as before
+      if not(self.stopped.done()):
+        self.stopped.set_exception(e)
+
+  async def run_check(self, check):
+    if self.workers_semaphore is None:
+      return(await self.run_check_in_thread(check))
+    async with self.workers_semaphore:
+      return(await self.run_check_in_thread(check))
+
+  async def get_dependency_result(self, name, timeout):
+    """Returns the latest result of a check, waiting for its current run to finish
+       (no longer than timeout seconds)
+    """
+    import asyncio
+    dependency = self.checks_by_name.get(name)
+    if dependency is None or dependency.running is None:
+      return(self.results.get(name))
+    if not(dependency.running.done()):
+      await asyncio.wait([dependency.running], timeout=timeout)
+    if dependency.running.done() and not(dependency.running.cancelled()) and \
+        dependency.running.exception() is None:
+      return(dependency.running.result())
+    return(self.results.get(name))
+
+  async def run_check_in_thread(self, check):
+    import asyncio
+    failed_dependencies = [name for name in check.depends_on if
+      (await self.get_dependency_result(name, check.timeout)) is False]
+    if failed_dependencies:
+      logger.info('{0} check is skipped: {1} check has not passed'.format(check.name,
+        ', '.join(failed_dependencies)))
+      return(None)
+    if check.running is not None and not(check.running.done()):
+      logger.error('{0} check is still running since the previous run'.format(check.name))
+      return(False)
+    logger.debug('-- Starting {0} check --'.format(check.name))
+    check.running = run_in_thread(self.loop, check.check_func)
+    try:
+      # shield() keeps the future, so that we can detect a hung run next time
+      return(await asyncio.wait_for(asyncio.shield(check.running), check.timeout))
+    except asyncio.TimeoutError:
+      logger.error('{0} check has timed out ({1}s)'.format(check.name, check.timeout))
+      return(False)
+
+  async def process_result(self, check, result):
+    if check.independent:
+      return(False)
+    async with self.result_lock:
+      self.results[check.name] = result
+      if self.reboot_initiated or not(check_is_allowed()):
+        return(self.reboot_initiated)
+      check_result = merge_check_results(self.results)
+      def process():
+        if result is not None:
+          record_check_result(check.name, result)
+        return(process_check_result(check_result))
+      self.reboot_initiated = await run_in_thread(self.loop, process)
+      if not(check_result) and not(self.reboot_initiated):
+        self.update_results()
+      return(self.reboot_initiated)
+
+  def update_results(self):
+    """Clears failed results of the checks, that have passed since.
+
+       Processing a failure re-runs the failing checks (see confirm_failure()
+       and do_remediation()), and their new results are recorded in the state only. Otherwise a failure,
+       that has been fixed, would stay in self.results until the next scheduled
+       run of the check and fail the combined result of other checks.
+    """
+    check_failures = get_state_store().get('check_failures') or {}
+    for name, result in self.results.items():
+      if result is False and not(check_failures.get(name)):
+        self.results[name] = True
 
-# Interrupt signal handler. Does nothing, just logs interruption cause and exits.
+class ArchiveReport(object):
+  """Outage analytics over the whole Weewx archive table: gaps in records and in
+     values of selected columns, per-day completeness and per-column NULL ratios.
+
+     The archive is read one local day at a time with primary key range queries.
+     Each day is read in one pass, that selects dateTime and the gap columns, in
+     chunks of report_fetch_size rows, so memory usage doesn't depend on the DB
+     size. Rows are processed column-wise with builtins, so the per-row work is
+     done in C. Non-NULL counts of the other columns are aggregated by SQLite,
+     only if NULL ratios are reported. Each query is a separate short read
+     transaction, so weewx is not blocked for the duration of the report.
+  """
+
+  # Columns, that are never NULL
+  service_columns = ('dateTime', 'usUnits', 'interval')
+
+  def __init__(self, conn, gap_columns, gap_minutes=None, record_interval=None,
+      null_ratios=True):
+    self.conn = conn
+    self.columns = [column_info[1] for column_info in conn.execute('PRAGMA table_info(archive)')
+      if column_info[1] not in self.service_columns]
+    for column in gap_columns:
+      if column not in self.columns:
+        raise ValueError('There is no column "{0}" in the archive table'.format(column))
+    self.gap_columns = gap_columns
+    self.gap_seconds = (report_gap_minutes if gap_minutes is None else gap_minutes) * 60
+    # Record interval in minutes, the interval of the last record by default
+    self.record_interval = record_interval
+    # Count non-NULL values of all the columns (see get_null_ratios())
+    self.null_ratios = null_ratios
+    self.records = 0
+    self.value_counts = dict.fromkeys(self.columns, 0)
+    # Gaps: [series, start time, end time], where series is 'records' or a column name
+    self.gaps = []
+    self.daily = []
+    self.first_time = None
+    self.last_time = None
+
+  def find_gaps(self, series, previous_time, times):
+    """Adds gaps between previous_time and sorted times of a series"""
+    import operator
+    if previous_time is not None:
+      times = [previous_time] + times
+    if len(times) < 2 or max(map(operator.sub, times[1:], times)) <= self.gap_seconds:
+      return
+    for start_time, end_time in zip(times, times[1:]):
+      if end_time - start_time > self.gap_seconds:
+        self.gaps.append([series, start_time, end_time])
+
+  def read_day(self, day_start, day_end, last_times):
+    """Reads a day of records, finds gaps and returns non-NULL value counts
+       of the series
+    """
+    import itertools
+    import operator
+    counts = dict.fromkeys(last_times, 0)
+    query = 'SELECT {0} FROM archive WHERE dateTime >= ? AND dateTime < ?'.format(
+      ', '.join('`{0}`'.format(column) for column in ['dateTime'] + self.gap_columns))
+    with contextlib.closing(self.conn.execute(query, (day_start, day_end))) as cursor:
+      while True:
+        rows = cursor.fetchmany(report_fetch_size)
+        if not(rows):
+          break
+        columns = list(zip(*rows))
+        series_times = [('records', list(columns[0]))]
+        for column, values in zip(self.gap_columns, columns[1:]):
+          series_times.append((column, list(itertools.compress(columns[0],
+            map(operator.is_not, values, itertools.repeat(None))))))
+        for series, times in series_times:
+          if not(times):
+            continue
+          counts[series] += len(times)
+          self.find_gaps(series, last_times[series], times)
+          last_times[series] = times[-1]
+    return(counts)
+
+  def run(self, since=None, until=None):
+    """Reads the archive from since to until (datetime.date, inclusive)"""
+    first_time, last_time, last_interval = self.conn.execute('SELECT min(dateTime), ' \
+      'max(dateTime), (SELECT interval FROM archive ORDER BY dateTime DESC LIMIT 1) ' \
+      'FROM archive').fetchone()
+    if first_time is None:
+      return
+    if self.record_interval is None:
+      self.record_interval = last_interval or 1
+    record_seconds = self.record_interval * 60
+    # Gap columns are counted while reading the day
+    other_columns = [column for column in self.columns if column not in self.gap_columns]
+    aggregate_query = None
+    if self.null_ratios and other_columns:
+      aggregate_query = 'SELECT {0} FROM archive WHERE dateTime >= ? AND dateTime < ?'.format(
+        ', '.join('count(`{0}`)'.format(column) for column in other_columns))
+    # Time of the last value in each series
+    last_times = collections.OrderedDict((series, None) for series in
+      ['records'] + self.gap_columns)
+
+    day = max(since, datetime.date.fromtimestamp(first_time)) if since else \
+      datetime.date.fromtimestamp(first_time)
+    last_day = min(until, datetime.date.fromtimestamp(last_time)) if until else \
+      datetime.date.fromtimestamp(last_time)
+    while day <= last_day:
+      next_day = day + datetime.timedelta(days=1)
+      # Local midnight, so that days are the same as in weewx reports (handles DST)
+      day_start = int(time.mktime(day.timetuple()))
+      day_end = int(time.mktime(next_day.timetuple()))
+      counts = self.read_day(day_start, day_end, last_times)
+      records = counts['records']
+      self.records += records
+      for column in self.gap_columns:
+        self.value_counts[column] += counts[column]
+      if aggregate_query is not None:
+        for column, count in zip(other_columns, self.conn.execute(aggregate_query,
+            (day_start, day_end)).fetchone()):
+          self.value_counts[column] += count
+      # Expected number of records in the part of the day, covered by the archive
+      covered_seconds = min(day_end, last_time + record_seconds) - max(day_start, first_time)
+      expected = max(1, covered_seconds // record_seconds)
+      day_stats = collections.OrderedDict([('date', day.isoformat()), ('records', records),
+        ('expected', expected), ('completeness', round(min(1.0, records / expected), 4))])
+      for column in self.gap_columns:
+        day_stats['{0}_completeness'.format(column)] = round(min(1.0,
+          counts[column] / expected), 4)
+      self.daily.append(day_stats)
+
+      if self.first_time is None:
+        self.first_time = max(day_start, first_time)
+      self.last_time = min(day_end - 1, last_time)
+      day = next_day
+
+    if self.first_time is None:
+      # The archive has no records in the reported period
+      return
+    # Values, missing at the beginning or at the end of the reported period
+    for series, series_last_time in last_times.items():
+      if series == 'records':
+        continue
+      if series_last_time is None:
+        self.gaps.append([series, self.first_time, self.last_time])
+        continue
+      if self.last_time - series_last_time > self.gap_seconds:
+        self.gaps.append([series, series_last_time, self.last_time])
+    series_order = list(last_times)
+    self.gaps.sort(key=lambda gap: (gap[1], series_order.index(gap[0])))
+
+  def get_gaps(self):
+    for series, start_time, end_time in self.gaps:
+      yield collections.OrderedDict([('series', series),
+        ('start', str(datetime.datetime.fromtimestamp(start_time))),
+        ('end', str(datetime.datetime.fromtimestamp(end_time))),
+        ('minutes', (end_time - start_time) // 60)])
+
+  def get_null_ratios(self):
+    return(collections.OrderedDict((column, round(1 - self.value_counts[column] / self.records, 4)
+      if self.records else None) for column in self.columns))
+
+  def write_json(self, f, section='all'):
+    import json
+    report = collections.OrderedDict()
+    if section in ('all', 'gaps'):
+      report['gaps'] = list(self.get_gaps())
+    if section in ('all', 'daily'):
+      report['daily'] = self.daily
+    if section in ('all', 'nulls'):
+      report['null_ratios'] = self.get_null_ratios()
+    json.dump(report, f, indent=2)
+    f.write('\n')
+
+  def write_csv(self, f, section='all'):
+    """Writes report sections as CSV tables, separated by empty lines"""
+    import csv
+    tables = []
+    if section in ('all', 'gaps'):
+      tables.append((['series', 'start', 'end', 'minutes'],
+        [list(gap.values()) for gap in self.get_gaps()]))
+    if section in ('all', 'daily'):
+      header = ['date', 'records', 'expected', 'completeness'] + \
+        ['{0}_completeness'.format(column) for column in self.gap_columns]
+      tables.append((header, [list(day_stats.values()) for day_stats in self.daily]))
+    if section in ('all', 'nulls'):
+      tables.append((['column', 'null_ratio'], list(self.get_null_ratios().items())))
+    writer = csv.writer(f, lineterminator='\n')
+    for table_index, (header, rows) in enumerate(tables):
+      if table_index:
+        f.write('\n')
+      writer.writerow(header)
+      writer.writerows(rows)
+
+def run_report(options):
+  """Runs 'report' subcommand.
+
+     Returns:
+       int: Exit code.
+  """
+  db_file = options.report_db_file or weewx_db_file
+  gap_columns = options.report_columns or [DataRule.parse(rule_spec).column
+    for rule_spec in data_rules]
+  since, until = [datetime.datetime.strptime(date_str, '%Y-%m-%d').date() if date_str else None
+    for date_str in (options.report_since, options.report_until)]
+  if not(os.path.isfile(db_file)):
+    logger.error('Weewx DB file {0} does not exist'.format(db_file))
+    return(1)
+  start_time = time.monotonic()
+  snapshot = None
+  read_file = db_file
+  if use_db_snapshot(db_file, db_read_mode):
+    if hasattr(sqlite3.Connection, 'backup'):
+      snapshot = DBSnapshot(db_file, db_snapshot_dir)
+      snapshot.refresh()
+      read_file = snapshot.snapshot_file
+    else:
+      # The report reads the DB in short per-day transactions anyway
+      logger.warning('DB snapshot for the report requires python 3.7+, reading the DB directly')
+  try:
+    import urllib.parse
+    db_uri = 'file:{0}?mode=ro'.format(urllib.parse.quote(os.path.abspath(read_file)))
+    with contextlib.closing(sqlite3.connect(db_uri, uri=True)) as conn:
+      report = ArchiveReport(conn, gap_columns, options.report_gap_minutes,
+        options.report_record_interval, options.report_section in ('all', 'nulls'))
+      report.run(since, until)
+  finally:
+    if snapshot is not None:
+      snapshot.remove()
+  logger.debug('Report on {0} records has taken {1:.1f}s'.format(report.records,
+    time.monotonic() - start_time))
+  output_file = open(options.report_output, 'w', newline='') if options.report_output else sys.stdout
+  try:
+    if options.report_format == 'json':
+      report.write_json(output_file, options.report_section)
+    else:
+      report.write_csv(output_file, options.report_section)
+  finally:
+    if output_file is not sys.stdout:
+      output_file.close()
+  return(0)
+
+# Overrides module-level settings with command line options
+def apply_options(options):
+  global ping_targets, ping_deadline, ping_backend, data_rules, db_watch, metrics_textfile
+  global remediation_ladder, recheck_interval, recheck_budget, notification_sinks, mail_to
+  global wind_anomaly_action, db_read_mode, db_snapshot_dir, enabled_checks, upload_check_urls
+  global weewx_log_source, weewx_log_file, check_timeout
+  db_watch = options.db_watch
+  db_read_mode = options.db_read_mode
+  db_snapshot_dir = options.db_snapshot_dir
+  enabled_checks = [name for name in ['ping', 'DB'] if not(name == 'ping' and options.no_ping)]
+  for name in options.extra_checks or []:
+    if name not in enabled_checks:
+      enabled_checks.append(name)
+  if options.upload_check_urls:
+    upload_check_urls = options.upload_check_urls
+  weewx_log_source = options.weewx_log_source
+  weewx_log_file = options.weewx_log_file
+  metrics_textfile = options.metrics_textfile
+  if options.data_rules:
+    for rule_spec in options.data_rules:
+      DataRule.parse(rule_spec)
+    data_rules = options.data_rules
+  if options.ping_targets:
+    ping_targets = options.ping_targets
+  ping_deadline = options.ping_deadline
+  ping_backend = options.ping_backend
+  check_timeout = options.check_timeout
+  if options.notification_sinks:
+    for sink_spec in options.notification_sinks:
+      create_notification_sink(sink_spec)
+    notification_sinks = options.notification_sinks
+  mail_to = options.mail_to
+  wind_anomaly_action = options.wind_anomaly_action
+  recheck_interval = options.recheck_interval
+  recheck_budget = options.recheck_budget
+  if options.remediation_ladder:
+    if 'reboot' in options.remediation_ladder[:-1]:
+      raise ValueError('Reboot should be the last remediation step')
+    remediation_ladder = options.remediation_ladder
+
+# Interrupt signal handler. Does nothing, just logs interruption cause and stops
+# check scheduler (or exits if it's not running).
 # Handles the following signals:
 # SIGTERM: process termintaion, SIGINT: terminal interruption, SIGHUP: terminal closing, SIGQUIT: process quit with dump
 def signal_handler(signum = None, frame = None):
   logger.info('Caught signal {0} ({1}), exiting'.format(signum, signals_to_handle[signum]))
-  sys.exit(0)
+  if active_scheduler is None:
+    sys.exit(0)
+  active_scheduler.stop()
 
 def main():
+  global active_scheduler
+  import argparse
+  import asyncio
+  setup_logging()
   exit_code = 0
   try:
     parser = argparse.ArgumentParser()
@@ -235,21 +3128,177 @@ def main():
       help='Disable ping check')
     parser.add_argument('-s', '--sleep-time', dest='sleep_time', type=int, default=300,
       help='Sleep time between checks in seconds (default: %(default)d)')
+    parser.add_argument('--db-check-interval', dest='db_check_interval', type=int,
+      help='Interval between DB checks in seconds (default: same as --sleep-time)')
+    parser.add_argument('--jitter', dest='jitter', type=int, default=0,
+      help='Maximum random delay added to each check run in seconds (default: %(default)d)')
+    parser.add_argument('-f', '--fleet-config', dest='fleet_config', metavar='FILE',
+      help='Monitor several Weewx stations, listed in the configuration file ' \
+      '(see read_fleet_config() for the format)')
+    parser.add_argument('-w', '--db-watch', dest='db_watch', action='store_true', default=False,
+      help='Query Weewx DB only when it has changed (uses inotify if available) and ' \
+      'check data as soon as it becomes stale')
+    parser.add_argument('--db-read-mode', dest='db_read_mode', choices=['direct', 'snapshot', 'auto'],
+      default=db_read_mode, help='Query Weewx DB file directly or its copy, so that reading ' \
+      'never blocks Weewx writes: checks copy only recent records, the report copies the ' \
+      'whole DB with SQLite backup API. "auto" queries the copy unless the DB is in WAL mode ' \
+      '(default: %(default)s)')
+    parser.add_argument('--db-snapshot-dir', dest='db_snapshot_dir', default=db_snapshot_dir,
+      help='Directory for Weewx DB copies, preferably on tmpfs (default: %(default)s)')
+    extra_check_definitions = [definition for name, definition in get_check_definitions().items()
+      if name not in ('ping', 'DB')]
+    parser.add_argument('--check', dest='extra_checks', action='append',
+      choices=[definition.name for definition in extra_check_definitions], metavar='CHECK',
+      help='Enable extra check, can be specified multiple times: {0}'.format(', '.join(
+      '{0} ({1})'.format(definition.name, definition.description)
+      for definition in extra_check_definitions)))
+    parser.add_argument('--upload-url', dest='upload_check_urls', action='append', metavar='URL',
+      help='URL of the service, Weewx uploads data to, for "upload" check, can be specified ' \
+      'multiple times (default: {0})'.format(', '.join(upload_check_urls)))
+    parser.add_argument('--weewx-log', dest='weewx_log_file', default=weewx_log_file,
+      metavar='FILE', help='Weewx log file for "log" check (default: %(default)s)')
+    parser.add_argument('--weewx-log-source', dest='weewx_log_source',
+      choices=['file', 'journal'], default=weewx_log_source,
+      help='Read Weewx log from the file or from systemd journal (default: %(default)s)')
+    parser.add_argument('--check-timeout', dest='check_timeout', type=int, default=check_timeout,
+      help='Time limit for a single check run in seconds (default: %(default)d)')
+    parser.add_argument('-r', '--data-rule', dest='data_rules', action='append', metavar='RULE',
+      help='Data freshness rule "[NAME=]COLUMN[:MINUTES[:MIN:MAX]]", e.g. "outTemp:30:-50:60". ' \
+      'Can be specified multiple times (default: {0})'.format(', '.join(data_rules)))
+    parser.add_argument('--wind-anomaly', dest='wind_anomaly_action',
+      choices=['off', 'warn', 'fail'], default=wind_anomaly_action,
+      help='Action on wind data anomaly (stuck anemometer, variance collapse, ' \
+      'gust less than speed) (default: %(default)s)')
+    parser.add_argument('--metrics-textfile', dest='metrics_textfile', metavar='FILE',
+      help='Write Prometheus metrics to a file for node_exporter textfile collector')
+    parser.add_argument('--metrics-port', dest='metrics_port', type=int, metavar='PORT',
+      help='Serve Prometheus metrics over HTTP on this port')
+    parser.add_argument('--metrics-address', dest='metrics_address', default='127.0.0.1',
+      help='Address for the metrics HTTP server (default: %(default)s)')
+    parser.add_argument('-n', '--notify', dest='notification_sinks', action='append',
+      metavar='SINK', help='Notification sink: "sendmail", "smtp:HOST[:PORT]" or "webhook:URL". ' \
+      'Can be specified multiple times (default: {0})'.format(', '.join(notification_sinks)))
+    parser.add_argument('--mail-to', dest='mail_to', default=mail_to,
+      help='Notification e-mail recipient (default: %(default)s)')
+    parser.add_argument('--recheck-interval', dest='recheck_interval', type=int,
+      default=recheck_interval, help='Interval between re-checks after a failure in seconds ' \
+      '(default: %(default)d)')
+    parser.add_argument('--recheck-budget', dest='recheck_budget', type=int,
+      default=recheck_budget, help='Time to confirm a failure with re-checks before ' \
+      'remediation in seconds, 0 to disable (default: %(default)d)')
+    parser.add_argument('--remediation', dest='remediation_ladder', action='append',
+      metavar='STEP', choices=sorted(remediation_commands) + ['reboot'],
+      help='Remediation step, tried on check failure. Can be specified multiple times, ' \
+      'steps are tried in order, e.g. "--remediation restart_weewx --remediation reboot". ' \
+      'Choices: %(choices)s (default: {0})'.format(', '.join(remediation_ladder)))
+    parser.add_argument('-t', '--ping-target', dest='ping_targets', action='append',
+      metavar='HOST', help='Ping target, can be specified multiple times ' \
+      '(default: {0})'.format(', '.join(ping_targets)))
+    parser.add_argument('--ping-deadline', dest='ping_deadline', type=int, default=ping_deadline,
+      help='Overall time limit for the ping check in seconds (default: %(default)d)')
+    parser.add_argument('--ping-backend', dest='ping_backend', choices=['native', 'subprocess'],
+      default=ping_backend, help='Use built-in probes or ping command (default: %(default)s). ' \
+      'Built-in probes accept "tcp:HOST:PORT" and "dns:SERVER[:PORT]" targets as well')
+    subparsers = parser.add_subparsers(dest='command', metavar='COMMAND')
+    report_parser = subparsers.add_parser('report', help='Report data gaps, per-day ' \
+      'completeness and per-column NULL ratios over the whole Weewx archive and exit')
+    report_parser.add_argument('--db-file', dest='report_db_file', metavar='FILE',
+      help='Weewx DB file (default: {0})'.format(weewx_db_file))
+    report_parser.add_argument('--format', dest='report_format', choices=['csv', 'json'],
+      default='csv', help='Output format (default: %(default)s)')
+    report_parser.add_argument('--section', dest='report_section',
+      choices=['all', 'gaps', 'daily', 'nulls'], default='all',
+      help='Report section to output (default: %(default)s)')
+    report_parser.add_argument('--column', dest='report_columns', action='append',
+      metavar='COLUMN', help='Column to report value gaps and daily completeness for, can be ' \
+      'specified multiple times (default: columns of data rules)')
+    report_parser.add_argument('--gap-minutes', dest='report_gap_minutes', type=int,
+      default=report_gap_minutes, help='Minimum reported gap in minutes (default: %(default)d)')
+    report_parser.add_argument('--record-interval', dest='report_record_interval', type=int,
+      metavar='MINUTES', help='Archive record interval (default: interval of the last record)')
+    report_parser.add_argument('--since', dest='report_since', metavar='YYYY-MM-DD',
+      help='First day of the report')
+    report_parser.add_argument('--until', dest='report_until', metavar='YYYY-MM-DD',
+      help='Last day of the report')
+    report_parser.add_argument('-o', '--output', dest='report_output', metavar='FILE',
+      help='Output file (default: stdout)')
     options = parser.parse_args()
 
     if options.debug:
       stdout_handler.setLevel(logging.DEBUG)
+    apply_options(options)
+    if options.command == 'report':
+      return(run_report(options))
 
     logger.info('Starting monitoring script')
     logger.debug('Script location: {0}'.format(os.path.realpath(__file__)))
     logger.debug('Data file: {0}'.format(data_file))
+    # Send notifications, spooled before restart
+    get_notifier().start()
 
-    for sig in signals_to_handle:
-      signal.signal(sig, signal_handler)
+    checks = []
+    if options.no_ping:
+      logger.debug('--no-ping option is specified. Skipping ping')
+    # DB check has its own schedule (see below)
+    for definition in get_enabled_check_definitions():
+      if definition.name != 'DB':
+        checks.append(ScheduledCheck(definition.name, definition.check_func, options.sleep_time,
+          options.jitter, definition.timeout or options.check_timeout,
+          depends_on=definition.depends_on))
+    db_check_interval = options.db_check_interval or options.sleep_time
+    max_workers = None
+    db_watcher = None
+    inotify_fd = None
+    stations = []
+    if options.fleet_config:
+      max_workers, stations = read_fleet_config(options.fleet_config)
+      logger.info('Fleet mode: {0} stations, {1} workers'.format(len(stations), max_workers))
+      for station in stations:
+        checks.append(ScheduledCheck('station {0}'.format(station.name), station.check,
+          db_check_interval, options.jitter, options.check_timeout, independent=True))
+    else:
+      db_watcher = get_weewx_db().watcher
+    if db_watcher is not None:
+      inotify_fd = db_watcher.start_inotify()
+      if inotify_fd is None:
+        # Polling with stat() is cheap, DB is queried only when it has changed
+        db_check_interval = min(db_check_interval, db_watch_poll_interval)
+    if not(options.fleet_config):
+      db_check = ScheduledCheck('DB', do_check_db, db_check_interval, options.jitter,
+        options.check_timeout, triggered=inotify_fd is not None,
+        deadline_func=(lambda: get_weewx_db().get_expiry_time()) if db_watcher else None)
+      checks.append(db_check)
 
-    while True:
-      do_check(options.no_ping)
-      time.sleep(options.sleep_time)
+    loop = asyncio.new_event_loop()
+    metrics_server = None
+    try:
+      active_scheduler = CheckScheduler(loop, checks, max_workers)
+      for sig in signals_to_handle:
+        loop.add_signal_handler(sig, signal_handler, sig)
+      if inotify_fd is not None:
+        loop.add_reader(inotify_fd, lambda: db_watcher.read_inotify_events() and
+          active_scheduler.trigger_check(db_check))
+      if options.metrics_port is not None:
+        metrics_server = loop.run_until_complete(asyncio.start_server(serve_metrics,
+          options.metrics_address, options.metrics_port))
+        logger.info('Serving metrics on {0}:{1}'.format(options.metrics_address, options.metrics_port))
+      loop.run_until_complete(active_scheduler.run())
+    finally:
+      active_scheduler = None
+      if metrics_server is not None:
+        metrics_server.close()
+      if db_watcher is not None:
+        db_watcher.close()
+      # Closing DB connections also removes DB snapshots
+      for station in stations:
+        station.weewx_db.close()
+      if weewx_db is not None:
+        weewx_db.close()
+      loop.close()
+      flush_state_stores()
+      if notifier is not None:
+        # Give queued notifications a chance to go out, the rest stay spooled
+        notifier.stop(notification_timeout)
 
   except Exception as e:
     logger.exception("Unhandled exception")
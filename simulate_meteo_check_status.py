@@ -0,0 +1,515 @@
+#!/usr/bin/env python
+
+"""Simulation of meteo_check_status.py daemon over days of virtual time.
+
+Replays station behavior (network outages, station hangs, short ping failures)
+against the real check scheduler, DB check, re-check, remediation and reboot
+logic. Clock, sleep, threads, ping, system uptime and commands are simulated (see
+SystemEnvironment in meteo_check_status.py). The scheduler runs on an event loop,
+that advances the virtual clock instead of waiting, so a week of station
+behavior takes a few seconds and results are repeatable. Simulated Weewx writes
+archive records to a SQLite DB as the virtual clock advances, unless the station
+has hung. A reboot restarts the simulated daemon: uptime starts over and the
+state (e.g. DB high-water marks) is re-read from the data file. Results (reboots
+with their backoff timeouts, detection latencies, false reboots) are written as
+JSON.
+
+Example:
+  ./simulate_meteo_check_status.py --days 7 --outage network@10+30 --outage station@100 \
+    --blips-per-day 4 --recheck-budget 60 --output results.json
+"""
+
+import sys
+import os
+import argparse
+import time
+import json
+import math
+import random
+import logging
+import tempfile
+import shutil
+import contextlib
+import queue
+import sqlite3
+import subprocess
+import asyncio
+import selectors
+
+import meteo_check_status
+
+# Simulation start: 2026-01-01 00:00:00 UTC
+start_timestamp = 1767225600
+# Uptime of the system at simulation start (seconds)
+initial_uptime = 24 * 60 * 60
+# Time from the shutdown command execution to the start of the daemon after
+# reboot (seconds): shutdown delay (-r +1) and boot time
+shutdown_delay = 60
+boot_duration = 90
+# Weewx archive record interval (seconds)
+record_interval = 60
+# Weewx DB contains records for this period of time before simulation start (seconds)
+initial_records_period = 3 * 60 * 60
+
+class Outage(object):
+  """Period of station misbehavior.
+
+     Kinds:
+       network: ping fails, reboot doesn't help (e.g. ISP failure).
+       station: Weewx doesn't get new data until reboot or USB reset (the
+         station has hung).
+       blip: ping fails for a short time, actions taken during a blip are false
+         positives.
+  """
+
+  def __init__(self, kind, start_time, duration=math.inf):
+    self.kind = kind
+    self.start_time = start_time
+    self.end_time = start_time + duration
+    # Time of the first failed check and of the first remediation or reboot
+    self.detection_time = None
+    self.action_time = None
+
+  @classmethod
+  def parse(cls, outage_spec):
+    """Creates an outage from "KIND@START[+DURATION]" string, START and DURATION
+       are in hours since the simulation start. No duration means that the
+       outage lasts until it's fixed, e.g. "network@10+30", "station@100".
+    """
+    kind, _, period = outage_spec.partition('@')
+    start_hours, _, duration_hours = period.partition('+')
+    if kind not in ('network', 'station', 'blip') or not(start_hours):
+      raise ValueError('Invalid outage specification: "{0}"'.format(outage_spec))
+    return(cls(kind, start_timestamp + float(start_hours) * 3600,
+      float(duration_hours) * 3600 if duration_hours else math.inf))
+
+  def is_active(self, now):
+    return(self.start_time <= now < self.end_time)
+
+class SimulatedEnvironment(object):
+  """Virtual clock and system for meteo_check_status (see SystemEnvironment).
+
+     Threads run synchronously, so the virtual clock doesn't move while a check
+     is in progress, unless the check sleeps or waits for a queue.
+
+     Args:
+       ping_func: Function without parameters, that returns ping result.
+       command_func: Function, that is called with (time, command) after a
+         command has been run.
+       clock_func: Function, that is called with the new time after the virtual
+         clock has advanced.
+  """
+
+  def __init__(self, ping_func=None, command_func=None, clock_func=None):
+    self.now = start_timestamp
+    self.boot_time = start_timestamp - initial_uptime
+    self.ping_func = ping_func
+    self.command_func = command_func
+    self.clock_func = clock_func
+    # Time, when the system goes down after shutdown command
+    self.shutdown_time = None
+    # (time, command) tuples
+    self.commands = []
+
+  def time(self):
+    return(self.now)
+
+  def monotonic(self):
+    # Counts from boot as CLOCK_MONOTONIC does. Event loop needs small values:
+    # its clock resolution is lost in unix time floats
+    return(self.get_uptime())
+
+  def sleep(self, seconds):
+    self.advance(seconds)
+
+  def advance(self, seconds):
+    self.now += seconds
+    if self.clock_func is not None:
+      self.clock_func(self.now)
+
+  def wait(self, queue_obj, timeout):
+    # Threads have already finished, so nothing more is going to be put into the queue
+    try:
+      return(queue_obj.get_nowait())
+    except queue.Empty:
+      if timeout is None:
+        raise RuntimeError('Simulated queue has nothing to wait for')
+      self.advance(timeout)
+      raise
+
+  def get_uptime(self):
+    return(self.now - self.boot_time)
+
+  def system(self, command):
+    if 'shutdown -r' in command:
+      self.shutdown_time = self.now + shutdown_delay
+    self.run_command(command)
+    return(0)
+
+  def call(self, command, timeout):
+    self.run_command(command)
+    return(0)
+
+  def run(self, args, input=None, timeout=None, stderr=None):
+    self.run_command(' '.join(args))
+    return(subprocess.CompletedProcess(args, 0, b''))
+
+  def run_command(self, command):
+    self.commands.append((self.now, command))
+    if self.command_func is not None:
+      self.command_func(self.now, command)
+
+  def start_thread(self, func, args=()):
+    func(*args)
+
+  def ping(self, targets, deadline_seconds):
+    return(True if self.ping_func is None else self.ping_func())
+
+class VirtualTimeSelector(object):
+  """Selector, that advances the virtual clock by the timeout instead of waiting"""
+
+  def __init__(self, environment):
+    self.environment = environment
+    self.selector = selectors.DefaultSelector()
+
+  def select(self, timeout=None):
+    events = self.selector.select(0)
+    if events or timeout == 0:
+      return(events)
+    # Nothing is scheduled, a real loop would wait forever
+    if timeout is None:
+      raise RuntimeError('Simulated event loop has nothing to wait for')
+    self.environment.advance(timeout)
+    return(events)
+
+  def __getattr__(self, name):
+    # register(), unregister(), close(), etc.
+    return(getattr(self.selector, name))
+
+class VirtualTimeEventLoop(asyncio.SelectorEventLoop):
+  """Event loop, that runs on the virtual clock of SimulatedEnvironment"""
+
+  def __init__(self, environment):
+    super().__init__(VirtualTimeSelector(environment))
+    self.environment = environment
+
+  def time(self):
+    return(self.environment.monotonic())
+
+class RecordingNotifier(object):
+  """Notifier replacement, that keeps notifications in memory"""
+
+  def __init__(self, environment):
+    self.environment = environment
+    self.sink_specs = meteo_check_status.notification_sinks
+    self.notices = []
+
+  def notify(self, text):
+    self.notices.append((self.environment.now, text))
+
+  def wake(self):
+    pass
+
+  def stop(self, timeout=None):
+    pass
+
+class SimulatedWeewx(object):
+  """Weewx, that writes an archive record to a SQLite DB every record_interval
+     seconds of the virtual time.
+
+     Records are written in batches, when the virtual clock advances (see
+     SimulatedEnvironment), so a check sees all records up to the current time.
+
+     Args:
+       db_file: Weewx DB file to create.
+       is_working_func: Function, that is called with a record time and returns
+         False if there is no record for this time (e.g. the station has hung).
+       seed: Random seed for the record values.
+  """
+
+  def __init__(self, db_file, is_working_func, seed=0):
+    self.is_working_func = is_working_func
+    self.random = random.Random(seed)
+    self.conn = sqlite3.connect(db_file)
+    self.conn.execute('CREATE TABLE archive (`dateTime` INTEGER NOT NULL UNIQUE PRIMARY KEY, ' \
+      '`usUnits` INTEGER NOT NULL, `interval` INTEGER NOT NULL, `outTemp` REAL, ' \
+      '`windSpeed` REAL, `windGust` REAL, `windDir` REAL)')
+    # Time of the last record, that has been written or skipped
+    self.record_time = start_timestamp - initial_records_period
+    self.records = 0
+    self.write(start_timestamp)
+
+  def write(self, now):
+    """Writes the records up to now"""
+    records = []
+    while self.record_time + record_interval <= now:
+      self.record_time += record_interval
+      if not(self.is_working_func(self.record_time)):
+        continue
+      wind_speed = round(self.random.uniform(0, 10), 1)
+      records.append((self.record_time, 16, record_interval // 60,
+        round(self.random.uniform(-5, 5), 1), wind_speed,
+        round(wind_speed + self.random.uniform(0, 5), 1), self.random.randrange(360)))
+    if records:
+      with self.conn:
+        self.conn.executemany('INSERT INTO archive VALUES (?, ?, ?, ?, ?, ?, ?)', records)
+      self.records += len(records)
+
+  def close(self):
+    self.conn.close()
+
+@contextlib.contextmanager
+def patched_module(values):
+  """Temporarily replaces meteo_check_status module attributes"""
+  saved_values = dict((name, getattr(meteo_check_status, name)) for name in values)
+  for name, value in values.items():
+    setattr(meteo_check_status, name, value)
+  try:
+    yield
+  finally:
+    for name, value in saved_values.items():
+      setattr(meteo_check_status, name, value)
+
+class Simulation(object):
+  """Runs meteo_check_status check scheduler with ping and DB checks every
+     sleep_time seconds for days of simulated time. Module settings (thresholds,
+     data rules, DB read mode, re-check budget, remediation ladder, etc.) are used
+     as they are set in meteo_check_status.
+  """
+
+  def __init__(self, outages, days, sleep_time=300, blips_per_day=0, blip_minutes=2, seed=0):
+    self.outages = list(outages)
+    self.end_time = start_timestamp + days * 24 * 60 * 60
+    self.sleep_time = sleep_time
+    self.environment = SimulatedEnvironment(self.do_ping, self.on_command, self.on_clock)
+    self.notifier = RecordingNotifier(self.environment)
+    # Random short ping failures (Poisson process)
+    rnd = random.Random(seed)
+    blip_time = start_timestamp
+    while blips_per_day > 0:
+      blip_time += rnd.expovariate(blips_per_day / (24 * 60 * 60))
+      if blip_time >= self.end_time:
+        break
+      self.outages.append(Outage('blip', blip_time, blip_minutes * 60))
+    self.outages.sort(key=lambda outage: outage.start_time)
+    self.reboots = []
+    self.failed_checks = 0
+    # Check scheduler of the running daemon
+    self.scheduler = None
+    # Weewx doesn't write records before this time (it's down during reboot)
+    self.weewx_start_time = None
+    self.weewx = None
+
+  def get_active_outages(self, kinds):
+    now = self.environment.now
+    return([outage for outage in self.outages if outage.kind in kinds and outage.is_active(now)])
+
+  def detect(self, outages):
+    """Records a failed check, caused by the outages"""
+    self.failed_checks += 1
+    for outage in outages:
+      if outage.detection_time is None:
+        outage.detection_time = self.environment.now
+
+  def do_ping(self):
+    outages = self.get_active_outages(('network', 'blip'))
+    if outages:
+      self.detect(outages)
+    return(not(outages))
+
+  def do_check_db(self):
+    # The real DB check on the simulated Weewx DB
+    result = meteo_check_status.do_check_db()
+    if not(result):
+      self.detect(self.get_active_outages(('station',)))
+    return(result)
+
+  def is_station_working(self, record_time):
+    return(record_time >= self.weewx_start_time and not(any(outage.kind == 'station' and
+      outage.is_active(record_time) for outage in self.outages)))
+
+  def on_clock(self, now):
+    if self.weewx is not None:
+      self.weewx.write(now)
+
+  def on_command(self, command_time, command):
+    """Updates outages after a remediation command or shutdown has been run"""
+    # Supervisord stops the daemon, when the system goes down
+    if 'shutdown' in command:
+      self.scheduler.loop.call_later(self.environment.shutdown_time - command_time,
+        self.scheduler.stop)
+    for outage in self.outages:
+      if outage.is_active(command_time) and outage.detection_time is not None and \
+          outage.action_time is None:
+        outage.action_time = command_time
+    # The station is back after a USB reset or Weewx restart
+    if 'shutdown' not in command:
+      for outage in self.outages:
+        if outage.kind == 'station' and outage.is_active(command_time):
+          outage.end_time = command_time
+
+  def reboot(self):
+    environment = self.environment
+    shutdown_time = environment.shutdown_time
+    environment.shutdown_time = None
+    # Outages at the time of the reboot decision
+    real_outages = [outage for outage in self.outages if outage.kind != 'blip' and
+      outage.is_active(shutdown_time - shutdown_delay)]
+    self.reboots.append({
+      'time_hours': round((shutdown_time - start_timestamp) / 3600, 3),
+      'uptime_minutes': round((shutdown_time - environment.boot_time) / 60, 1),
+      'reboot_timeout': meteo_check_status.read_reboot_timeout(),
+      'false_positive': not(real_outages)})
+    # Supervisord stops the daemon on shutdown, then it starts over after boot
+    meteo_check_status.flush_state_stores()
+    meteo_check_status.state_stores.clear()
+    if meteo_check_status.weewx_db is not None:
+      meteo_check_status.weewx_db.close()
+      meteo_check_status.weewx_db = None
+    for outage in self.get_active_outages(('station',)):
+      outage.end_time = shutdown_time
+    environment.boot_time = shutdown_time
+    self.weewx_start_time = shutdown_time + boot_duration
+    environment.now = shutdown_time
+    environment.advance(boot_duration)
+
+  def run_daemon(self):
+    """Runs the check scheduler until the system goes down or the simulation ends"""
+    loop = VirtualTimeEventLoop(self.environment)
+    # Checks are scheduled as main() does it, DB check has the same interval
+    checks = [meteo_check_status.ScheduledCheck(definition.name, definition.check_func,
+      self.sleep_time, timeout=definition.timeout or meteo_check_status.check_timeout,
+      depends_on=definition.depends_on)
+      for definition in meteo_check_status.get_enabled_check_definitions()]
+    self.scheduler = meteo_check_status.CheckScheduler(loop, checks)
+    try:
+      loop.call_later(self.end_time - self.environment.now, self.scheduler.stop)
+      loop.run_until_complete(self.scheduler.run())
+      # Let the cancelled check tasks finish
+      loop.run_until_complete(asyncio.gather(*self.scheduler.tasks, return_exceptions=True))
+    finally:
+      self.scheduler = None
+      loop.close()
+
+  def run(self):
+    """Runs the simulation.
+
+       Returns:
+         dict: Simulation results.
+    """
+    # State is written on each check result change, tmpfs makes fsync() cheap
+    state_dir = tempfile.mkdtemp(dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+    environment = self.environment
+    # Ping goes through the environment, DB check failures are attributed to outages
+    custom_checks = dict(meteo_check_status.custom_check_definitions)
+    custom_checks['DB'] = meteo_check_status.CheckDefinition('DB', self.do_check_db)
+    db_file = os.path.join(state_dir, 'weewx.sdb')
+    self.weewx_start_time = start_timestamp - initial_records_period
+    start_time = time.perf_counter()
+    try:
+      self.weewx = SimulatedWeewx(db_file, self.is_station_working)
+      with patched_module({'environment': environment, 'notifier': self.notifier,
+          'data_file': os.path.join(state_dir, 'data_file'), 'state_stores': {},
+          'weewx_db_file': db_file, 'weewx_db': None, 'db_snapshot_dir': state_dir,
+          'enabled_checks': ['ping', 'DB'], 'metrics_textfile': None,
+          'custom_check_definitions': custom_checks}):
+        try:
+          while environment.now < self.end_time:
+            self.run_daemon()
+            if environment.shutdown_time is not None:
+              self.reboot()
+        finally:
+          if meteo_check_status.weewx_db is not None:
+            meteo_check_status.weewx_db.close()
+    finally:
+      if self.weewx is not None:
+        self.weewx.close()
+      shutil.rmtree(state_dir)
+    elapsed_time = time.perf_counter() - start_time
+
+    outages = []
+    for outage in self.outages:
+      if outage.kind == 'blip':
+        continue
+      outages.append({'kind': outage.kind,
+        'start_hours': round((outage.start_time - start_timestamp) / 3600, 3),
+        'detection_latency_minutes': None if outage.detection_time is None else
+          round((outage.detection_time - outage.start_time) / 60, 1),
+        'action_latency_minutes': None if outage.action_time is None else
+          round((outage.action_time - outage.start_time) / 60, 1),
+        'duration_hours': None if outage.end_time == math.inf else
+          round((min(outage.end_time, self.end_time) - outage.start_time) / 3600, 3)})
+    return({
+      'simulated_days': round((self.end_time - start_timestamp) / 86400, 3),
+      'elapsed_ms': round(elapsed_time * 1000, 1),
+      'reboots': self.reboots,
+      'false_reboots': sum(reboot['false_positive'] for reboot in self.reboots),
+      'remediation_commands': [{'time_hours': round((command_time - start_timestamp) / 3600, 3),
+        'command': command} for command_time, command in environment.commands
+        if 'shutdown' not in command],
+      'blips': sum(outage.kind == 'blip' for outage in self.outages),
+      'failed_checks': self.failed_checks,
+      'db_records': self.weewx.records,
+      'notifications': len(self.notifier.notices),
+      'outages': outages})
+
+def main():
+  parser = argparse.ArgumentParser(description='Simulates meteo_check_status.py behavior ' \
+    'over days of virtual time')
+  parser.add_argument('--days', dest='days', type=float, default=7,
+    help='Simulated time in days (default: %(default)s)')
+  parser.add_argument('--outage', dest='outages', action='append', type=Outage.parse,
+    metavar='KIND@START[+DURATION]', default=[],
+    help='Outage: network, station or blip, START and DURATION in hours, no DURATION means ' \
+    'until fixed. Can be specified multiple times')
+  parser.add_argument('--blips-per-day', dest='blips_per_day', type=float, default=0,
+    help='Average number of random short ping failures per day (default: %(default)s)')
+  parser.add_argument('--blip-minutes', dest='blip_minutes', type=float, default=2,
+    help='Short ping failure duration (default: %(default)s)')
+  parser.add_argument('--seed', dest='seed', type=int, default=0,
+    help='Random seed (default: %(default)s)')
+  parser.add_argument('-s', '--sleep-time', dest='sleep_time', type=int, default=300,
+    help='Sleep time between checks in seconds (default: %(default)d)')
+  parser.add_argument('--no-db-records-threshold', dest='no_db_records_threshold', type=int,
+    default=meteo_check_status.no_db_records_threshold,
+    help='DB data age threshold in minutes (default: %(default)d)')
+  parser.add_argument('--min-uptime', dest='min_uptime', type=int,
+    default=meteo_check_status.min_uptime_before_check,
+    help='Uptime before the first check in minutes (default: %(default)d)')
+  parser.add_argument('--recheck-interval', dest='recheck_interval', type=int,
+    default=meteo_check_status.recheck_interval,
+    help='Re-check interval in seconds (default: %(default)d)')
+  parser.add_argument('--recheck-budget', dest='recheck_budget', type=int,
+    default=meteo_check_status.recheck_budget,
+    help='Re-check budget in seconds (default: %(default)d)')
+  parser.add_argument('--remediation', dest='remediation_ladder', action='append',
+    choices=sorted(meteo_check_status.remediation_commands) + ['reboot'],
+    help='Remediation step, can be specified multiple times (default: reboot)')
+  parser.add_argument('-d', '--debug', dest='debug', action='store_true', default=False,
+    help='Output meteo_check_status log messages')
+  parser.add_argument('-o', '--output', dest='output', help='Output file (default: stdout)')
+  options = parser.parse_args()
+
+  if options.debug:
+    meteo_check_status.setup_logging(True)
+    meteo_check_status.logger.setLevel(logging.DEBUG)
+  else:
+    meteo_check_status.logger.setLevel(logging.CRITICAL)
+  simulation = Simulation(options.outages, options.days, options.sleep_time,
+    options.blips_per_day, options.blip_minutes, options.seed)
+  with patched_module({'no_db_records_threshold': options.no_db_records_threshold,
+      'min_uptime_before_check': options.min_uptime,
+      'recheck_interval': options.recheck_interval, 'recheck_budget': options.recheck_budget,
+      'remediation_ladder': options.remediation_ladder or ['reboot']}):
+    results = simulation.run()
+
+  output = json.dumps(results, indent=2)
+  if options.output:
+    with open(options.output, 'w') as f:
+      f.write(output + '\n')
+  else:
+    print(output)
+  return(0)
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -7,8 +7,18 @@ import sqlite3
 import contextlib
 import datetime
 import math
+import subprocess
+import time
+import socket
+import threading
+import struct
+import asyncio
+import signal
+import json
+import sys
 
 import meteo_check_status
+import simulate_meteo_check_status
 
 # Returns current time as unix timestamp, floored to integer
 # Optionally can add (or subtract) minutes to the result
@@ -28,6 +38,12 @@ class do_check_db_FunctionalTest(unittest.TestCase):
   def setUp(self):
     # Create a temporary directory
     self.test_dir = tempfile.mkdtemp()
+    # DB high-water marks are saved to the data file
+    data_file_patcher = mock.patch.object(meteo_check_status, 'data_file',
+      os.path.join(self.test_dir, 'data_file'))
+    data_file_patcher.start()
+    self.addCleanup(data_file_patcher.stop)
+    self.wind_rules = [meteo_check_status.DataRule('wind', 'windSpeed')]
 
   def tearDown(self):
     # Remove the directory after the test
@@ -98,6 +114,1127 @@ class do_check_db_FunctionalTest(unittest.TestCase):
     self.assertTrue(ret_val)
     mock_logger_error.assert_not_called()
 
+  def test_new_records_query_uses_primary_key(self, mock_logger_error, mock_logger_debug):
+    """It uses primary key search instead of full table scan to find new records"""
+    db_file_path = self.create_test_db('test5.sdb')
+    with contextlib.closing(sqlite3.connect(db_file_path)) as conn:
+      query, query_params = meteo_check_status.build_new_records_query([
+        meteo_check_status.DataRule('wind', 'windSpeed'),
+        meteo_check_status.DataRule('gust', 'windGust', 15, 0, 50)])
+      query_plan = conn.execute('EXPLAIN QUERY PLAN ' + query,
+        query_params + [now_as_timestamp(-15)]).fetchall()
+    plan_details = [plan_row[-1] for plan_row in query_plan]
+    self.assertEqual(len(plan_details), 1)
+    self.assertTrue(plan_details[0].startswith('SEARCH archive USING INTEGER PRIMARY KEY'),
+      plan_details[0])
+
+  def test_connection_is_reused(self, mock_logger_error, mock_logger_debug):
+    """It keeps DB connection open between checks"""
+    db_file_path = self.create_test_db('test6.sdb', ((now_as_timestamp(), 14.9, 15.1),))
+    weewx_db = meteo_check_status.WeewxDB(db_file_path, self.wind_rules)
+    try:
+      self.assertTrue(weewx_db.check())
+      conn = weewx_db.conn
+      self.assertTrue(weewx_db.check())
+      self.assertIs(weewx_db.conn, conn)
+      # Scheduled checks run in different threads
+      results = []
+      check_thread = threading.Thread(target=lambda: results.append(weewx_db.check()))
+      check_thread.start()
+      check_thread.join()
+      self.assertEqual(results, [True])
+      self.assertIs(weewx_db.conn, conn)
+    finally:
+      weewx_db.close()
+
+  def test_overlapping_checks_are_serialized(self, mock_logger_error, mock_logger_debug):
+    """It doesn't use the shared connection from two threads at once"""
+    db_file_path = self.create_test_db('test6a.sdb', ((now_as_timestamp(), 14.9, 15.1),))
+    weewx_db = meteo_check_status.WeewxDB(db_file_path, self.wind_rules)
+    update_marks = weewx_db.update_marks
+    active = []
+    overlaps = []
+    def slow_update_marks():
+      active.append(threading.current_thread())
+      if len(active) > 1:
+        overlaps.append(len(active))
+      time.sleep(0.05)
+      update_marks()
+      active.pop()
+    results = []
+    try:
+      with mock.patch.object(weewx_db, 'update_marks', side_effect=slow_update_marks):
+        # A scheduled check and a re-check of a failure
+        check_threads = [threading.Thread(target=lambda: results.append(weewx_db.check()))
+          for i in range(2)]
+        for check_thread in check_threads:
+          check_thread.start()
+        for check_thread in check_threads:
+          check_thread.join()
+      self.assertEqual(results, [True, True])
+      self.assertEqual(overlaps, [])
+    finally:
+      weewx_db.close()
+
+  def test_connection_is_read_only(self, mock_logger_error, mock_logger_debug):
+    """It opens DB file in read-only mode"""
+    db_file_path = self.create_test_db('test7.sdb')
+    weewx_db = meteo_check_status.WeewxDB(db_file_path, self.wind_rules)
+    try:
+      with self.assertRaises(sqlite3.OperationalError):
+        weewx_db.get_connection().execute('DELETE FROM archive')
+    finally:
+      weewx_db.close()
+
+  @mock.patch('meteo_check_status.logger.info')
+  def test_connection_is_reopened_if_file_is_replaced(self, mock_logger_info,
+      mock_logger_error, mock_logger_debug):
+    """It reopens DB connection if DB file has been replaced"""
+    db_file_path = self.create_test_db('test8.sdb')
+    weewx_db = meteo_check_status.WeewxDB(db_file_path, self.wind_rules)
+    try:
+      self.assertFalse(weewx_db.check())
+      conn = weewx_db.conn
+      new_db_file_path = self.create_test_db('test8_new.sdb', ((now_as_timestamp(), 14.9, 15.1),))
+      os.rename(new_db_file_path, db_file_path)
+      self.assertTrue(weewx_db.check())
+      self.assertIsNot(weewx_db.conn, conn)
+    finally:
+      weewx_db.close()
+
+  def add_records(self, db_file_path, data_records):
+    with contextlib.closing(sqlite3.connect(db_file_path)) as conn:
+      conn.executemany('INSERT INTO archive (dateTime, windSpeed, windGust) VALUES (?,?,?)', data_records)
+      conn.commit()
+
+  @mock.patch('meteo_check_status.logger.warning')
+  def test_high_water_marks_are_updated(self, mock_logger_warning, mock_logger_error,
+      mock_logger_debug):
+    """It reads only new records and reports how long wind data is missing"""
+    now = int(time.time())
+    db_file_path = self.create_test_db('test9.sdb', ((now - 600, 14.9, 15.1),))
+    weewx_db = meteo_check_status.WeewxDB(db_file_path, self.wind_rules)
+    try:
+      self.assertTrue(weewx_db.check())
+      self.assertEqual((weewx_db.last_record_time, weewx_db.last_valid_times), (now - 600, {'windSpeed:None:None': now - 600}))
+      self.add_records(db_file_path, ((now - 300, None, 15.1), (now, None, 15.6)))
+      self.assertTrue(weewx_db.check())
+      self.assertEqual((weewx_db.last_record_time, weewx_db.last_valid_times), (now, {'windSpeed:None:None': now - 600}))
+      # Records older than the mark are not read again
+      self.add_records(db_file_path, ((now - 400, 14.2, 15.1),))
+      with mock.patch('meteo_check_status.time.time', return_value=now + 900):
+        self.assertFalse(weewx_db.check())
+      self.assertEqual((weewx_db.last_record_time, weewx_db.last_valid_times), (now, {'windSpeed:None:None': now - 600}))
+      mock_logger_warning.assert_called_with('Last wind data record: {0} (0:25:00 ago)'.format(
+        datetime.datetime.fromtimestamp(now - 600)))
+      mock_logger_error.assert_called_with('No wind data for the last 15min in the Weewx DB file')
+    finally:
+      weewx_db.close()
+
+  def test_high_water_marks_survive_restart(self, mock_logger_error, mock_logger_debug):
+    """It restores high-water marks, saved by another instance for the same DB file"""
+    now = int(time.time())
+    db_file_path = self.create_test_db('test10.sdb', ((now - 60, 14.9, 15.1), (now, None, 15.6)))
+    weewx_db = meteo_check_status.WeewxDB(db_file_path, self.wind_rules)
+    try:
+      self.assertTrue(weewx_db.check())
+    finally:
+      weewx_db.close()
+
+    weewx_db = meteo_check_status.WeewxDB(db_file_path, self.wind_rules)
+    try:
+      weewx_db.get_connection()
+      self.assertEqual((weewx_db.last_record_time, weewx_db.last_valid_times), (now, {'windSpeed:None:None': now - 60}))
+    finally:
+      weewx_db.close()
+
+    # Marks are not used for a different DB file
+    other_db_file_path = self.create_test_db('test11.sdb')
+    weewx_db = meteo_check_status.WeewxDB(other_db_file_path, self.wind_rules)
+    try:
+      weewx_db.get_connection()
+      self.assertEqual((weewx_db.last_record_time, weewx_db.last_valid_times), (None, {}))
+    finally:
+      weewx_db.close()
+
+  @mock.patch('meteo_check_status.logger.warning')
+  def test_data_rules(self, mock_logger_warning, mock_logger_error, mock_logger_debug):
+    """It evaluates all data rules and fails if any of them fails"""
+    now = int(time.time())
+    db_file_path = self.create_test_db('test12.sdb', (
+        (now - 1200, 14.9, 15.1),
+        (now - 600,  None, 15.6),
+        (now - 60,   14.2, 65.3)
+      ))
+    rules = [meteo_check_status.DataRule('wind', 'windSpeed'),
+      meteo_check_status.DataRule.parse('gust=windGust:5:0:50'),
+      meteo_check_status.DataRule.parse('windGust:30:0:50')]
+    weewx_db = meteo_check_status.WeewxDB(db_file_path, rules)
+    try:
+      self.assertFalse(weewx_db.check())
+      report = weewx_db.evaluate_rules(now)
+    finally:
+      weewx_db.close()
+    self.assertEqual([(rule.name, last_valid_time, passed) for rule, last_valid_time, passed in report], [
+      ('wind', now - 60, True), ('gust', now - 600, False), ('windGust', now - 600, True)])
+    mock_logger_error.assert_called_once_with('No gust data for the last 5min in the Weewx DB file')
+
+  @mock.patch('meteo_check_status.wind_anomaly_action', 'fail')
+  def test_wind_anomaly_fails_check(self, mock_logger_error, mock_logger_debug):
+    """It fails the check on stuck wind speed, updating the window incrementally"""
+    start_time = int(time.time()) - 120 * 60
+    db_file_path = self.create_test_db('test15.sdb', [(start_time + minute * 60, 3.0 + minute % 2, 5.0)
+      for minute in range(60)])
+    weewx_db = meteo_check_status.WeewxDB(db_file_path, self.wind_rules)
+    try:
+      with mock.patch('meteo_check_status.time.time', return_value=start_time + 60 * 60):
+        self.assertTrue(weewx_db.check())
+      self.add_records(db_file_path, [(start_time + minute * 60, 3.4, 5.0) for minute in range(60, 121)])
+      self.assertFalse(weewx_db.check())
+      self.assertEqual(weewx_db.wind_window.count, 121)
+    finally:
+      weewx_db.close()
+    mock_logger_error.assert_called_once_with('Wind data anomaly: wind speed has been stuck at 3.4 for 60min')
+
+  def test_data_rule_unknown_column(self, mock_logger_error, mock_logger_debug):
+    """It raises an error if data rule column doesn't exist"""
+    db_file_path = self.create_test_db('test13.sdb', ((now_as_timestamp(), 14.9, 15.1),))
+    weewx_db = meteo_check_status.WeewxDB(db_file_path, [meteo_check_status.DataRule.parse('outTemp')])
+    try:
+      with self.assertRaises(ValueError):
+        weewx_db.check()
+    finally:
+      weewx_db.close()
+
+  def test_data_rule_parse(self, mock_logger_error, mock_logger_debug):
+    """It parses data rule specification"""
+    rule = meteo_check_status.DataRule.parse('barometer::900:')
+    self.assertEqual((rule.name, rule.column, rule.max_age, rule.min_value, rule.max_value),
+      ('barometer', 'barometer', None, 900.0, None))
+    self.assertEqual(rule.get_max_age(), 15)
+    rule = meteo_check_status.DataRule.parse('temp=outTemp:30:-50:60')
+    self.assertEqual((rule.name, rule.column, rule.max_age, rule.min_value, rule.max_value),
+      ('temp', 'outTemp', 30, -50.0, 60.0))
+    with self.assertRaises(ValueError):
+      meteo_check_status.DataRule.parse('outTemp" OR 1')
+
+  def test_watch_mode_skips_unchanged_db(self, mock_logger_error, mock_logger_debug):
+    """It queries the DB in watch mode only if DB files have changed"""
+    now = int(time.time())
+    db_file_path = self.create_test_db('test14.sdb', ((now - 60, 14.9, 15.1),))
+    weewx_db = meteo_check_status.WeewxDB(db_file_path, self.wind_rules, watch=True)
+    archive_queries = []
+    try:
+      weewx_db.get_connection().set_trace_callback(
+        lambda statement: 'FROM archive' in statement and archive_queries.append(statement))
+      # New records query and wind window update
+      self.assertTrue(weewx_db.check())
+      self.assertTrue(weewx_db.check())
+      self.assertEqual(len(archive_queries), 2)
+      self.add_records(db_file_path, ((now, 14.2, 15.6),))
+      self.assertTrue(weewx_db.check())
+      self.assertEqual(len(archive_queries), 4)
+      self.assertEqual(weewx_db.last_record_time, now)
+      self.assertEqual(weewx_db.get_expiry_time(), now + 15 * 60 + 1)
+    finally:
+      weewx_db.close()
+
+class WindWindow_UnitTest(unittest.TestCase):
+  """Unit tests for 'WindWindow' class"""
+
+  def fill(self, window, speeds, gusts=None, start_time=100000):
+    for index, speed in enumerate(speeds):
+      if gusts is None:
+        gust = None if speed is None else speed + 1
+      else:
+        gust = gusts[index]
+      window.add_record(start_time + index * 60, speed, gust)
+
+  def test_ring_buffer_statistics(self):
+    """It keeps statistics of the last records only"""
+    window = meteo_check_status.WindWindow(4)
+    self.fill(window, [1.0, 2.0, None, 3.0, 5.0, 8.0])
+    self.assertEqual(window.count, 4)
+    self.assertEqual((window.speed_count, window.speed_sum, window.speed_sum_squares), (3, 16.0, 98.0))
+    self.assertAlmostEqual(window.get_variance(), 98.0 / 3 - (16.0 / 3) ** 2)
+    self.assertEqual(window.last_time, 100000 + 5 * 60)
+    self.assertEqual(window.get_anomalies(), [])
+
+  @mock.patch('meteo_check_status.wind_stuck_minutes', 60)
+  @mock.patch('meteo_check_status.wind_calm_stuck_minutes', 360)
+  def test_stuck_speed(self):
+    """It detects speed, that hasn't changed for too long"""
+    window = meteo_check_status.WindWindow(180)
+    self.fill(window, [2.0, 3.0] + [4.2] * 30 + [None] * 10 + [4.2] * 21)
+    self.assertEqual(window.get_anomalies(), ['wind speed has been stuck at 4.2 for 60min'])
+    # Calm can last longer
+    window = meteo_check_status.WindWindow(180)
+    self.fill(window, [2.0] + [0.0] * 120)
+    self.assertEqual(window.get_anomalies(), [])
+
+  @mock.patch('meteo_check_status.wind_min_variance', 0.01)
+  def test_variance_collapse(self):
+    """It detects speed, that barely changes"""
+    window = meteo_check_status.WindWindow(20)
+    self.fill(window, [2.0, 2.1] * 10)
+    self.assertEqual(window.get_anomalies(), ['wind speed variance has collapsed to 0.0025 ' \
+      'over the last 20 records'])
+    self.fill(window, [2.0, 3.0], start_time=200000)
+    self.assertEqual(window.get_anomalies(), [])
+
+  @mock.patch('meteo_check_status.wind_max_gust_violations', 3)
+  def test_gust_less_than_speed(self):
+    """It detects records with gust less than speed"""
+    window = meteo_check_status.WindWindow(10)
+    speeds = [2.0, 3.0, 4.0, 5.0, 6.0]
+    self.fill(window, speeds, [2.5, 2.0, 3.0, 5.5, None])
+    self.assertEqual(window.get_anomalies(), [])
+    self.fill(window, speeds, [1.0, 4.0, 3.0, 5.5, 7.0], start_time=200000)
+    self.assertEqual(window.get_anomalies(), ['wind gust is less than speed in 4 of the last 10 records'])
+
+class DBChangeWatcher_FunctionalTest(unittest.TestCase):
+  """Functional tests for 'DBChangeWatcher' class"""
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp()
+    self.db_file_path = os.path.join(self.test_dir, 'weewx.sdb')
+    with contextlib.closing(sqlite3.connect(self.db_file_path)) as conn:
+      conn.execute('CREATE TABLE archive (`dateTime` INTEGER NOT NULL UNIQUE PRIMARY KEY, `windSpeed` REAL)')
+    self.watcher = meteo_check_status.DBChangeWatcher(self.db_file_path)
+
+  def tearDown(self):
+    self.watcher.close()
+    shutil.rmtree(self.test_dir)
+
+  def add_record(self):
+    with contextlib.closing(sqlite3.connect(self.db_file_path)) as conn:
+      conn.execute('INSERT INTO archive (dateTime, windSpeed) VALUES (?, 1)', (int(time.time() * 1000),))
+      conn.commit()
+
+  def test_stat_changes(self):
+    """It detects DB file changes by file size and modification time"""
+    self.assertTrue(self.watcher.changed())
+    self.assertFalse(self.watcher.changed())
+    self.add_record()
+    self.assertTrue(self.watcher.changed())
+    self.assertFalse(self.watcher.changed())
+
+  @mock.patch('meteo_check_status.logger')
+  def test_inotify_events(self, mock_logger):
+    """It reports inotify events for the DB files only"""
+    if self.watcher.start_inotify() is None:
+      self.skipTest('inotify is not available')
+    self.assertFalse(self.watcher.read_inotify_events())
+    with open(os.path.join(self.test_dir, 'other_file'), 'w') as f:
+      f.write('data')
+    self.assertFalse(self.watcher.read_inotify_events())
+    self.add_record()
+    self.assertTrue(self.watcher.read_inotify_events())
+    self.assertFalse(self.watcher.read_inotify_events())
+
+@mock.patch('meteo_check_status.logger')
+class DBSnapshot_FunctionalTest(unittest.TestCase):
+  """Functional tests for 'DBSnapshot' class and snapshot read mode"""
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.test_dir)
+    self.snapshot_dir = os.path.join(self.test_dir, 'shm')
+    os.mkdir(self.snapshot_dir)
+    for name, value in (('db_snapshot_dir', self.snapshot_dir), ('db_snapshot_pages', 1),
+        ('db_snapshot_step_pause', 0), ('data_file', os.path.join(self.test_dir, 'data_file'))):
+      patcher = mock.patch.object(meteo_check_status, name, value)
+      patcher.start()
+      self.addCleanup(patcher.stop)
+    self.db_file_path = os.path.join(self.test_dir, 'weewx.sdb')
+    with contextlib.closing(sqlite3.connect(self.db_file_path)) as conn:
+      conn.execute('CREATE TABLE archive (`dateTime` INTEGER NOT NULL UNIQUE PRIMARY KEY, ' \
+        '`windSpeed` REAL, `data` BLOB)')
+      # Make the DB several pages large, so that the backup takes several steps
+      for record_time in range(now_as_timestamp(-100), now_as_timestamp(-50), 60):
+        conn.execute('INSERT INTO archive VALUES (?, 1, ?)', (record_time, b'x' * 2000))
+      conn.commit()
+
+  def add_record(self, record_time, conn_timeout=5.0):
+    with contextlib.closing(sqlite3.connect(self.db_file_path, timeout=conn_timeout)) as conn:
+      conn.execute('INSERT INTO archive (dateTime, windSpeed) VALUES (?, 2)', (record_time,))
+      conn.commit()
+
+  def count_snapshot_records(self, snapshot):
+    with contextlib.closing(sqlite3.connect(snapshot.snapshot_file)) as conn:
+      return(conn.execute('SELECT count(*) FROM archive').fetchone()[0])
+
+  def test_refresh(self, mock_logger):
+    """It copies the DB only if it has changed"""
+    snapshot = meteo_check_status.DBSnapshot(self.db_file_path, self.snapshot_dir)
+    self.assertEqual(os.path.dirname(snapshot.snapshot_file), self.snapshot_dir)
+    self.assertTrue(snapshot.refresh())
+    self.assertEqual(self.count_snapshot_records(snapshot), 50)
+    self.assertFalse(snapshot.refresh())
+    self.add_record(now_as_timestamp())
+    self.assertTrue(snapshot.refresh())
+    self.assertEqual(self.count_snapshot_records(snapshot), 51)
+    snapshot.remove()
+    self.assertFalse(os.path.exists(snapshot.snapshot_file))
+
+  def test_writes_are_not_blocked(self, mock_logger):
+    """Weewx can write to the DB between backup steps, then the backup restarts"""
+    snapshot = meteo_check_status.DBSnapshot(self.db_file_path, self.snapshot_dir)
+    writes = []
+    def write_during_backup(seconds):
+      if not(writes):
+        # No busy timeout: the write fails if the DB is locked
+        self.add_record(now_as_timestamp(), conn_timeout=0)
+        writes.append(True)
+    with mock.patch('meteo_check_status.time.sleep', side_effect=write_during_backup):
+      snapshot.refresh()
+    self.assertEqual(writes, [True])
+    self.assertEqual(self.count_snapshot_records(snapshot), 51)
+
+  @mock.patch('meteo_check_status.db_snapshot_window', 10)
+  def test_recent_snapshot(self, mock_logger):
+    """It copies only new records and keeps only the recent ones"""
+    snapshot = meteo_check_status.RecentDBSnapshot(self.db_file_path, self.snapshot_dir)
+    self.addCleanup(snapshot.remove)
+    self.assertTrue(snapshot.refresh())
+    # The newest record and the ones within 10 minutes before it
+    self.assertEqual(self.count_snapshot_records(snapshot), 11)
+    self.assertFalse(snapshot.refresh())
+    self.add_record(now_as_timestamp())
+    self.assertTrue(snapshot.refresh())
+    self.assertTrue(mock_logger.debug.call_args[0][0].startswith('Weewx DB snapshot {0} has ' \
+      'been updated with 1 records'.format(snapshot.snapshot_file)))
+    # Records, that are older than 10 minutes before the new one, are dropped
+    self.assertEqual(self.count_snapshot_records(snapshot), 1)
+
+  def test_recent_snapshot_schema_change(self, mock_logger):
+    """It re-creates the snapshot if the archive table has been changed"""
+    snapshot = meteo_check_status.RecentDBSnapshot(self.db_file_path, self.snapshot_dir)
+    self.addCleanup(snapshot.remove)
+    snapshot.refresh()
+    with contextlib.closing(sqlite3.connect(self.db_file_path)) as conn:
+      conn.execute('ALTER TABLE archive ADD COLUMN `outTemp` REAL')
+    record_time = now_as_timestamp()
+    self.add_record(record_time)
+    self.assertTrue(snapshot.refresh())
+    with contextlib.closing(sqlite3.connect(snapshot.snapshot_file)) as conn:
+      self.assertEqual(conn.execute('SELECT dateTime, windSpeed, outTemp FROM archive ' \
+        'ORDER BY dateTime DESC LIMIT 1').fetchone(), (record_time, 2, None))
+
+  def test_read_modes(self, mock_logger):
+    """Snapshot is used in 'auto' mode unless the DB is in WAL mode"""
+    rules = [meteo_check_status.DataRule('wind', 'windSpeed')]
+    self.add_record(now_as_timestamp(-1))
+    weewx_db = meteo_check_status.WeewxDB(self.db_file_path, rules, read_mode='auto')
+    self.assertTrue(weewx_db.check())
+    self.assertIsNotNone(weewx_db.snapshot)
+    self.assertTrue(os.path.isfile(weewx_db.snapshot.snapshot_file))
+    snapshot_file = weewx_db.snapshot.snapshot_file
+    weewx_db.close()
+    self.assertFalse(os.path.exists(snapshot_file))
+
+    with contextlib.closing(sqlite3.connect(self.db_file_path)) as conn:
+      conn.execute('PRAGMA journal_mode=WAL')
+    self.assertTrue(meteo_check_status.is_wal_db(self.db_file_path))
+    weewx_db = meteo_check_status.WeewxDB(self.db_file_path, rules, read_mode='auto')
+    self.assertTrue(weewx_db.check())
+    self.assertIsNone(weewx_db.snapshot)
+    weewx_db.close()
+
+  def test_snapshot_check_sees_new_records(self, mock_logger):
+    """Snapshot is refreshed before each DB query"""
+    rules = [meteo_check_status.DataRule('wind', 'windSpeed')]
+    weewx_db = meteo_check_status.WeewxDB(self.db_file_path, rules, read_mode='snapshot')
+    self.addCleanup(weewx_db.close)
+    self.assertFalse(weewx_db.check())
+    self.add_record(now_as_timestamp(-1))
+    self.assertTrue(weewx_db.check())
+
+  def test_snapshot_removed(self, mock_logger):
+    """Connection is reopened if the snapshot file has been removed"""
+    rules = [meteo_check_status.DataRule('wind', 'windSpeed')]
+    weewx_db = meteo_check_status.WeewxDB(self.db_file_path, rules, read_mode='snapshot')
+    self.addCleanup(weewx_db.close)
+    self.add_record(now_as_timestamp(-2))
+    self.assertTrue(weewx_db.check())
+    os.remove(weewx_db.snapshot.snapshot_file)
+    record_time = now_as_timestamp(-1)
+    self.add_record(record_time)
+    self.assertTrue(weewx_db.check())
+    self.assertEqual(weewx_db.last_record_time, record_time)
+    self.assertTrue(os.path.isfile(weewx_db.snapshot.snapshot_file))
+
+  def test_report_and_checks(self, mock_logger):
+    """Report and checks of the same DB use separate snapshots"""
+    with contextlib.closing(sqlite3.connect(self.db_file_path)) as conn:
+      conn.execute('ALTER TABLE archive ADD COLUMN `interval` INTEGER')
+    rules = [meteo_check_status.DataRule('wind', 'windSpeed')]
+    weewx_db = meteo_check_status.WeewxDB(self.db_file_path, rules, read_mode='snapshot')
+    self.addCleanup(weewx_db.close)
+    self.add_record(now_as_timestamp(-3))
+    self.assertTrue(weewx_db.check())
+    snapshot_file = weewx_db.snapshot.snapshot_file
+
+    output_file = os.path.join(self.test_dir, 'report')
+    with mock.patch.object(sys, 'argv', ['meteo_check_status.py', '--db-read-mode', 'snapshot',
+        '--db-snapshot-dir', self.snapshot_dir, 'report', '--db-file', self.db_file_path,
+        '--column', 'windSpeed', '--record-interval', '1', '--format', 'json', '-o',
+        output_file]), mock.patch('meteo_check_status.setup_logging'), \
+        mock.patch('meteo_check_status.db_read_mode', 'snapshot'):
+      self.assertEqual(meteo_check_status.main(), 0)
+    with open(output_file) as f:
+      self.assertEqual(sum(day['records'] for day in json.load(f)['daily']), 51)
+    # The report has removed its own snapshot only
+    self.assertEqual(os.listdir(self.snapshot_dir), [os.path.basename(snapshot_file)])
+    record_time = now_as_timestamp(-2)
+    self.add_record(record_time)
+    self.assertTrue(weewx_db.check())
+    self.assertEqual(weewx_db.last_record_time, record_time)
+
+    # The daemon doesn't remove the snapshot of a running report
+    report_snapshot = meteo_check_status.DBSnapshot(self.db_file_path, self.snapshot_dir)
+    self.addCleanup(report_snapshot.remove)
+    report_snapshot.refresh()
+    self.assertNotEqual(report_snapshot.snapshot_file, snapshot_file)
+    self.add_record(now_as_timestamp(-1))
+    self.assertTrue(weewx_db.check())
+    weewx_db.close()
+    self.assertEqual(os.listdir(self.snapshot_dir), [os.path.basename(
+      report_snapshot.snapshot_file)])
+    self.assertEqual(self.count_snapshot_records(report_snapshot), 52)
+
+# Fake ping processes: target name is "<exit code>:<run time in seconds>"
+real_popen = subprocess.Popen
+fake_ping_subprocs = []
+def fake_ping_popen(args, **kwargs):
+  return_code, run_time = args[-1].split(':')
+  if return_code == '0':
+    fake_args = ['sleep', run_time]
+  else:
+    fake_args = ['sh', '-c', 'sleep {0}; exit {1}'.format(run_time, return_code)]
+  fake_ping_subprocs.append(real_popen(fake_args, **kwargs))
+  return(fake_ping_subprocs[-1])
+
+@mock.patch('meteo_check_status.logger')
+@mock.patch('meteo_check_status.subprocess.Popen', side_effect=fake_ping_popen)
+class do_ping_FunctionalTest(unittest.TestCase):
+  """Functional tests for 'do_ping' function"""
+
+  def setUp(self):
+    del fake_ping_subprocs[:]
+
+  def run_ping(self, ping_targets, ping_deadline=10):
+    with mock.patch.multiple(meteo_check_status, ping_targets=ping_targets,
+        ping_backend='subprocess'):
+      with mock.patch.object(meteo_check_status, 'ping_deadline', ping_deadline):
+        start_time = time.monotonic()
+        ret_val = meteo_check_status.do_ping()
+    return(ret_val, time.monotonic() - start_time)
+
+  def test_returns_on_first_success(self, mock_popen, mock_logger):
+    """It returns True as soon as one of the targets succeeds and kills the rest"""
+    ret_val, elapsed = self.run_ping(['1:0', '0:0.2', '0:30'])
+    self.assertTrue(ret_val)
+    self.assertLess(elapsed, 5)
+    self.assertEqual(mock_popen.call_count, 3)
+    # Slow target's process has been killed
+    self.assertNotEqual(fake_ping_subprocs[2].wait(), 0)
+    mock_logger.error.assert_not_called()
+
+  def test_all_targets_fail(self, mock_popen, mock_logger):
+    """It logs an error and returns False if all the targets have failed"""
+    ret_val, elapsed = self.run_ping(['1:0', '2:0.1'])
+    self.assertFalse(ret_val)
+    self.assertEqual(mock_logger.warning.call_count, 2)
+    mock_logger.error.assert_called_with('All ping attempts have failed')
+
+  def test_deadline_expires(self, mock_popen, mock_logger):
+    """It returns False when the deadline expires before any target succeeds"""
+    ret_val, elapsed = self.run_ping(['1:0', '0:30'], ping_deadline=1)
+    self.assertFalse(ret_val)
+    self.assertLess(elapsed, 5)
+    mock_logger.warning.assert_called_with('Ping deadline (1s) has expired')
+    mock_logger.error.assert_called_with('All ping attempts have failed')
+
+# Local stand-in for a DNS server: replies to every query with the same ID and
+# "response" flag set
+class FakeDNSServer(object):
+  def __init__(self):
+    self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    self.sock.bind(('127.0.0.1', 0))
+    self.port = self.sock.getsockname()[1]
+    self.thread = threading.Thread(target=self.serve)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def serve(self):
+    while True:
+      try:
+        query, address = self.sock.recvfrom(512)
+      except OSError:
+        return
+      self.sock.sendto(query[:2] + struct.pack('!H', 0x8180) + query[4:], address)
+
+  def close(self):
+    self.sock.close()
+
+@mock.patch('meteo_check_status.logger')
+class run_native_probes_FunctionalTest(unittest.TestCase):
+  """Functional tests for 'run_native_probes' function"""
+
+  def setUp(self):
+    self.tcp_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.tcp_server.bind(('127.0.0.1', 0))
+    self.tcp_server.listen(5)
+    self.tcp_port = self.tcp_server.getsockname()[1]
+    # Bind and close a socket to get a port nobody listens on
+    with contextlib.closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as closed_socket:
+      closed_socket.bind(('127.0.0.1', 0))
+      self.closed_port = closed_socket.getsockname()[1]
+    self.dns_server = FakeDNSServer()
+
+  def tearDown(self):
+    self.tcp_server.close()
+    self.dns_server.close()
+
+  def test_tcp_probe_succeeds(self, mock_logger):
+    """It returns True if TCP connection is established"""
+    self.assertTrue(meteo_check_status.run_native_probes(
+      ['tcp:127.0.0.1:{0}'.format(self.tcp_port)], 5))
+
+  def test_tcp_probe_fails(self, mock_logger):
+    """It returns False if TCP connection is refused"""
+    target = 'tcp:127.0.0.1:{0}'.format(self.closed_port)
+    self.assertFalse(meteo_check_status.run_native_probes([target], 5))
+    mock_logger.warning.assert_called_with('{0}: ping attempt has failed'.format(target))
+
+  def test_dns_probe_succeeds(self, mock_logger):
+    """It returns True if DNS server replies to the query"""
+    self.assertTrue(meteo_check_status.run_native_probes(
+      ['dns:127.0.0.1:{0}'.format(self.dns_server.port)], 5))
+
+  def test_dns_probe_deadline_expires(self, mock_logger):
+    """It returns False if DNS server doesn't reply before the deadline"""
+    self.dns_server.close()
+    silent_server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    silent_server.bind(('127.0.0.1', 0))
+    try:
+      self.assertFalse(meteo_check_status.run_native_probes(
+        ['dns:127.0.0.1:{0}'.format(silent_server.getsockname()[1])], 0.5))
+    finally:
+      silent_server.close()
+    mock_logger.warning.assert_called_with('Ping deadline (0.5s) has expired')
+
+  def test_first_success_wins(self, mock_logger):
+    """It returns True if any of the targets succeeds"""
+    self.assertTrue(meteo_check_status.run_native_probes([
+      'tcp:127.0.0.1:{0}'.format(self.closed_port),
+      'dns:127.0.0.1:{0}'.format(self.dns_server.port)], 5))
+
+  def slow_getaddrinfo(self, host, *args):
+    # Name resolution of "slow" hosts hangs until the test ends
+    if host.startswith('slow'):
+      self.resolution_released.wait()
+      raise socket.gaierror(socket.EAI_AGAIN, 'Temporary failure in name resolution')
+    return(self.getaddrinfo(host, *args))
+
+  def mock_slow_resolution(self):
+    self.getaddrinfo = socket.getaddrinfo
+    self.resolution_released = threading.Event()
+    self.addCleanup(self.resolution_released.set)
+    patcher = mock.patch('socket.getaddrinfo', side_effect=self.slow_getaddrinfo)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+
+  def test_slow_resolution_does_not_delay_other_probes(self, mock_logger):
+    """It starts each probe as soon as its own host name is resolved"""
+    self.mock_slow_resolution()
+    start_time = time.monotonic()
+    self.assertTrue(meteo_check_status.run_native_probes(['tcp:slow1:80', 'dns:slow2',
+      'tcp:127.0.0.1:{0}'.format(self.tcp_port)], 5))
+    self.assertLess(time.monotonic() - start_time, 1)
+
+  def test_slow_resolution_is_limited_by_deadline(self, mock_logger):
+    """It doesn't wait for host name resolution beyond the deadline"""
+    self.mock_slow_resolution()
+    start_time = time.monotonic()
+    self.assertFalse(meteo_check_status.run_native_probes(['tcp:slow1:80', 'slow2', 'slow3'], 0.5))
+    self.assertLess(time.monotonic() - start_time, 1)
+    mock_logger.warning.assert_called_with('Ping deadline (0.5s) has expired')
+
+  def test_resolution_failure(self, mock_logger):
+    """It fails the probe, whose host name can't be resolved"""
+    self.mock_slow_resolution()
+    self.resolution_released.set()
+    self.assertFalse(meteo_check_status.run_native_probes(['tcp:slow1:80'], 5))
+    mock_logger.warning.assert_called_with('tcp:slow1:80: probe has failed: '
+      '[Errno {0}] Temporary failure in name resolution'.format(socket.EAI_AGAIN))
+
+  @mock.patch('meteo_check_status.ICMPProbe.resolve')
+  @mock.patch('meteo_check_status.ICMPProbe.start', side_effect=PermissionError)
+  @mock.patch('meteo_check_status.subprocess.Popen', side_effect=fake_ping_popen)
+  def test_icmp_falls_back_to_subprocess(self, mock_popen, mock_icmp_start, mock_icmp_resolve,
+      mock_logger):
+    """It uses ping subprocess if ICMP socket is not permitted"""
+    self.assertTrue(meteo_check_status.run_native_probes(['0:0.1'], 5))
+    self.assertEqual(mock_popen.call_args[0][0][-1], '0:0.1')
+    self.assertFalse(meteo_check_status.run_native_probes(['1:0.1'], 5))
+
+@mock.patch('meteo_check_status.logger')
+@mock.patch('meteo_check_status.check_is_allowed', return_value=True)
+@mock.patch('meteo_check_status.process_check_result', return_value=False)
+class CheckScheduler_FunctionalTest(unittest.TestCase):
+  """Functional tests for 'CheckScheduler' class"""
+
+  def setUp(self):
+    self.loop = asyncio.new_event_loop()
+    self.call_counts = {}
+
+  def tearDown(self):
+    self.loop.close()
+
+  def make_check(self, name, interval, run_time=0, result=True, timeout=None):
+    self.call_counts[name] = 0
+    def check_func():
+      self.call_counts[name] += 1
+      time.sleep(run_time)
+      return(result)
+    return(meteo_check_status.ScheduledCheck(name, check_func, interval, timeout=timeout))
+
+  def run_scheduler(self, checks, run_time):
+    scheduler = meteo_check_status.CheckScheduler(self.loop, checks)
+    self.loop.call_later(run_time, scheduler.stop)
+    self.loop.run_until_complete(scheduler.run())
+
+  def test_checks_run_on_own_intervals(self, mock_process_check_result,
+      mock_check_is_allowed, mock_logger):
+    """It runs each check on its own interval"""
+    self.run_scheduler([self.make_check('fast', 0.1), self.make_check('slow', 0.5)], 0.95)
+    self.assertIn(self.call_counts['fast'], (9, 10, 11))
+    self.assertEqual(self.call_counts['slow'], 2)
+    mock_process_check_result.assert_called_with(True)
+
+  def test_check_duration_does_not_cause_drift(self, mock_process_check_result,
+      mock_check_is_allowed, mock_logger):
+    """It schedules runs from the start time, not from the end of the previous run"""
+    self.run_scheduler([self.make_check('check', 0.2, run_time=0.1)], 0.95)
+    self.assertEqual(self.call_counts['check'], 5)
+
+  def test_hung_check_does_not_stall_others(self, mock_process_check_result,
+      mock_check_is_allowed, mock_logger):
+    """It fails a check that exceeds its timeout without delaying other checks"""
+    self.run_scheduler([self.make_check('hung', 10, run_time=2, timeout=0.1),
+      self.make_check('fast', 0.1)], 0.95)
+    self.assertEqual(self.call_counts['hung'], 1)
+    self.assertIn(self.call_counts['fast'], (9, 10, 11))
+    mock_logger.error.assert_called_with('hung check has timed out (0.1s)')
+    mock_process_check_result.assert_called_with(False)
+
+  def test_checks_stop_after_reboot(self, mock_process_check_result,
+      mock_check_is_allowed, mock_logger):
+    """It stops running checks when reboot has been initiated"""
+    mock_process_check_result.return_value = True
+    self.run_scheduler([self.make_check('check', 0.1, result=False)], 0.5)
+    self.assertEqual(self.call_counts['check'], 1)
+    mock_process_check_result.assert_called_once_with(False)
+
+  def test_check_exception_stops_scheduler(self, mock_process_check_result,
+      mock_check_is_allowed, mock_logger):
+    """It stops and re-raises unexpected check exceptions"""
+    def failing_check():
+      raise sqlite3.OperationalError('database is locked')
+    checks = [meteo_check_status.ScheduledCheck('failing', failing_check, 0.1)]
+    with self.assertRaises(sqlite3.OperationalError):
+      self.run_scheduler(checks, 5)
+
+  @mock.patch('meteo_check_status.trigger_delay', 0)
+  def test_triggered_check_runs_early(self, mock_process_check_result,
+      mock_check_is_allowed, mock_logger):
+    """It runs triggered check immediately without shifting its schedule"""
+    check = self.make_check('check', 0.4)
+    check.triggered = True
+    scheduler = meteo_check_status.CheckScheduler(self.loop, [check])
+    self.loop.call_later(0.1, scheduler.trigger_check, check)
+    self.loop.call_later(0.2, scheduler.trigger_check, check)
+    self.loop.call_later(0.6, scheduler.stop)
+    self.loop.run_until_complete(scheduler.run())
+    # Runs at 0, 0.1, 0.2 (triggered) and 0.4 (scheduled)
+    self.assertEqual(self.call_counts['check'], 4)
+
+  def test_deadline_wakes_check_up(self, mock_process_check_result,
+      mock_check_is_allowed, mock_logger):
+    """It runs the check at the time returned by deadline function"""
+    check = self.make_check('check', 10)
+    deadline = time.time() + 0.3
+    check.deadline_func = lambda: deadline
+    self.run_scheduler([check], 0.5)
+    self.assertEqual(self.call_counts['check'], 2)
+
+  def test_signal_handler_stops_scheduler(self, mock_process_check_result,
+      mock_check_is_allowed, mock_logger):
+    """It stops active scheduler on signal instead of exiting"""
+    scheduler = meteo_check_status.CheckScheduler(self.loop, [self.make_check('check', 0.1)])
+    with mock.patch.object(meteo_check_status, 'active_scheduler', scheduler):
+      self.loop.call_later(0.25, meteo_check_status.signal_handler, signal.SIGTERM)
+      self.loop.run_until_complete(scheduler.run())
+    self.assertEqual(self.call_counts['check'], 3)
+    mock_logger.info.assert_called_with('Caught signal {0} (SIGTERM), exiting'.format(signal.SIGTERM))
+
+  def test_workers_limit_and_independent_checks(self, mock_process_check_result,
+      mock_check_is_allowed, mock_logger):
+    """It runs no more than max_workers checks at once and keeps independent results apart"""
+    running = [0, 0]
+    lock = threading.Lock()
+    def check_func():
+      with lock:
+        running[0] += 1
+        running[1] = max(running)
+      time.sleep(0.1)
+      with lock:
+        running[0] -= 1
+      return(False)
+    checks = [meteo_check_status.ScheduledCheck('station {0}'.format(i), check_func, 10,
+      independent=True) for i in range(6)]
+    scheduler = meteo_check_status.CheckScheduler(self.loop, checks, max_workers=2)
+    self.loop.call_later(0.45, scheduler.stop)
+    self.loop.run_until_complete(scheduler.run())
+    self.assertEqual(running[1], 2)
+    mock_process_check_result.assert_not_called()
+
+  def test_failed_dependency_skips_check(self, mock_process_check_result,
+      mock_check_is_allowed, mock_logger):
+    """It skips a check while its dependency is failing and ignores it in the result"""
+    ping = self.make_check('ping', 0.2, result=False)
+    upload = self.make_check('upload', 0.2)
+    upload.depends_on = ['ping']
+    self.run_scheduler([ping, upload], 0.3)
+    self.assertEqual(self.call_counts['upload'], 0)
+    mock_logger.info.assert_any_call('upload check is skipped: ping check has not passed')
+    mock_process_check_result.assert_called_with(False)
+
+@mock.patch('meteo_check_status.logger')
+@mock.patch('meteo_check_status.send_mail_to_root')
+class Fleet_FunctionalTest(unittest.TestCase):
+  """Functional tests for fleet mode ('Station' class and 'read_fleet_config' function)"""
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.test_dir)
+
+  def create_station_db(self, name, records_age):
+    db_file = os.path.join(self.test_dir, name + '.sdb')
+    with contextlib.closing(sqlite3.connect(db_file)) as conn:
+      conn.execute('CREATE TABLE archive (`dateTime` INTEGER NOT NULL UNIQUE PRIMARY KEY, `windSpeed` REAL)')
+      conn.execute('INSERT INTO archive VALUES (?, ?)', (now_as_timestamp(-records_age), 1.0))
+      conn.commit()
+    return(db_file)
+
+  def write_config(self, text):
+    config_file = os.path.join(self.test_dir, 'fleet.conf')
+    with open(config_file, 'w') as f:
+      f.write(text)
+    return(config_file)
+
+  def test_read_config(self, mock_send_mail_to_root, mock_logger):
+    """It reads stations with their own settings and defaults"""
+    config_file = self.write_config('[fleet]\nworkers = 2\n\n'
+      '[station:a]\ndb_file = /mnt/a/weewx.sdb\ndata_rules = wind=windSpeed, outTemp:30\n'
+      'action = reboot\n\n'
+      '[station:b]\ndb_file = /mnt/b/weewx.sdb\ndata_file = {0}/b.data\n'.format(self.test_dir))
+    workers, stations = meteo_check_status.read_fleet_config(config_file)
+    self.assertEqual(workers, 2)
+    self.assertEqual([station.name for station in stations], ['a', 'b'])
+    self.assertEqual(stations[0].action, 'reboot')
+    self.assertEqual(stations[0].state_file, os.path.expanduser('~/.meteo_check_status.a'))
+    self.assertEqual([rule.column for rule in stations[0].weewx_db.rules], ['windSpeed', 'outTemp'])
+    self.assertEqual(stations[1].action, 'notify')
+    self.assertEqual(stations[1].state_file, os.path.join(self.test_dir, 'b.data'))
+    self.assertEqual(stations[1].weewx_db.db_file, '/mnt/b/weewx.sdb')
+
+  def test_read_config_errors(self, mock_send_mail_to_root, mock_logger):
+    """It rejects configuration without stations or with unknown actions"""
+    with self.assertRaises(ValueError):
+      meteo_check_status.read_fleet_config(self.write_config('[fleet]\nworkers = 2\n'))
+    with self.assertRaises(ValueError):
+      meteo_check_status.read_fleet_config(self.write_config(
+        '[station:a]\ndb_file = /mnt/a/weewx.sdb\naction = shutdown\n'))
+
+  def test_stations_have_separate_state(self, mock_send_mail_to_root, mock_logger):
+    """It keeps DB marks and backoff state of each station in its own data file"""
+    stations = [meteo_check_status.Station(name, self.create_station_db(name, records_age),
+      os.path.join(self.test_dir, name + '.data'), ['wind=windSpeed'])
+      for name, records_age in (('ok', 1), ('stale', 60))]
+    with mock.patch('time.monotonic', return_value=1000):
+      self.assertTrue(stations[0].check())
+      self.assertFalse(stations[1].check())
+    self.assertEqual(meteo_check_status.read_reboot_timeout(stations[0].state_file), 0)
+    self.assertIsNone(meteo_check_status.read_reboot_timeout(stations[1].state_file))
+    self.assertEqual(meteo_check_status.read_db_marks(stations[0].db_file,
+      stations[0].weewx_db.file_id, stations[0].state_file)[0], now_as_timestamp(-1))
+    self.assertEqual(meteo_check_status.read_db_marks(stations[1].db_file,
+      stations[1].weewx_db.file_id, stations[1].state_file)[0], now_as_timestamp(-60))
+    mock_send_mail_to_root.assert_not_called()
+
+  def test_notifications_back_off(self, mock_send_mail_to_root, mock_logger):
+    """It notifies about failing 'notify' station with increasing intervals"""
+    station = meteo_check_status.Station('stale', self.create_station_db('stale', 60),
+      os.path.join(self.test_dir, 'stale.data'), ['wind=windSpeed'])
+    mails = []
+    for minute in range(0, 60):
+      with mock.patch('time.monotonic', return_value=minute * 60):
+        station.check()
+      mails.append(mock_send_mail_to_root.call_count)
+    # 15min after the failure, then in 30min
+    self.assertEqual(mails[15], 0)
+    self.assertEqual(mails[16], 1)
+    self.assertEqual(mails[46], 1)
+    self.assertEqual(mails[47], 2)
+    self.assertEqual(meteo_check_status.read_reboot_timeout(station.state_file), 30)
+    mock_send_mail_to_root.assert_called_with('Weewx station stale ({0}) check has failed'.format(
+      station.db_file))
+    # Recovery resets backoff
+    station.weewx_db.check = lambda: True
+    station.check()
+    self.assertEqual(meteo_check_status.read_reboot_timeout(station.state_file), 0)
+    self.assertIsNone(station.failing_since)
+
+class ArchiveReport_FunctionalTest(unittest.TestCase):
+  """Functional tests for 'report' subcommand"""
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.test_dir)
+    self.db_file = os.path.join(self.test_dir, 'weewx.sdb')
+    # Three days of 10-minute records in local time
+    self.day_start = int(time.mktime(datetime.date(2026, 1, 10).timetuple()))
+    with contextlib.closing(sqlite3.connect(self.db_file)) as conn:
+      conn.execute('CREATE TABLE archive (`dateTime` INTEGER NOT NULL UNIQUE PRIMARY KEY, ' \
+        '`usUnits` INTEGER NOT NULL, `interval` INTEGER NOT NULL, `windSpeed` REAL, `outTemp` REAL)')
+      for record_time in range(self.day_start, self.day_start + 3 * 86400, 600):
+        minutes = (record_time - self.day_start) // 60
+        # No records on day 2 from 10:10 to 11:50
+        if 1440 + 610 <= minutes <= 1440 + 710:
+          continue
+        # No wind data on day 2 from 20:10 to 20:50
+        wind_speed = None if 1440 + 1210 <= minutes <= 1440 + 1250 else 3.0
+        # outTemp sensor is lost on day 3
+        out_temp = None if minutes >= 2880 else 10.0
+        conn.execute('INSERT INTO archive VALUES (?, 16, 10, ?, ?)', (record_time, wind_speed,
+          out_temp))
+      conn.commit()
+
+  def run_report(self, *args):
+    output_file = os.path.join(self.test_dir, 'report')
+    with mock.patch.object(sys, 'argv', ['meteo_check_status.py', 'report', '--db-file',
+        self.db_file, '-o', output_file] + list(args)), \
+        mock.patch('meteo_check_status.setup_logging'):
+      self.assertEqual(meteo_check_status.main(), 0)
+    with open(output_file) as f:
+      return(f.read())
+
+  def test_gaps(self):
+    report = json.loads(self.run_report('--format', 'json', '--section', 'gaps',
+      '--column', 'windSpeed', '--column', 'outTemp'))
+    self.assertEqual(list(report.keys()), ['gaps'])
+    self.assertEqual([(gap['series'], gap['start'], gap['minutes']) for gap in report['gaps']], [
+      ('records', '2026-01-11 10:00:00', 120),
+      ('windSpeed', '2026-01-11 10:00:00', 120),
+      ('outTemp', '2026-01-11 10:00:00', 120),
+      ('windSpeed', '2026-01-11 20:00:00', 60),
+      # Value is missing until the end of the archive
+      ('outTemp', '2026-01-11 23:50:00', 1440)])
+    self.assertEqual(report['gaps'][-1]['end'], '2026-01-12 23:50:00')
+
+  def test_daily_and_null_ratios(self):
+    report = json.loads(self.run_report('--format', 'json', '--since', '2026-01-11'))
+    self.assertEqual(report['daily'], [
+      {'date': '2026-01-11', 'records': 133, 'expected': 144, 'completeness': 0.9236,
+        'windSpeed_completeness': 0.8889},
+      {'date': '2026-01-12', 'records': 144, 'expected': 144, 'completeness': 1.0,
+        'windSpeed_completeness': 1.0}])
+    # Gap minimum is 15 minutes by default, so 10-minute intervals are not reported
+    self.assertEqual([gap['series'] for gap in report['gaps']], ['records', 'windSpeed',
+      'windSpeed'])
+    self.assertEqual(report['null_ratios'], {'windSpeed': round(5 / 277, 4),
+      'outTemp': round(144 / 277, 4)})
+
+  def test_csv_output(self):
+    tables = self.run_report('--until', '2026-01-10').split('\n\n')
+    self.assertEqual(tables, [
+      'series,start,end,minutes',
+      'date,records,expected,completeness,windSpeed_completeness\n2026-01-10,144,144,1.0,1.0',
+      'column,null_ratio\nwindSpeed,0.0\noutTemp,0.0\n'])
+
+  def test_empty_period(self):
+    """It reports no gaps and no days if the archive has no records in the period"""
+    for args in (('--since', '2099-01-01'), ('--until', '2000-01-01')):
+      report = json.loads(self.run_report('--format', 'json', *args))
+      self.assertEqual(report, {'gaps': [], 'daily': [],
+        'null_ratios': {'windSpeed': None, 'outTemp': None}})
+
+  def test_one_pass_per_day(self):
+    """It reads each day once, and aggregates NULL counts only if they are reported"""
+    for null_ratios, day_queries in ((False, 1), (True, 2)):
+      with contextlib.closing(sqlite3.connect(self.db_file)) as conn:
+        report = meteo_check_status.ArchiveReport(conn, ['windSpeed'], null_ratios=null_ratios)
+        queries = []
+        conn.set_trace_callback(queries.append)
+        report.run()
+      # Archive bounds and the queries for each of the three days
+      self.assertEqual(len(queries), 1 + 3 * day_queries)
+      self.assertEqual([day_stats['windSpeed_completeness'] for day_stats in report.daily],
+        [1.0, 0.8889, 1.0])
+
+  def test_unknown_column(self):
+    with mock.patch.object(sys, 'argv', ['meteo_check_status.py', 'report', '--db-file',
+        self.db_file, '--column', 'noSuchColumn']), \
+        mock.patch('meteo_check_status.setup_logging'), \
+        mock.patch('meteo_check_status.logger.exception') as mock_exception:
+      self.assertEqual(meteo_check_status.main(), 1)
+    mock_exception.assert_called_once_with('Unhandled exception')
+
+class Metrics_UnitTest(unittest.TestCase):
+  """Unit tests for 'Metrics' class and metrics exposition"""
+
+  def setUp(self):
+    self.metrics = meteo_check_status.Metrics([0.1, 1])
+    metrics_patcher = mock.patch.object(meteo_check_status, 'metrics', self.metrics)
+    metrics_patcher.start()
+    self.addCleanup(metrics_patcher.stop)
+
+  def test_render(self):
+    """It renders histograms, counters and gauges in Prometheus text format"""
+    self.metrics.observe('ping', 0.05, True)
+    self.metrics.observe('ping', 0.5, False)
+    self.metrics.observe('ping', 2, True)
+    self.metrics.set_gauge('meteo_reboot_timeout_minutes', 'Reboot timeout', 15)
+    self.metrics.increment('meteo_reboots_initiated_total', 'Reboots')
+    self.metrics.increment('meteo_reboots_initiated_total', 'Reboots')
+    rendered = self.metrics.render().splitlines()
+    for expected_line in ('meteo_check_duration_seconds_bucket{phase="ping",le="0.1"} 1',
+        'meteo_check_duration_seconds_bucket{phase="ping",le="1"} 2',
+        'meteo_check_duration_seconds_bucket{phase="ping",le="+Inf"} 3',
+        'meteo_check_duration_seconds_sum{phase="ping"} 2.55',
+        'meteo_check_duration_seconds_count{phase="ping"} 3',
+        'meteo_check_results_total{phase="ping",result="failure"} 1',
+        'meteo_check_results_total{phase="ping",result="success"} 2',
+        '# TYPE meteo_reboot_timeout_minutes gauge',
+        'meteo_reboot_timeout_minutes 15',
+        '# TYPE meteo_reboots_initiated_total counter',
+        'meteo_reboots_initiated_total 2'):
+      self.assertIn(expected_line, rendered)
+
+  def test_timed_phase(self):
+    """It records duration and result of decorated function"""
+    @meteo_check_status.timed_phase('test')
+    def phase_func(result):
+      if result is None:
+        raise RuntimeError('phase failure')
+      return(result)
+    self.assertTrue(phase_func(True))
+    self.assertFalse(phase_func(False))
+    with self.assertRaises(RuntimeError):
+      phase_func(None)
+    self.assertEqual(self.metrics.results, {('test', 'success'): 1, ('test', 'failure'): 2})
+    self.assertEqual(self.metrics.durations['test'][-1], 3)
+
+  @mock.patch('meteo_check_status.get_system_uptime', return_value=datetime.timedelta(minutes=10))
+  def test_textfile(self, mock_get_system_uptime):
+    """It writes metrics file atomically"""
+    test_dir = tempfile.mkdtemp()
+    try:
+      metrics_file = os.path.join(test_dir, 'meteo.prom')
+      with mock.patch.object(meteo_check_status, 'metrics_textfile', metrics_file):
+        meteo_check_status.write_metrics_textfile()
+      self.assertEqual(os.listdir(test_dir), ['meteo.prom'])
+      with open(metrics_file) as f:
+        self.assertIn('meteo_system_uptime_seconds 600.0\n', f.read())
+    finally:
+      shutil.rmtree(test_dir)
+
+  @mock.patch('meteo_check_status.get_system_uptime', return_value=datetime.timedelta(minutes=10))
+  def test_http_endpoint(self, mock_get_system_uptime):
+    """It serves metrics over HTTP"""
+    loop = asyncio.new_event_loop()
+    try:
+      server = loop.run_until_complete(asyncio.start_server(meteo_check_status.serve_metrics,
+        '127.0.0.1', 0))
+      port = server.sockets[0].getsockname()[1]
+      async def fetch():
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(b'GET /metrics HTTP/1.0\r\nHost: localhost\r\n\r\n')
+        response = await reader.read()
+        writer.close()
+        return(response)
+      response = loop.run_until_complete(fetch())
+      server.close()
+      loop.run_until_complete(server.wait_closed())
+    finally:
+      loop.close()
+    self.assertTrue(response.startswith(b'HTTP/1.0 200 OK\r\n'))
+    self.assertIn(b'\r\n\r\n# HELP meteo_check_duration_seconds', response)
+    self.assertIn(b'meteo_system_uptime_seconds 600.0\n', response)
+
+# Startup budget: cumulative import time of the module (including the modules it
+# imports, as reported by "python -X importtime") in milliseconds and the number
+# of modules it loads. The module takes about 35ms and loads 52 modules on python
+# 3.11 (x86_64), the standard modules, that the original script imported, take
+# about 70ms and load 88 modules. Modules for optional features must not be
+# imported at startup
+module_import_time_budget = 60
+module_import_count_limit = 60
+lazy_modules = ['argparse', 'configparser', 'ctypes', 'email', 'smtplib', 'getpass',
+  'urllib.request', 'http.client', 'asyncio', 'socket', 'json', 'struct', 'random', 'array']
+
+class ImportTime_FunctionalTest(unittest.TestCase):
+  """Functional tests for module startup cost"""
+
+  def run_python(self, code, *args):
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    # Compiled module is cached, as it is when the script is run with "python3 -m"
+    env['PYTHONPYCACHEPREFIX'] = self.cache_dir
+    return(subprocess.run([sys.executable] + list(args) + ['-c', code], env=env,
+      cwd=os.path.dirname(os.path.abspath(meteo_check_status.__file__)),
+      stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True, universal_newlines=True))
+
+  def setUp(self):
+    self.cache_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.cache_dir)
+
+  def get_imported_modules(self):
+    """Returns names of the modules, that importing the module loads"""
+    output = self.run_python('import sys; modules = set(sys.modules); import meteo_check_status; '
+      'print("\\n".join(sorted(set(sys.modules) - modules)))').stdout
+    return(output.split())
+
+  def test_rarely_used_modules_are_not_imported(self):
+    """It doesn't import modules, that are needed for optional features only"""
+    imported_modules = self.get_imported_modules()
+    self.assertIn('sqlite3', imported_modules)
+    self.assertEqual([module for module in lazy_modules if module in imported_modules], [])
+    self.assertLessEqual(len(imported_modules), module_import_count_limit)
+
+  def get_import_time(self):
+    """Returns the best of 3 cumulative import times of the module, milliseconds"""
+    code = 'import meteo_check_status'
+    self.run_python(code)
+    import_times = []
+    for _ in range(3):
+      for line in self.run_python(code, '-X', 'importtime').stderr.splitlines():
+        fields = line.split('|')
+        if len(fields) == 3 and fields[2].strip() == 'meteo_check_status':
+          import_times.append(int(fields[1]) / 1000)
+    return(min(import_times))
+
+  def test_import_time_budget(self):
+    """It imports the module within the time budget"""
+    self.assertLess(self.get_import_time(), module_import_time_budget)
+
 @mock.patch('meteo_check_status.logger.warning')
 class read_reboot_timeout_FunctionalTest(unittest.TestCase):
   """Functional tests for 'read_reboot_timeout' function"""
@@ -174,6 +1311,672 @@ class read_reboot_timeout_FunctionalTest(unittest.TestCase):
     self.assertEqual(ret_val, None)
     mock_logger_warning.assert_called_once()
 
+@mock.patch('meteo_check_status.logger')
+class StateStore_FunctionalTest(unittest.TestCase):
+  """Functional tests for 'StateStore' class"""
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp()
+    self.state_file = os.path.join(self.test_dir, 'data_file')
+    self.state_store = meteo_check_status.StateStore(self.state_file)
+
+  def tearDown(self):
+    shutil.rmtree(self.test_dir)
+
+  def read_state(self):
+    with open(self.state_file) as f:
+      return(json.load(f))
+
+  def test_writes_only_on_change(self, mock_logger):
+    """It rewrites the file atomically and only when a value changes"""
+    self.state_store.update({'reboot_timeout': 0})
+    self.assertEqual(self.read_state(), {'reboot_timeout': 0})
+    file_inode = os.stat(self.state_file).st_ino
+    with mock.patch('os.rename') as mock_rename:
+      self.state_store.update({'reboot_timeout': 0})
+      mock_rename.assert_not_called()
+    self.state_store.update({'reboot_timeout': 15})
+    self.assertEqual(self.read_state(), {'reboot_timeout': 15})
+    self.assertNotEqual(os.stat(self.state_file).st_ino, file_inode)
+    self.assertEqual(os.listdir(self.test_dir), ['data_file'])
+    mock_logger.warning.assert_not_called()
+
+  @mock.patch('meteo_check_status.state_lazy_write_interval', 3600)
+  def test_lazy_updates(self, mock_logger):
+    """It postpones lazy updates until another change, flush or the interval expiration"""
+    with mock.patch('time.monotonic', return_value=1000):
+      self.state_store.update({'last_success_time': 1})
+      self.state_store.update({'last_success_time': 2}, lazy=True)
+    self.assertEqual(self.read_state(), {'last_success_time': 1})
+    self.assertEqual(self.state_store.get('last_success_time'), 2)
+    with mock.patch('time.monotonic', return_value=2000):
+      self.state_store.update({'reboot_timeout': 0})
+    self.assertEqual(self.read_state(), {'last_success_time': 2, 'reboot_timeout': 0})
+    with mock.patch('time.monotonic', return_value=5599):
+      self.state_store.update({'last_success_time': 3}, lazy=True)
+    self.assertEqual(self.read_state()['last_success_time'], 2)
+    with mock.patch('time.monotonic', return_value=5601):
+      self.state_store.update({'last_success_time': 4}, lazy=True)
+    self.assertEqual(self.read_state()['last_success_time'], 4)
+    self.state_store.update({'last_success_time': 5}, lazy=True)
+    self.state_store.flush()
+    self.assertEqual(self.read_state()['last_success_time'], 5)
+
+  def test_legacy_data_file(self, mock_logger):
+    """It reads ConfigParser data files and converts them on the first write"""
+    with open(self.state_file, 'w') as f:
+      f.write('[meteo_check_status]\nreboot_timeout = 30\n\n[weewx_db]\ndb_file = /tmp/weewx.sdb\n'
+        'file_id = 1:2\nlast_record_time = 1000\nlast_valid_times = {"wind": 900}\n')
+    with mock.patch.object(meteo_check_status, 'state_stores', {}):
+      self.assertEqual(meteo_check_status.read_reboot_timeout(self.state_file), 30)
+      self.assertEqual(meteo_check_status.read_db_marks('/tmp/weewx.sdb', (1, 2), self.state_file),
+        (1000, {'wind': 900}))
+      meteo_check_status.record_check_result('ping', False, self.state_file)
+    self.assertEqual(self.read_state(), {'reboot_timeout': 30, 'check_failures': {'ping': 1},
+      'weewx_db': {'db_file': '/tmp/weewx.sdb', 'file_id': [1, 2], 'last_record_time': 1000,
+        'last_valid_times': {'wind': 900}}})
+    mock_logger.warning.assert_not_called()
+
+  def test_legacy_data_file_invalid_reboot_timeout(self, mock_logger):
+    """Invalid reboot timeout is dropped on conversion"""
+    with open(self.state_file, 'w') as f:
+      f.write('[meteo_check_status]\nreboot_timeout = wrong-int\n')
+    with mock.patch.object(meteo_check_status, 'state_stores', {}):
+      meteo_check_status.record_check_result('ping', True, self.state_file)
+    self.assertEqual(self.read_state(), {'check_failures': {'ping': 0}})
+    mock_logger.warning.assert_called_once_with(
+      'Invalid reboot timeout "wrong-int" in legacy data file is ignored')
+
+  def test_consecutive_failures(self, mock_logger):
+    """It counts consecutive failures of each check"""
+    with mock.patch.object(meteo_check_status, 'state_stores', {}):
+      for name, result in (('ping', False), ('DB', True), ('ping', False), ('DB', False)):
+        meteo_check_status.record_check_result(name, result, self.state_file)
+      self.assertEqual(self.read_state()['check_failures'], {'ping': 2, 'DB': 1})
+      meteo_check_status.record_check_result('ping', True, self.state_file)
+      self.assertEqual(self.read_state()['check_failures'], {'ping': 0, 'DB': 1})
+
+@mock.patch('meteo_check_status.logger')
+@mock.patch('meteo_check_status.time.sleep')
+@mock.patch('meteo_check_status.subprocess.call', return_value=0)
+@mock.patch('meteo_check_status.do_check_db', return_value=False)
+@mock.patch('meteo_check_status.do_reboot', return_value=True)
+@mock.patch('meteo_check_status.remediation_ladder', ['restart_weewx', 'reset_usb', 'reboot'])
+class do_remediation_FunctionalTest(unittest.TestCase):
+  """Functional tests for 'do_remediation' function"""
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp()
+    for name, value in (('data_file', os.path.join(self.test_dir, 'data_file')),
+        ('state_stores', {})):
+      patcher = mock.patch.object(meteo_check_status, name, value)
+      patcher.start()
+      self.addCleanup(patcher.stop)
+    meteo_check_status.record_check_result('DB', False)
+
+  def tearDown(self):
+    shutil.rmtree(self.test_dir)
+
+  def test_step_fixes_failure(self, mock_do_reboot, mock_do_check_db, mock_call, mock_sleep,
+      mock_logger):
+    """It stops escalation when verification re-check passes"""
+    mock_do_check_db.return_value = True
+    self.assertFalse(meteo_check_status.do_remediation())
+    mock_call.assert_called_once_with('sudo /usr/sbin/service weewx restart', shell=True,
+      timeout=meteo_check_status.remediation_command_timeout)
+    mock_sleep.assert_called_once_with(90)
+    mock_do_reboot.assert_not_called()
+    self.assertEqual(meteo_check_status.get_state_store().get('check_failures'), {'DB': 0})
+
+  def test_escalation_and_backoff(self, mock_do_reboot, mock_do_check_db, mock_call, mock_sleep,
+      mock_logger):
+    """It escalates to the next steps and skips recently run ones"""
+    with mock.patch('time.time', return_value=100000):
+      self.assertTrue(meteo_check_status.do_remediation())
+    self.assertEqual(mock_call.call_count, 2)
+    self.assertEqual(mock_do_check_db.call_count, 2)
+    mock_do_reboot.assert_called_once_with()
+    # Both steps are in backoff (15 minutes)
+    with mock.patch('time.time', return_value=100000 + 14 * 60):
+      meteo_check_status.do_remediation()
+    self.assertEqual(mock_call.call_count, 2)
+    self.assertEqual(mock_do_reboot.call_count, 2)
+    # Failing command is not verified
+    mock_call.return_value = 1
+    with mock.patch('time.time', return_value=100000 + 16 * 60):
+      meteo_check_status.do_remediation()
+    self.assertEqual(mock_call.call_count, 4)
+    self.assertEqual(mock_do_check_db.call_count, 2)
+    self.assertEqual(meteo_check_status.get_state_store().get('remediation'), {
+      'restart_weewx': {'time': 100000 + 16 * 60, 'timeout': 30},
+      'reset_usb': {'time': 100000 + 16 * 60, 'timeout': 30}})
+    # Successful check resets the backoff
+    meteo_check_status.process_check_result(True)
+    self.assertEqual(meteo_check_status.get_state_store().get('remediation'), {})
+
+  def test_nothing_to_remediate(self, mock_do_reboot, mock_do_check_db, mock_call, mock_sleep,
+      mock_logger):
+    """It doesn't run any steps if the failing checks have passed since"""
+    meteo_check_status.record_check_result('DB', True)
+    self.assertFalse(meteo_check_status.do_remediation())
+    mock_call.assert_not_called()
+    mock_do_check_db.assert_not_called()
+    mock_do_reboot.assert_not_called()
+    mock_logger.info.assert_called_with('There are no failing checks to remediate')
+
+@mock.patch('meteo_check_status.logger')
+@mock.patch('meteo_check_status.do_remediation', return_value=False)
+@mock.patch('meteo_check_status.do_ping', return_value=True)
+@mock.patch('meteo_check_status.do_check_db', return_value=False)
+@mock.patch('meteo_check_status.recheck_interval', 5)
+@mock.patch('meteo_check_status.recheck_budget', 30)
+@mock.patch('meteo_check_status.time.sleep')
+class confirm_failure_FunctionalTest(unittest.TestCase):
+  """Functional tests for re-check burst after a failure ('confirm_failure' function)"""
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp()
+    for name, value in (('data_file', os.path.join(self.test_dir, 'data_file')),
+        ('state_stores', {})):
+      patcher = mock.patch.object(meteo_check_status, name, value)
+      patcher.start()
+      self.addCleanup(patcher.stop)
+
+  def tearDown(self):
+    shutil.rmtree(self.test_dir)
+
+  def test_transient_failure_is_dismissed(self, mock_sleep, mock_do_check_db, mock_do_ping,
+      mock_do_remediation, mock_logger):
+    """It re-runs only the failing checks and dismisses the failure once they pass"""
+    mock_do_check_db.side_effect = [False, True]
+    meteo_check_status.record_check_result('ping', True)
+    meteo_check_status.record_check_result('DB', False)
+    self.assertFalse(meteo_check_status.process_check_result(False))
+    self.assertEqual(mock_do_check_db.call_count, 2)
+    mock_do_ping.assert_not_called()
+    mock_do_remediation.assert_not_called()
+    self.assertEqual(meteo_check_status.read_reboot_timeout(), 0)
+
+  def test_failure_is_confirmed_within_budget(self, mock_sleep, mock_do_check_db, mock_do_ping,
+      mock_do_remediation, mock_logger):
+    """It escalates when the checks keep failing until the budget is spent"""
+    meteo_check_status.record_check_result('DB', False)
+    clock = [1000]
+    def fake_sleep(seconds):
+      clock[0] += seconds
+    with mock.patch('time.monotonic', lambda: clock[0]), mock.patch('time.sleep', fake_sleep):
+      meteo_check_status.process_check_result(False)
+    self.assertEqual(clock[0], 1030)
+    self.assertEqual(mock_do_check_db.call_count, 6)
+    mock_do_remediation.assert_called_once_with()
+    mock_logger.info.assert_any_call('Failure has been confirmed by 6 re-checks')
+
+  def test_nothing_to_confirm(self, mock_sleep, mock_do_check_db, mock_do_ping,
+      mock_do_remediation, mock_logger):
+    """It doesn't confirm a failure if none of the checks is failing"""
+    meteo_check_status.record_check_result('ping', True)
+    meteo_check_status.record_check_result('DB', True)
+    self.assertFalse(meteo_check_status.process_check_result(False))
+    mock_do_check_db.assert_not_called()
+    mock_do_remediation.assert_not_called()
+    mock_logger.info.assert_any_call('There are no failing checks to confirm')
+
+@mock.patch('meteo_check_status.logger')
+@mock.patch('meteo_check_status.get_system_uptime', return_value=datetime.timedelta(days=1))
+@mock.patch('meteo_check_status.os.system')
+@mock.patch('meteo_check_status.subprocess.call', return_value=0)
+@mock.patch('meteo_check_status.time.sleep')
+@mock.patch('meteo_check_status.do_ping', return_value=True)
+@mock.patch('meteo_check_status.do_check_db')
+class CheckScheduler_IntegrationTest(unittest.TestCase):
+  """Integration tests for failure processing by 'CheckScheduler' class"""
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp()
+    for name, value in (('data_file', os.path.join(self.test_dir, 'data_file')),
+        ('state_stores', {})):
+      patcher = mock.patch.object(meteo_check_status, name, value)
+      patcher.start()
+      self.addCleanup(patcher.stop)
+    self.loop = asyncio.new_event_loop()
+
+  def tearDown(self):
+    self.loop.close()
+    shutil.rmtree(self.test_dir)
+
+  def run_scheduler(self, run_time):
+    """Runs frequent ping check and DB check, that runs once"""
+    scheduler = meteo_check_status.CheckScheduler(self.loop, [
+      meteo_check_status.ScheduledCheck('ping', lambda: meteo_check_status.do_ping(), 0.05),
+      meteo_check_status.ScheduledCheck('DB', lambda: meteo_check_status.do_check_db(), 60)])
+    self.loop.call_later(run_time, scheduler.stop)
+    self.loop.run_until_complete(scheduler.run())
+    return(scheduler)
+
+  @mock.patch('meteo_check_status.recheck_budget', 0)
+  @mock.patch('meteo_check_status.remediation_ladder', ['restart_weewx', 'reboot'])
+  def test_fixed_failure_is_cleared(self, mock_do_check_db, mock_do_ping, mock_sleep, mock_call,
+      mock_os_system, mock_get_system_uptime, mock_logger):
+    """It doesn't fail later results of other checks with a failure, that has been fixed"""
+    mock_do_check_db.side_effect = [False, True]
+    scheduler = self.run_scheduler(0.5)
+    mock_call.assert_called_once_with('sudo /usr/sbin/service weewx restart', shell=True,
+      timeout=meteo_check_status.remediation_command_timeout)
+    mock_logger.info.assert_any_call('Remediation step "restart_weewx" has fixed the failure')
+    mock_os_system.assert_not_called()
+    self.assertEqual(scheduler.results, {'ping': True, 'DB': True})
+    mock_logger.info.assert_called_with('Check result: Ok')
+
+  @mock.patch('meteo_check_status.recheck_interval', 5)
+  @mock.patch('meteo_check_status.recheck_budget', 30)
+  @mock.patch('meteo_check_status.remediation_ladder', ['reboot'])
+  def test_dismissed_failure_is_cleared(self, mock_do_check_db, mock_do_ping, mock_sleep,
+      mock_call, mock_os_system, mock_get_system_uptime, mock_logger):
+    """It doesn't fail later results of other checks with a failure, dismissed by re-check"""
+    mock_do_check_db.side_effect = [False, True]
+    scheduler = self.run_scheduler(0.5)
+    mock_logger.info.assert_any_call('Failure has not been confirmed by re-check #1')
+    self.assertEqual(mock_do_check_db.call_count, 2)
+    mock_call.assert_not_called()
+    mock_os_system.assert_not_called()
+    self.assertEqual(scheduler.results, {'ping': True, 'DB': True})
+    mock_logger.info.assert_called_with('Check result: Ok')
+
+@mock.patch('meteo_check_status.logger')
+class run_checks_FunctionalTest(unittest.TestCase):
+  """Functional tests for 'run_checks' function"""
+
+  def make_definition(self, name, result=True, run_time=0, timeout=None, depends_on=()):
+    def check_func():
+      self.started[name] = time.monotonic()
+      time.sleep(run_time)
+      return(result)
+    return(meteo_check_status.CheckDefinition(name, check_func, timeout, depends_on))
+
+  def setUp(self):
+    self.started = {}
+
+  def test_parallel_run(self, mock_logger):
+    """Independent checks run in parallel, dependent ones after their dependencies"""
+    start_time = time.monotonic()
+    results = meteo_check_status.run_checks([self.make_definition('upload', run_time=0.1,
+      depends_on=['ping']), self.make_definition('ping', run_time=0.2),
+      self.make_definition('DB', run_time=0.2), self.make_definition('disk', run_time=0.2)])
+    self.assertLess(time.monotonic() - start_time, 0.5)
+    self.assertGreaterEqual(self.started['upload'] - self.started['ping'], 0.2)
+    self.assertEqual(list(results.items()), [('upload', True), ('ping', True), ('DB', True),
+      ('disk', True)])
+
+  def test_failed_dependency(self, mock_logger):
+    """A check is skipped if its dependency fails, and the skip doesn't count"""
+    results = meteo_check_status.run_checks([self.make_definition('ping', result=False),
+      self.make_definition('upload', depends_on=['ping']),
+      self.make_definition('report', depends_on=['upload']),
+      # Dependencies, that are not run, are considered passed
+      self.make_definition('DB', depends_on=['weewx'])])
+    self.assertEqual(results, {'ping': False, 'upload': None, 'report': None, 'DB': True})
+    self.assertNotIn('upload', self.started)
+    mock_logger.info.assert_any_call('upload check is skipped: ping check has not passed')
+    self.assertFalse(meteo_check_status.merge_check_results(results))
+    self.assertTrue(meteo_check_status.merge_check_results({'ping': True, 'upload': None}))
+
+  def test_timeout(self, mock_logger):
+    """A check, that exceeds its timeout, fails without delaying the others"""
+    start_time = time.monotonic()
+    results = meteo_check_status.run_checks([self.make_definition('hung', run_time=2,
+      timeout=0.1), self.make_definition('DB', run_time=0.2)])
+    self.assertLess(time.monotonic() - start_time, 1)
+    self.assertEqual(results, {'hung': False, 'DB': True})
+    mock_logger.error.assert_called_once_with('hung check has timed out (0.1s)')
+
+  @mock.patch('meteo_check_status.check_timeout', 120)
+  def test_check_timeout_option(self, mock_logger):
+    """--check-timeout option limits checks without their own timeout"""
+    with mock.patch.object(sys, 'argv', ['meteo_check_status.py', '--check-timeout', '1',
+        'report', '--db-file', os.path.join(tempfile.gettempdir(), 'no_such_weewx.sdb')]), \
+        mock.patch('meteo_check_status.setup_logging'):
+      self.assertEqual(meteo_check_status.main(), 1)
+    self.assertEqual(meteo_check_status.check_timeout, 1)
+    start_time = time.monotonic()
+    results = meteo_check_status.run_checks([self.make_definition('hung', run_time=3)])
+    self.assertLess(time.monotonic() - start_time, 2)
+    self.assertEqual(results, {'hung': False})
+    mock_logger.error.assert_called_with('hung check has timed out (1s)')
+
+  def test_circular_dependencies(self, mock_logger):
+    with self.assertRaises(ValueError):
+      meteo_check_status.run_checks([self.make_definition('a', depends_on=['b']),
+        self.make_definition('b', depends_on=['a'])])
+
+  @mock.patch('meteo_check_status.do_ping', return_value=False)
+  @mock.patch('meteo_check_status.do_check_db', return_value=True)
+  @mock.patch('meteo_check_status.do_check_upload')
+  @mock.patch('meteo_check_status.process_check_result')
+  @mock.patch('meteo_check_status.check_is_allowed', return_value=True)
+  @mock.patch('meteo_check_status.enabled_checks', ['ping', 'DB', 'upload'])
+  def test_do_check(self, mock_check_is_allowed, mock_process_check_result, mock_do_check_upload,
+      mock_do_check_db, mock_do_ping, mock_logger):
+    """do_check() runs enabled checks and merges their results"""
+    test_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, test_dir)
+    with mock.patch.object(meteo_check_status, 'data_file', os.path.join(test_dir, 'data_file')), \
+        mock.patch.object(meteo_check_status, 'state_stores', {}):
+      meteo_check_status.do_check(False)
+      mock_do_check_upload.assert_not_called()
+      mock_process_check_result.assert_called_once_with(False)
+      self.assertEqual(meteo_check_status.get_state_store().get('check_failures'),
+        {'ping': 1, 'DB': 0})
+
+class FakeHTTPServer(object):
+  """HTTP server, that responds to GET requests with the status, set in 'status' attribute"""
+
+  def __init__(self):
+    import http.server
+    fake_server = self
+    class RequestHandler(http.server.BaseHTTPRequestHandler):
+      def do_GET(self):
+        self.send_response(fake_server.status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+      def log_message(self, *args):
+        pass
+    self.status = 200
+    self.server = http.server.HTTPServer(('127.0.0.1', 0), RequestHandler)
+    self.url = 'http://127.0.0.1:{0}/upload'.format(self.server.server_address[1])
+    self.thread = threading.Thread(target=self.server.serve_forever)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def close(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+@mock.patch('meteo_check_status.logger')
+class ExtraChecks_FunctionalTest(unittest.TestCase):
+  """Functional tests for extra checks (disk, usb, weewx, upload)"""
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.test_dir)
+
+  def test_disk(self, mock_logger):
+    fs_stat = os.statvfs(self.test_dir)
+    free_mb = fs_stat.f_bavail * fs_stat.f_frsize / (1024 * 1024)
+    with mock.patch.object(meteo_check_status, 'disk_check_paths', [self.test_dir, '/no/such/dir']):
+      with mock.patch.object(meteo_check_status, 'disk_min_free_mb', 0), \
+          mock.patch.object(meteo_check_status, 'disk_min_free_percent', 0):
+        self.assertTrue(meteo_check_status.do_check_disk())
+      with mock.patch.object(meteo_check_status, 'disk_min_free_mb', free_mb + 1024):
+        self.assertFalse(meteo_check_status.do_check_disk())
+
+  def test_usb(self, mock_logger):
+    for device_name, ids in (('usb1', ('1d6b', '0002')), ('1-1', ('1941', '8021')), ('1-1:1.0', None)):
+      os.mkdir(os.path.join(self.test_dir, device_name))
+      if ids is not None:
+        for file_name, device_id in zip(('idVendor', 'idProduct'), ids):
+          with open(os.path.join(self.test_dir, device_name, file_name), 'w') as f:
+            f.write(device_id + '\n')
+    with mock.patch.object(meteo_check_status, 'usb_devices_dir', self.test_dir):
+      self.assertTrue(meteo_check_status.do_check_usb())
+      with mock.patch.object(meteo_check_status, 'usb_device_id', '1941:8022'):
+        self.assertFalse(meteo_check_status.do_check_usb())
+    mock_logger.error.assert_called_once_with('USB device 1941:8022 is not connected')
+
+  def test_weewx_process(self, mock_logger):
+    with open('/proc/self/cmdline', 'rb') as f:
+      process_name = os.path.basename(os.fsdecode(f.read().split(b'\0')[0]))
+    with mock.patch.object(meteo_check_status, 'weewx_process_name', process_name):
+      self.assertTrue(meteo_check_status.do_check_weewx_process())
+    with mock.patch.object(meteo_check_status, 'weewx_process_name', 'no-such-process'):
+      self.assertFalse(meteo_check_status.do_check_weewx_process())
+
+  def test_upload(self, mock_logger):
+    http_server = FakeHTTPServer()
+    self.addCleanup(http_server.close)
+    with mock.patch.object(meteo_check_status, 'upload_check_urls', [http_server.url]):
+      self.assertTrue(meteo_check_status.do_check_upload())
+      # Client errors mean that the service is up
+      http_server.status = 404
+      self.assertTrue(meteo_check_status.do_check_upload())
+      http_server.status = 503
+      self.assertFalse(meteo_check_status.do_check_upload())
+    with mock.patch.object(meteo_check_status, 'upload_check_urls', ['http://127.0.0.1:1/']):
+      self.assertFalse(meteo_check_status.do_check_upload())
+
+@mock.patch('meteo_check_status.logger')
+class WeewxLogMonitor_FunctionalTest(unittest.TestCase):
+  """Functional tests for 'WeewxLogMonitor' class"""
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.test_dir)
+    self.state_file = os.path.join(self.test_dir, 'data_file')
+    self.log_file = os.path.join(self.test_dir, 'syslog')
+    state_stores_patcher = mock.patch.object(meteo_check_status, 'state_stores', {})
+    state_stores_patcher.start()
+    self.addCleanup(state_stores_patcher.stop)
+    self.write_log(self.station_status(64, -60))
+
+  def station_status(self, lost_connection, minutes_offset=0):
+    return('{0} meteo-srv weewx[4689]: fousb: station status {{\'unknown\': 0, ' \
+      '\'lost_connection\': {1}, \'rain_overflow\': 0}} ({1})\n'.format(time.strftime(
+      '%b %d %H:%M:%S', time.localtime(time.time() + minutes_offset * 60)), lost_connection))
+
+  def upload_failure(self):
+    return('{0} meteo-srv weewx[2665]: restx: WindGuru: Failed to publish record ' \
+      '2016-08-19 23:11:00 EET (1471641060): No windSpeed in record\n'.format(
+      time.strftime('%b %d %H:%M:%S')))
+
+  def write_log(self, data, mode='a'):
+    with open(self.log_file, mode) as f:
+      f.write(data)
+
+  def create_monitor(self):
+    monitor = meteo_check_status.WeewxLogMonitor('file', self.log_file, self.state_file)
+    self.addCleanup(monitor.close)
+    return(monitor)
+
+  def test_lost_connection(self, mock_logger):
+    """It fails when the station has lost connection for a while"""
+    monitor = self.create_monitor()
+    # Existing log lines are not processed
+    self.assertTrue(monitor.check())
+    self.write_log(self.station_status(64, -2))
+    self.assertTrue(monitor.check())
+    self.write_log(self.station_status(64, -1))
+    with mock.patch('time.time', return_value=time.time() + 3 * 60):
+      self.assertFalse(monitor.check())
+    self.assertRegex(mock_logger.error.call_args[0][0],
+      r'^Weather station has lost connection 0:0[45]:\d\d ago$')
+    self.write_log(self.station_status(0))
+    self.assertTrue(monitor.check())
+
+  def test_incomplete_line(self, mock_logger):
+    """It processes a line only when it has been written completely"""
+    monitor = self.create_monitor()
+    monitor.check()
+    line = self.station_status(64, -10)
+    self.write_log(line[:50])
+    self.assertTrue(monitor.check())
+    self.write_log(line[50:])
+    self.assertFalse(monitor.check())
+
+  def test_rotation_and_truncation(self, mock_logger):
+    """It reads the rest of the rotated file and the new file from the beginning"""
+    monitor = self.create_monitor()
+    monitor.check()
+    self.write_log(self.station_status(64, -10))
+    os.rename(self.log_file, self.log_file + '.1')
+    self.write_log(self.upload_failure() * 4)
+    with mock.patch.object(meteo_check_status, 'log_max_upload_failures', 4):
+      self.assertFalse(monitor.check())
+      self.assertIsNotNone(monitor.lost_connection_since)
+      self.assertEqual(len(monitor.upload_failures), 4)
+      # copytruncate
+      self.write_log(self.station_status(0), mode='w')
+      self.assertFalse(monitor.check())
+      self.assertIsNone(monitor.lost_connection_since)
+    mock_logger.error.assert_called_with('4 failed uploads (WindGuru) in the last 15min')
+    with mock.patch('time.time', return_value=time.time() + 16 * 60):
+      self.assertTrue(monitor.check())
+
+  def test_position_is_saved(self, mock_logger):
+    """It resumes reading from the saved position after restart"""
+    monitor = self.create_monitor()
+    monitor.check()
+    meteo_check_status.flush_state_stores()
+    monitor.close()
+    # Written while the script was not running
+    self.write_log(self.station_status(64, -10))
+    meteo_check_status.state_stores.clear()
+    monitor = self.create_monitor()
+    self.assertFalse(monitor.check())
+
+  @mock.patch('meteo_check_status.subprocess.run')
+  def test_journal(self, mock_run, mock_logger):
+    """It reads journal entries after the saved cursor"""
+    mock_run.return_value.stdout = b'2016-08-19T23:10:00+0200 meteo-srv weewx[4689]: fousb: ' \
+      b'station status {\'unknown\': 0, \'lost_connection\': 64, \'rain_overflow\': 0} (64)\n' \
+      b'-- cursor: s=1;i=10\n'
+    monitor = meteo_check_status.WeewxLogMonitor('journal', None, self.state_file)
+    # The first call only gets the cursor
+    self.assertTrue(monitor.check())
+    self.assertIn('--lines=1', mock_run.call_args[0][0])
+    self.assertFalse(monitor.check())
+    self.assertIn('--after-cursor=s=1;i=10', mock_run.call_args[0][0])
+    self.assertEqual(monitor.lost_connection_since,
+      time.mktime(datetime.datetime(2016, 8, 19, 23, 10).timetuple()))
+
+class FakeSMTPServer(object):
+  """Minimal SMTP server, that accepts one message per connection"""
+
+  def __init__(self):
+    self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.sock.bind(('127.0.0.1', 0))
+    self.sock.listen(1)
+    self.port = self.sock.getsockname()[1]
+    self.messages = []
+    self.thread = threading.Thread(target=self.serve)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def serve(self):
+    while True:
+      try:
+        conn, _ = self.sock.accept()
+      except OSError:
+        return
+      with conn, conn.makefile('rb') as f:
+        conn.sendall(b'220 localhost\r\n')
+        for line in f:
+          command = line.strip().upper()
+          if command.startswith(b'DATA'):
+            conn.sendall(b'354 go ahead\r\n')
+            message = b''.join(iter(f.readline, b'.\r\n'))
+            self.messages.append(message.decode())
+            conn.sendall(b'250 ok\r\n')
+          elif command.startswith(b'QUIT'):
+            conn.sendall(b'221 bye\r\n')
+            break
+          else:
+            conn.sendall(b'250 ok\r\n')
+
+  def close(self):
+    self.sock.close()
+
+class FakeSink(object):
+  def __init__(self, name, fail=False):
+    self.name = name
+    self.fail = fail
+    self.sent = []
+
+  def send(self, subject, text):
+    if self.fail:
+      raise OSError('Network is unreachable')
+    self.sent.append((subject, text))
+
+@mock.patch('meteo_check_status.logger')
+@mock.patch('meteo_check_status.notification_batch_delay', 0.1)
+class Notifier_FunctionalTest(unittest.TestCase):
+  """Functional tests for 'Notifier' class and notification sinks"""
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp()
+    self.spool_file = os.path.join(self.test_dir, 'spool')
+
+  def tearDown(self):
+    shutil.rmtree(self.test_dir)
+
+  def test_notices_are_coalesced(self, mock_logger):
+    """It sends notices, arriving close together, as one digest"""
+    sink = FakeSink('fake')
+    notifier = meteo_check_status.Notifier([sink], self.spool_file)
+    for text in ('DB check has failed', 'Ping has failed', 'DB check has failed'):
+      notifier.notify(text)
+    notifier.stop(5)
+    self.assertEqual(len(sink.sent), 1)
+    subject, text = sink.sent[0]
+    self.assertEqual(subject, 'Notification from meteo_check_status.py script (3 notices)')
+    lines = text.splitlines()
+    self.assertEqual(len(lines), 3)
+    self.assertTrue(lines[1].endswith(': DB check has failed (repeated 2 times, last at {0})'.format(
+      lines[2].split(': ')[0])))
+    self.assertTrue(lines[2].endswith(': Ping has failed'))
+
+  @mock.patch('meteo_check_status.notification_retry_interval', 60)
+  def test_undelivered_notices_are_spooled(self, mock_logger):
+    """It keeps undelivered notices in the spool file and sends them later"""
+    failing_sink = FakeSink('fake', fail=True)
+    notifier = meteo_check_status.Notifier([failing_sink], self.spool_file)
+    notifier.notify('Rebooting')
+    time.sleep(0.3)
+    failing_sink.fail = False
+    notifier.notify('Rebooting')
+    # Connectivity is back, no need to wait for the retry interval
+    notifier.wake()
+    time.sleep(0.3)
+    notifier.stop(5)
+    self.assertEqual(len(failing_sink.sent), 1)
+    self.assertIn('Rebooting (repeated 2 times', failing_sink.sent[0][1])
+
+    # Spooled notices survive restart
+    notifier = meteo_check_status.Notifier([FakeSink('fake', fail=True)], self.spool_file)
+    notifier.notify('Rebooting')
+    notifier.stop(5)
+    with open(self.spool_file) as f:
+      self.assertEqual([notice['text'] for notice in json.load(f)['pending']['fake']], ['Rebooting'])
+    sink = FakeSink('fake')
+    notifier = meteo_check_status.Notifier([sink], self.spool_file)
+    notifier.start()
+    notifier.stop(5)
+    self.assertEqual(len(sink.sent), 1)
+    with open(self.spool_file) as f:
+      self.assertEqual(json.load(f)['pending'], {})
+
+  def test_smtp_sink(self, mock_logger):
+    """It delivers notifications to an SMTP server"""
+    smtp_server = FakeSMTPServer()
+    self.addCleanup(smtp_server.close)
+    sink = meteo_check_status.create_notification_sink('smtp:127.0.0.1:{0}'.format(smtp_server.port))
+    notifier = meteo_check_status.Notifier([sink], self.spool_file)
+    notifier.notify('Rebooting meteo-srv in 1 minute')
+    notifier.stop(5)
+    self.assertEqual(len(smtp_server.messages), 1)
+    self.assertIn('To: root', smtp_server.messages[0])
+    self.assertIn('Rebooting meteo-srv in 1 minute', smtp_server.messages[0])
+    mock_logger.warning.assert_not_called()
+
+  def test_sink_specs(self, mock_logger):
+    """It creates sinks from specifications"""
+    self.assertEqual(meteo_check_status.create_notification_sink('sendmail').name, 'sendmail')
+    self.assertEqual(meteo_check_status.create_notification_sink('smtp:mail.local').name,
+      'smtp:mail.local:25')
+    self.assertEqual(meteo_check_status.create_notification_sink(
+      'webhook:https://example.com/hook').url, 'https://example.com/hook')
+    for sink_spec in ('smtp', 'webhook:', 'telegram:123'):
+      with self.assertRaises(ValueError):
+        meteo_check_status.create_notification_sink(sink_spec)
+
 @mock.patch('meteo_check_status.logger')
 @mock.patch('meteo_check_status.read_reboot_timeout')
 @mock.patch('meteo_check_status.write_reboot_timeout')
@@ -198,6 +2001,7 @@ class do_reboot_UnitTest(unittest.TestCase):
 class reboot_sequence_IntegrationTest(unittest.TestCase):
   """Integration tests to ensure proper reboot timeouts on different stages"""
 
+  @mock.patch('meteo_check_status.recheck_budget', 0)
   @mock.patch('meteo_check_status.logger')
   @mock.patch('meteo_check_status.get_system_uptime')
   @mock.patch('meteo_check_status.do_ping')
@@ -292,3 +2096,165 @@ class reboot_sequence_IntegrationTest(unittest.TestCase):
       # reboot
       {'uptime': 16,  'no_ping': True, 'ping_result': False, 'db_result': False, 'expect_reboot': True}
     ))
+
+@mock.patch('meteo_check_status.logger')
+class Simulation_FunctionalTest(unittest.TestCase):
+  """Simulated days of station behavior (see simulate_meteo_check_status.py)"""
+
+  def run_simulation(self, outages, days, **kwargs):
+    simulation = simulate_meteo_check_status.Simulation([simulate_meteo_check_status.Outage.parse(
+      outage_spec) for outage_spec in outages], days, **kwargs)
+    return(simulation.run())
+
+  def test_environment(self, mock_logger):
+    """Uptime, clock and commands go through the environment object"""
+    environment = simulate_meteo_check_status.SimulatedEnvironment()
+    with mock.patch.object(meteo_check_status, 'environment', environment):
+      self.assertEqual(meteo_check_status.get_system_uptime(), datetime.timedelta(days=1))
+      environment.sleep(60)
+      self.assertEqual(meteo_check_status.get_system_uptime(),
+        datetime.timedelta(days=1, minutes=1))
+      self.assertTrue(meteo_check_status.run_remediation_command('restart_weewx'))
+      self.assertTrue(meteo_check_status.do_ping())
+      environment.ping_func = lambda: False
+      self.assertFalse(meteo_check_status.do_ping())
+    self.assertEqual(environment.commands, [(simulate_meteo_check_status.start_timestamp + 60,
+      'sudo /usr/sbin/service weewx restart')])
+
+  def test_environment_processes(self, mock_logger):
+    """Journal and sendmail are run through the environment object"""
+    environment = simulate_meteo_check_status.SimulatedEnvironment()
+    state_dir = tempfile.mkdtemp()
+    try:
+      with mock.patch.object(meteo_check_status, 'environment', environment), \
+          mock.patch('meteo_check_status.subprocess.run') as mock_run:
+        monitor = meteo_check_status.WeewxLogMonitor('journal', None,
+          os.path.join(state_dir, 'state_file'))
+        self.assertTrue(monitor.check())
+        meteo_check_status.SendmailSink().send('Subject', 'Text')
+    finally:
+      shutil.rmtree(state_dir)
+    mock_run.assert_not_called()
+    self.assertTrue(environment.commands[0][1].startswith('journalctl '))
+    self.assertEqual(environment.commands[1][1], '/usr/sbin/sendmail -t -oi')
+
+  @mock.patch('meteo_check_status.metrics', meteo_check_status.Metrics([1, 10]))
+  def test_environment_clock(self, mock_logger):
+    """Phase durations, check deadlines and notification retries use the environment clock"""
+    environment = simulate_meteo_check_status.SimulatedEnvironment()
+    @meteo_check_status.timed_phase('sleep')
+    def sleep():
+      environment.sleep(5)
+      return(True)
+    with mock.patch.object(meteo_check_status, 'environment', environment), \
+        mock.patch('meteo_check_status.time.monotonic', side_effect=AssertionError):
+      self.assertEqual(meteo_check_status.run_checks([
+        meteo_check_status.CheckDefinition('sleep', sleep)]), {'sleep': True})
+      self.assertEqual(meteo_check_status.metrics.durations['sleep'], [0, 1, 5, 1])
+      # Notices are batched for notification_batch_delay, delivery fails at first, then
+      # it's retried after notification_retry_interval
+      send_times = []
+      def send(subject, text):
+        send_times.append(environment.now)
+        if len(send_times) == 1:
+          raise OSError('Connection refused')
+        notifier.queue.put(False)
+      sink = mock.Mock(send=mock.Mock(side_effect=send))
+      sink.name = 'test'
+      state_dir = tempfile.mkdtemp()
+      try:
+        notifier = meteo_check_status.Notifier([sink], os.path.join(state_dir, 'spool'))
+        notifier.queue.put({'time': int(environment.time()), 'text': 'Text'})
+        notifier.run()
+      finally:
+        shutil.rmtree(state_dir)
+    batch_time = simulate_meteo_check_status.start_timestamp + 5 + \
+      meteo_check_status.notification_batch_delay
+    self.assertEqual(send_times, [batch_time,
+      batch_time + meteo_check_status.notification_retry_interval])
+
+  def test_scheduler(self, mock_logger):
+    """Checks are run by CheckScheduler on the virtual clock"""
+    run_check = meteo_check_status.CheckScheduler.run_check
+    with mock.patch.object(meteo_check_status.CheckScheduler, 'run_check', autospec=True,
+        side_effect=run_check) as mock_run_check:
+      start_time = time.monotonic()
+      results = self.run_simulation([], 1)
+      self.assertLess(time.monotonic() - start_time, 5)
+    # Ping and DB checks every 5 minutes
+    self.assertEqual(mock_run_check.call_count, 2 * 24 * 60 // 5)
+    self.assertEqual(results['reboots'], [])
+    self.assertEqual(results['failed_checks'], 0)
+
+  @mock.patch('meteo_check_status.recheck_budget', 0)
+  def test_reboot_backoff(self, mock_logger):
+    """Network outage: reboot timeouts progress as set in reboot_timeouts_map"""
+    start_time = time.monotonic()
+    results = self.run_simulation(['network@1+48'], 3)
+    self.assertLess(time.monotonic() - start_time, 5)
+    self.assertEqual([reboot['reboot_timeout'] for reboot in results['reboots']],
+      [15, 30, 180, 720, 720, 720])
+    for reboot in results['reboots'][1:]:
+      self.assertGreater(reboot['uptime_minutes'], reboot['reboot_timeout'])
+    self.assertEqual(results['false_reboots'], 0)
+    self.assertEqual(results['outages'][0]['detection_latency_minutes'], 0)
+    self.assertEqual(results['notifications'], 6)
+
+  @mock.patch('meteo_check_status.remediation_ladder', ['reset_usb', 'reboot'])
+  def test_station_hang(self, mock_logger):
+    """Station hang: USB reset fixes it without reboot"""
+    results = self.run_simulation(['station@2'], 1)
+    self.assertEqual(results['reboots'], [])
+    self.assertEqual([command['command'] for command in results['remediation_commands']],
+      [meteo_check_status.remediation_commands['reset_usb'][0]])
+    outage = results['outages'][0]
+    # The last record has been written a minute before the hang, it becomes older than
+    # no_db_records_threshold after the threshold, the check interval is 5 minutes
+    self.assertGreaterEqual(outage['detection_latency_minutes'],
+      meteo_check_status.no_db_records_threshold)
+    self.assertLessEqual(outage['detection_latency_minutes'],
+      meteo_check_status.no_db_records_threshold + 5)
+    # Failure is confirmed by re-checks before remediation
+    self.assertEqual(outage['action_latency_minutes'], outage['detection_latency_minutes'] + 0.5)
+    # Weewx has written no records from the hang until the USB reset
+    self.assertEqual(results['db_records'], (3 + 24) * 60 -
+      math.ceil(outage['action_latency_minutes']))
+
+  @mock.patch('meteo_check_status.db_read_mode', 'snapshot')
+  def test_station_hang_reboot(self, mock_logger):
+    """Station hang: reboot fixes it, the DB check reads the Weewx DB snapshot"""
+    results = self.run_simulation(['station@2'], 1)
+    self.assertEqual(len(results['reboots']), 1)
+    self.assertEqual(results['false_reboots'], 0)
+    outage = results['outages'][0]
+    self.assertLessEqual(outage['detection_latency_minutes'],
+      meteo_check_status.no_db_records_threshold + 5)
+    down_minutes = outage['action_latency_minutes'] + simulate_meteo_check_status.shutdown_delay / 60
+    self.assertAlmostEqual(outage['duration_hours'] * 60, down_minutes)
+    # Weewx doesn't write records until it starts after boot, then the data is fresh again
+    self.assertEqual(results['db_records'], (3 + 24) * 60 - math.ceil(down_minutes +
+      simulate_meteo_check_status.boot_duration / 60))
+    self.assertEqual(results['failed_checks'],
+      1 + meteo_check_status.recheck_budget // meteo_check_status.recheck_interval)
+
+  def test_recheck_budget_vs_false_reboots(self, mock_logger):
+    """Re-check budget, longer than short ping failures, prevents false reboots"""
+    with mock.patch.object(meteo_check_status, 'recheck_budget', 0):
+      results = self.run_simulation([], 2, blips_per_day=6, blip_minutes=2, seed=1)
+    self.assertGreater(results['blips'], 0)
+    self.assertGreater(results['false_reboots'], 0)
+    with mock.patch.object(meteo_check_status, 'recheck_budget', 150):
+      results = self.run_simulation([], 2, blips_per_day=6, blip_minutes=2, seed=1)
+    self.assertEqual(results['false_reboots'], 0)
+
+  @mock.patch('meteo_check_status.remediation_ladder', ['reset_usb', 'reboot'])
+  def test_fixed_failures_vs_false_reboots(self, mock_logger):
+    """Failures, that have been fixed by remediation or have passed on re-check,
+       don't fail other checks' results in the scheduler
+    """
+    results = self.run_simulation(['station@2'], 2, blips_per_day=6, blip_minutes=2, seed=1)
+    self.assertGreater(results['blips'], 0)
+    self.assertEqual(results['reboots'], [])
+    # USB reset has fixed the station hang
+    self.assertAlmostEqual(results['outages'][0]['duration_hours'],
+      results['outages'][0]['action_latency_minutes'] / 60, places=3)